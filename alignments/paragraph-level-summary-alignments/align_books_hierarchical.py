@@ -0,0 +1,339 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Script used to align the sentences of book-level summaries (`alignments/book-level-summary-alignments`) with the
+paragraphs of the whole book, coarse to fine:
+    1. every chapter file of the book (`all_chapterized_books/<bid>-chapters/`) is a section, chapters longer than
+       `section_max_paragraphs` paragraphs, eg. a book without chapter files, are split into several sections,
+       the merged paragraphs of each section are encoded and averaged into a section centroid, the merged paragraphs
+       and their embeddings are written to a temporary directory
+    2. summary sentences are scored against the centroids and each one keeps its `top_sections` best sections
+    3. the stable/greedy matchers run inside every selected section, read back from the temporary directory, with
+       the sentences that selected it, each sentence keeps its best scoring alignment over its sections
+Only the centroids and a single section are kept in memory, whatever the length of the book, and every chapter is
+segmented and encoded once. Rows of the data file with the same book (one per summary source) are aligned together.
+
+python align_books_hierarchical.py --data_path ../book-level-summary-alignments/book_summaries_aligned_test.jsonl --stable_alignment
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+from os.path import basename
+
+import numpy as np
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../scripts"))
+import spacy_registry
+from embedding_cache import EmbeddingCache
+from embedding_scheduler import EncodingScheduler
+from encoder_backends import ENCODER_BACKENDS
+from sparse_similarity import normalize_embeddings
+from gather_data import split_summary_sentences
+import align_data_bi_encoder_paraphrase as aligner
+
+BOOK_METHODS = ["stable", "greedy"]
+
+ROMAN_NUMERAL_PATTERN = re.compile(r"^m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})$")
+ROMAN_VALUES = {"i": 1, "v": 5, "x": 10, "l": 50, "c": 100, "d": 500, "m": 1000}
+
+
+def roman_to_int(numeral):
+    value = 0
+    for ix, char in enumerate(numeral):
+        if ix + 1 < len(numeral) and ROMAN_VALUES[char] < ROMAN_VALUES[numeral[ix + 1]]:
+            value -= ROMAN_VALUES[char]
+        else:
+            value += ROMAN_VALUES[char]
+    return value
+
+
+FRONT_MATTER = {"preface", "foreword", "introduction", "prologue", "prelude"}
+BACK_MATTER = {"epilogue", "afterword", "conclusion", "postscript", "appendix"}
+
+
+def chapter_sort_key(file_name):
+    # reading order of the chapter files: front matter, then natural order, eg. act_ii.txt < act_iv.txt, 2.txt < 10.txt, then back matter
+    tokens = re.findall(r"[a-z]+|\d+", os.path.splitext(file_name)[0].lower())
+
+    key = []
+    for token in tokens:
+        if token.isdigit():
+            key.append((0, int(token), ""))
+        elif ROMAN_NUMERAL_PATTERN.match(token):
+            key.append((0, roman_to_int(token), ""))
+        else:
+            key.append((1, 0, token))
+
+    position = 0 if FRONT_MATTER & set(tokens) else 2 if BACK_MATTER & set(tokens) else 1
+    return position, key
+
+
+def iterate_chapter_paragraphs(chapter_path):
+    # paragraphs of a chapter file, streamed line by line, split the same way as `fd.read().split("\n\n")` in gather_data.py
+    lines = []
+    with open(chapter_path) as fd:
+        for line in fd:
+            if line == "\n":
+                paragraph = " ".join(lines).strip()
+                if paragraph:
+                    yield paragraph
+                lines = []
+            else:
+                lines.append(line.rstrip("\n"))
+
+    paragraph = " ".join(lines).strip()
+    if paragraph:
+        yield paragraph
+
+
+def list_chapter_files(chapters_dir, coverage=0.9):
+    """
+    Returns the paths of the chapter files of a book, in reading order, the whole book if it is not chapterized
+    Files that repeat the content of smaller files are left out, eg. chapters_1_to_3.txt, or act_i.txt next to the
+    numbered chapters of the act, or part_i.txt next to part_1.txt
+
+    :param chapters_dir: directory of the book, eg. all_chapterized_books/<bid>-chapters
+    :param coverage: fraction of the paragraphs of a file found in smaller files above which it is left out
+    """
+    file_names = [name for name in os.listdir(chapters_dir) if name.endswith(".txt") and name != "book_clean.txt"]
+    if not file_names:
+        return [os.path.join(chapters_dir, "book_clean.txt")]
+
+    paragraphs = {name: {hash(par) for par in iterate_chapter_paragraphs(os.path.join(chapters_dir, name))} for name in file_names}
+    size = {name: (len(paragraphs[name]), name) for name in file_names}
+
+    kept = []
+    for name in file_names:
+        # paragraphs of the smaller files contained in this one, ties of identical files broken by name
+        contained = set()
+        for other in file_names:
+            if size[other] < size[name] and len(paragraphs[other] & paragraphs[name]) >= coverage * len(paragraphs[other]):
+                contained |= paragraphs[other]
+
+        if not paragraphs[name] or len(contained & paragraphs[name]) < coverage * len(paragraphs[name]):
+            kept.append(name)
+
+    return [os.path.join(chapters_dir, name) for name in sorted(kept, key=chapter_sort_key)]
+
+
+def iterate_book_sections(chapter_paths, max_paragraphs):
+    """
+    Yields the paragraphs of the sections of a book: its chapters, split into windows of at most `max_paragraphs`
+
+    :param chapter_paths: chapter files of the book, in reading order
+    :param max_paragraphs: max number of paragraphs of a section, bounds the size of the similarity matrices
+    """
+    for chapter_path in chapter_paths:
+        section = []
+        for paragraph in iterate_chapter_paragraphs(chapter_path):
+            section.append(paragraph)
+            if len(section) == max_paragraphs:
+                yield section
+                section = []
+
+        if section:
+            yield section
+
+
+def encode_sections(chapter_paths, scheduler, store_dir, args):
+    """
+    Merges and encodes the sections of a book, one at a time, and stores them in `store_dir` for the second pass
+    Returns (section index, centroid, number of merged paragraphs) of the non-empty sections
+
+    :param chapter_paths: chapter files of the book, in reading order
+    :param scheduler: EncodingScheduler of the bi-encoder
+    :param store_dir: temporary directory the merged paragraphs and normalized embeddings are written to
+    """
+    sections = []
+    for section_ix, paragraphs in enumerate(iterate_book_sections(chapter_paths, args.section_max_paragraphs)):
+        merged = aligner.merge_text_paragraphs(paragraphs, args.merging_min_sents, args.merging_max_sents,
+                                               args.segmentation_batch_size, args.segmentation_n_process)
+        if not merged:
+            continue
+
+        embeddings = normalize_embeddings(scheduler.encode([merged])[0].cpu().numpy())
+        np.save(os.path.join(store_dir, "%d.npy" % section_ix), embeddings)
+        with open(os.path.join(store_dir, "%d.json" % section_ix), "w") as fd:
+            json.dump(merged, fd)
+
+        sections.append((section_ix, normalize_embeddings(embeddings.mean(axis=0, keepdims=True))[0], len(merged)))
+
+    return sections
+
+
+def load_section(store_dir, section_ix):
+    # (merged paragraphs, embeddings) of a section written by `encode_sections`, the embeddings are memory-mapped
+    with open(os.path.join(store_dir, "%d.json" % section_ix)) as fd:
+        merged = json.load(fd)
+    return merged, np.load(os.path.join(store_dir, "%d.npy" % section_ix), mmap_mode="r")
+
+
+def load_summary_sentences(summary_path, spacy_nlp):
+    with open(summary_path) as fd:
+        summary_content = json.loads(fd.read())["summary"]
+
+    if isinstance(summary_content, list):
+        summary_content = " ".join(summary_content)
+
+    return split_summary_sentences(spacy_nlp, summary_content, summary_path) if summary_content else []
+
+
+def align_book(chapter_paths, rows, scheduler, spacy_nlp, store_dir, args):
+    """
+    Returns method -> aggregated alignment records of every row of the book
+
+    :param chapter_paths: chapter files of the book, in reading order
+    :param rows: rows of the data file for this book, one per summary source
+    :param scheduler: EncodingScheduler of the bi-encoder
+    :param spacy_nlp: spaCy pipeline used for splitting summaries into sentences
+    :param store_dir: temporary directory of the encoded sections
+    """
+    summaries = [load_summary_sentences(os.path.join(args.summaries_dir, row["summary_path"]), spacy_nlp) for row in rows]
+    summaries_embeddings = [normalize_embeddings(scheduler.encode([sentences])[0].cpu().numpy()) if sentences else None for sentences in summaries]
+
+    # coarse: centroid of every section, and the index of its first merged paragraph in the book
+    sections = encode_sections(chapter_paths, scheduler, store_dir, args)
+    if not sections:
+        return {name: [] for name in BOOK_METHODS}
+
+    section_ids, centroids, section_offsets, offset = [], [], {}, 0
+    for section_ix, centroid, merged_cnt in sections:
+        section_ids.append(section_ix)
+        centroids.append(centroid)
+        section_offsets[section_ix] = offset
+        offset += merged_cnt
+
+    # section -> (row, sentence indices) of the sentences that selected it
+    selected = {}
+    top_sections = min(args.top_sections, len(centroids))
+    for row_ix, embeddings in enumerate(summaries_embeddings):
+        if embeddings is None:
+            continue
+
+        section_scores = embeddings @ np.stack(centroids).T
+        best_sections = np.argsort(-section_scores, axis=1)[:, :top_sections]
+        for s_ix, sections in enumerate(best_sections):
+            for centroid_ix in sections:
+                selected.setdefault(section_ids[centroid_ix], {}).setdefault(row_ix, []).append(s_ix)
+
+    # fine: matching inside the selected sections, (score, paragraph index, paragraph) of the best alignment of each sentence
+    best = {name: [{} for _ in rows] for name in BOOK_METHODS}
+    for section_ix in sorted(selected):
+        merged, embeddings = load_section(store_dir, section_ix)
+        for row_ix, sentence_ixs in selected[section_ix].items():
+            similarity_matrix = summaries_embeddings[row_ix][sentence_ixs] @ embeddings.T
+
+            alignments = {}
+            if args.stable_alignment:
+                alignments["stable"] = aligner.align_data_stable_matching(similarity_matrix, args.alignment_capacity, args.stable_matching_engine)
+            if args.greedy_alignment:
+                alignments["greedy"] = aligner.align_data_greedy_matching(similarity_matrix)
+
+            for name, section_alignments in alignments.items():
+                for local_ix, t_ix in enumerate(section_alignments):
+                    if t_ix < 0:
+                        continue
+
+                    s_ix, score = sentence_ixs[local_ix], float(similarity_matrix[local_ix, t_ix])
+                    if s_ix not in best[name][row_ix] or score > best[name][row_ix][s_ix][0]:
+                        best[name][row_ix][s_ix] = (score, section_offsets[section_ix] + t_ix, merged[t_ix])
+
+    aligned = {}
+    for name in BOOK_METHODS:
+        aligned[name] = []
+        for row, sentences, sentence_alignments in zip(rows, summaries, best[name]):
+            title = "%s.%s-%s" % (row["title"].lower().replace(" ", "_"), row["source"].lower(), name)
+            examples = [{
+                "summary_sentence": sentences[s_ix],
+                "paragraph_alignment": paragraph,
+                "alignment_score": str(score),
+                "title": title + "-" + str(t_ix)
+            } for s_ix, (score, t_ix, paragraph) in sorted(sentence_alignments.items())]
+
+            aligned[name].extend(aligner.aggregate_paragraph_summary_alignments(examples))
+
+    return aligned
+
+
+def main(args):
+    model = aligner.load_bi_encoder(args)
+
+    embedding_cache = None
+    if args.embedding_cache_dir:
+        embedding_cache = EmbeddingCache(args.embedding_cache_dir, aligner.bi_encoder_cache_name(args), model.max_seq_length,
+                                         args.embedding_cache_dtype, max_size_bytes=int(args.embedding_cache_max_gb * 1024 ** 3))
+    scheduler = EncodingScheduler(model, args.encoding_batch_size, args.encoding_bucket_width, embedding_cache)
+
+    spacy_nlp = spacy_registry.get_pipeline('en_core_web_lg', disable=["tagger", "ner", "textcat", "lemmatizer"])
+
+    names = [name for name in BOOK_METHODS if getattr(args, name + "_alignment")]
+    output_files = {name: open(basename(args.data_path) + "." + name, "w") for name in names}
+
+    with open(args.data_path) as fd:
+        data = [json.loads(line) for line in fd]
+
+    # rows of the same book, in the order of their first row, whether or not they are consecutive in the data file
+    book_rows = {}
+    for row in data:
+        book_rows.setdefault(row["book_path"], []).append(row)
+
+    try:
+        for book_path, rows in tqdm(book_rows.items()):
+            rows = [row for row in rows if os.path.exists(os.path.join(args.summaries_dir, row["summary_path"]))]
+            chapters_dir = os.path.dirname(os.path.join(args.books_dir, book_path))
+            if not rows or not os.path.isdir(chapters_dir):
+                print ("Skipping missing book or summaries: ", chapters_dir)
+                continue
+
+            with tempfile.TemporaryDirectory() as store_dir:
+                aligned = align_book(list_chapter_files(chapters_dir), rows, scheduler, spacy_nlp, store_dir, args)
+            for name in names:
+                for record in aligned[name]:
+                    output_files[name].write(json.dumps(record) + "\n")
+    finally:
+        for output_file in output_files.values():
+            output_file.close()
+
+        if embedding_cache is not None:
+            embedding_cache.save_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, required=True, help='path to a book_summaries_aligned_*.jsonl file')
+    parser.add_argument('--books_dir', type=str, default='../../', help='directory the book paths are relative to')
+    parser.add_argument('--summaries_dir', type=str, default='../../scripts/', help='directory the summary paths are relative to')
+    parser.add_argument('--stable_alignment', action='store_true', help='function used for aligning')
+    parser.add_argument('--greedy_alignment', action='store_true', help='function used for aligning')
+    parser.add_argument('--alignment_capacity', type=int, default=10, help='')
+    parser.add_argument('--stable_matching_engine', type=str, default='numpy', choices=['numpy', 'matching'], help='solver used for stable alignment, both return the same alignments')
+    parser.add_argument('--top_sections', type=int, default=3, help='number of best scoring sections each summary sentence is aligned in')
+    parser.add_argument('--section_max_paragraphs', type=int, default=300, help='chapters longer than this many paragraphs are split into several sections')
+    parser.add_argument('--merging_min_sents', type=int, default=4, help='')
+    parser.add_argument('--merging_max_sents', type=int, default=12, help='')
+    parser.add_argument('--segmentation_batch_size', type=int, default=256, help='number of paragraphs per spaCy `nlp.pipe` batch')
+    parser.add_argument('--segmentation_n_process', type=int, default=1, help='number of processes used by spaCy `nlp.pipe`')
+    parser.add_argument('--encoder_backend', type=str, default='pytorch', choices=ENCODER_BACKENDS, help='bi-encoder inference backend')
+    parser.add_argument('--model_dir', type=str, default=None, help='local sentence-transformers model directory')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='number of torch threads')
+    parser.add_argument('--encoding_batch_size', type=int, default=64, help='number of texts per encoder forward pass')
+    parser.add_argument('--encoding_bucket_width', type=int, default=32, help='range of token lengths grouped into the same encoding bucket')
+    parser.add_argument('--embedding_cache_dir', type=str, default=None, help='directory of the persistent embedding cache, disabled if not set')
+    parser.add_argument('--embedding_cache_dtype', type=str, default='float32', choices=['float16', 'float32'], help='dtype of the cached embeddings')
+    parser.add_argument('--embedding_cache_max_gb', type=float, default=20.0, help='size limit of the embedding cache')
+    args = parser.parse_args()
+
+    if not (args.stable_alignment or args.greedy_alignment):
+        raise RuntimeError("At least one alignment option must be chosen: `stable_alignment`, `greedy_alignment`.")
+
+    main(args)
@@ -9,6 +9,8 @@
 Script used to generate alignments of the paragraphs with sentences from the summary using a paraphrase biencoder model - https://huggingface.co/sentence-transformers/paraphrase-distilroberta-base-v1.
 The summary sentences that match with the same paragraph are then aggregated together.
 It is recommended to run this script on a GPU machine.
+torch, sentence_transformers, spaCy, matplotlib and `matching` are imported on first use, so `--help` and argument
+errors return right away.
 """
 
 #!/usr/bin/env python
@@ -23,40 +25,90 @@ import os
 from os.path import basename
 import sys
 import pprint
-import spacy
+import multiprocessing
+from collections import Counter, deque
 import numpy as np
 import warnings
 from tqdm import tqdm
-from matplotlib import pyplot as plt
-from matching.games import HospitalResident
 
-from sentence_transformers import SentenceTransformer, util
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../scripts"))
+import spacy_registry
+from embedding_scheduler import EncodingScheduler
+from embedding_cache import EmbeddingCache, model_dir_fingerprint
+from checkpointing import CheckpointedOutputs
+from sharding import shard_of, shard_output_base, merge_shard_outputs, remove_shard_outputs, parse_shard, in_node_shard, node_output_base
+from encoder_backends import ENCODER_BACKENDS, load_encoder
+from similarity_archive import SimilarityArchiveWriter, check_archive_dir
+from sparse_similarity import TopKSimilarity, topk_similarities
+from lexical_similarity import LEXICAL_SCHEMES, LexicalVectorizer
+from pipeline import Pipeline
+from compact_outputs import chapter_file_offsets, compact_alignment_record, compact_paragraphs_record, load_chapter_offsets
+from parquet_outputs import AlignmentParquetWriter, convert_to_parquet
+from profiling import ExampleProfiler, profile_stage
+from figure_renderer import FigureRenderer, alignment_matrix, render_alignments
+from stable_matching import hospital_optimal_matching, hospital_optimal_matching_library, hospital_optimal_matching_topk
+from monotonic_alignment import align_data_monotonic
+from optimal_alignment import align_data_optimal
 
 # change recursion limit
 sys.setrecursionlimit(5000)
 
 # https://huggingface.co/sentence-transformers/paraphrase-distilroberta-base-v1
-model_bi_encoder_paraphrase = SentenceTransformer('paraphrase-distilroberta-base-v1')
+BI_ENCODER_MODEL_NAME = 'paraphrase-distilroberta-base-v1'
 
-model_bi_encoder_paraphrase.max_seq_length = 512
+# Alignment methods, each one enabled by `--<method>_alignment` and written to a `.<method>` output file
+ALIGNMENT_METHODS = ["stable", "greedy", "monotonic", "optimal"]
 
-pp = pprint.PrettyPrinter(indent=2)
+# Loaded by `load_bi_encoder` with the backend chosen by `--encoder_backend`
+model_bi_encoder_paraphrase = None
 
-error_logs_file = open("error_logs.jsonl","a")
+pp = pprint.PrettyPrinter(indent=2)
 
 warnings.filterwarnings("ignore", category=ResourceWarning)
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
-# Breaks down chapter text into smaller length paragraphs that we can align ground truth summary sentences to
-def merge_text_paragraphs(paragraphs, min_sent=3, max_sent=12):
-    spacy_nlp = spacy.load("en_core_web_lg")
+def enabled_alignment_methods(args):
+    return [name for name in ALIGNMENT_METHODS if getattr(args, name + "_alignment", False)]
+
+
+# Names of the output files, the compact format writes `.<method>.compact` files and the chapter `.paragraphs` file
+def output_names(args):
+    if getattr(args, "output_format", "json") == "compact":
+        return [name + ".compact" for name in enabled_alignment_methods(args)] + ["paragraphs"]
+    return enabled_alignment_methods(args)
+
+
+def load_bi_encoder(args):
+    global model_bi_encoder_paraphrase
+
+    if model_bi_encoder_paraphrase is None:
+        model_bi_encoder_paraphrase = load_encoder(args.encoder_backend, args.model_dir or BI_ENCODER_MODEL_NAME, 512, args.threads_per_worker)
+
+    return model_bi_encoder_paraphrase
+
+
+# Embeddings of different backends differ slightly, so the backend is part of the embedding cache key
+# A local model directory is identified by its resolved path and its files, not only by its name
+def bi_encoder_cache_name(args):
+    if args.model_dir:
+        return "%s-%s:%s" % (basename(os.path.normpath(args.model_dir)), model_dir_fingerprint(args.model_dir), args.encoder_backend)
+    return "%s:%s" % (BI_ENCODER_MODEL_NAME, args.encoder_backend)
 
+
+# Number of sentences in each paragraph, paragraphs are streamed through the spaCy pipeline in batches
+def count_paragraph_sentences(paragraphs, batch_size=256, n_process=1):
+    spacy_nlp = spacy_registry.get_pipeline("en_core_web_lg")
+
+    return [len(list(doc.sents)) for doc in spacy_nlp.pipe(paragraphs, batch_size=batch_size, n_process=n_process)]
+
+
+# Merges paragraphs based on precomputed sentence counts
+def merge_paragraphs_by_counts(paragraphs, sentence_counts, min_sent=3, max_sent=12):
     new_paragraphs = []
     temp_paragraphs = []
     temp_paragraphs_cnt = 0
 
-    for paragraph in paragraphs:
-        paragraph_len = len(list(spacy_nlp(paragraph).sents))
+    for paragraph, paragraph_len in zip(paragraphs, sentence_counts):
 
         if paragraph_len > min_sent:
             if temp_paragraphs:
@@ -85,7 +137,6 @@ def merge_text_paragraphs(paragraphs, min_sent=3, max_sent=12):
         assert len(temp_paragraphs) <=  max_sent
 
         joined = " ".join(temp_paragraphs)
-        new_list_len = list(spacy_nlp(joined).sents)
         new_paragraphs.append(joined)
         temp_paragraphs = []
         temp_paragraphs_cnt = 0
@@ -93,9 +144,96 @@ def merge_text_paragraphs(paragraphs, min_sent=3, max_sent=12):
     return new_paragraphs
 
 
+# Breaks down chapter text into smaller length paragraphs that we can align ground truth summary sentences to
+def merge_text_paragraphs(paragraphs, min_sent=3, max_sent=12, batch_size=256, n_process=1):
+    sentence_counts = count_paragraph_sentences(paragraphs, batch_size, n_process)
+
+    return merge_paragraphs_by_counts(paragraphs, sentence_counts, min_sent, max_sent)
+
+
+# Same as `merge_text_paragraphs` for a list of chapters, paragraphs of all chapters go through a single `nlp.pipe` stream
+def merge_text_paragraphs_batched(chapters, min_sent=3, max_sent=12, batch_size=256, n_process=1):
+    all_paragraphs = [paragraph for paragraphs in chapters for paragraph in paragraphs]
+    all_sentence_counts = count_paragraph_sentences(all_paragraphs, batch_size, n_process)
+
+    merged_chapters = []
+    offset = 0
+    for paragraphs in chapters:
+        sentence_counts = all_sentence_counts[offset:offset + len(paragraphs)]
+        merged_chapters.append(merge_paragraphs_by_counts(paragraphs, sentence_counts, min_sent, max_sent))
+        offset += len(paragraphs)
+
+    return merged_chapters
+
+
+# Examples with the same group key share the chapter text, eg. summaries of one chapter from different sources
+def example_group_key(example, ix, args):
+    if not args.group_key:
+        return ix
+    return example[args.group_key]
+
+
+# Examples are assigned to workers by group key, in the compact format by chapter, so that a chapter
+# is written to the `.paragraphs` file of a single worker whatever the group key
+def worker_shard_key(example, ix, args):
+    if args.output_format == "compact":
+        return example["chapter_path"]
+    return example_group_key(example, ix, args)
+
+
+# Number of remaining examples for each group key, shared chapter data is released once it drops to zero
+def count_group_keys(data, args):
+    return Counter(example_group_key(example, ix, args) for ix, example in enumerate(data) if example['summary'] != [])
+
+
+# Yields (example, summaries, merged paragraphs, group key) for non-empty examples, chapters are segmented in chunks of `chunk_size` examples
+# Each chapter is merged once and shared by all examples with the same group key
+def iterate_merged_examples(data, args, group_counts, profiler=None):
+    group_counts = Counter(group_counts)
+    merged_chapters = {}
+    chunk = []
+
+    def flush(chunk):
+        to_merge = {}
+        for ix, example, key in chunk:
+            if key not in merged_chapters and key not in to_merge:
+                to_merge[key] = [sent for sent in example["text"] if sent]
+
+        with profile_stage(profiler, "merging", [example for _, example, _ in chunk]):
+            merged = merge_text_paragraphs_batched(list(to_merge.values()), args.merging_min_sents, args.merging_max_sents,
+                                                   args.segmentation_batch_size, args.segmentation_n_process)
+        merged_chapters.update(zip(to_merge, merged))
+
+        for ix, example, key in chunk:
+            summaries = [sent for sent in example["summary"] if sent]
+            paragraphs = merged_chapters[key]
+
+            group_counts[key] -= 1
+            if group_counts[key] == 0:
+                del merged_chapters[key]
+
+            yield example, summaries, paragraphs, key
+
+    for ix, example in enumerate(data):
+        if example['summary'] == []:
+            continue
+
+        chunk.append((ix, example, example_group_key(example, ix, args)))
+        if len(chunk) >= args.segmentation_chunk_size:
+            yield from flush(chunk)
+            chunk = []
+
+    if chunk:
+        yield from flush(chunk)
+
+
 def align_data_greedy_matching(similarity_matrix):
     summ_cnt, text_cnt = similarity_matrix.shape
 
+    # top-k paragraphs are sorted, the first one is the most similar
+    if isinstance(similarity_matrix, TopKSimilarity):
+        return similarity_matrix.indices[:, 0].tolist()
+
     # extract alignments
     alignments = np.argmax(similarity_matrix, axis=1).tolist()
 
@@ -103,55 +241,137 @@ def align_data_greedy_matching(similarity_matrix):
     return alignments
 
 
-def align_data_stable_matching(similarity_matrix, text_capacity):
+def align_data_stable_matching(similarity_matrix, text_capacity, engine="numpy"):
     # text paragraphs -> hospital
     # summary paragraphs -> resident
-    summ_cnt, text_cnt = similarity_matrix.shape
+    if isinstance(similarity_matrix, TopKSimilarity):
+        # sentences left out by the truncated preference lists keep their most similar paragraph, beyond its capacity
+        alignments = hospital_optimal_matching_topk(similarity_matrix, text_capacity)
+        return [t_ix if t_ix >= 0 else int(similarity_matrix.indices[s_ix, 0]) for s_ix, t_ix in enumerate(alignments)]
 
-    summ_ids = ["%dS" % ix for ix in range(summ_cnt)]
-    text_ids = ["%dT" % ix for ix in range(text_cnt)]
-    ids_summ = {key: ix for ix, key in enumerate(summ_ids)}
-    ids_text = {key: ix for ix, key in enumerate(text_ids)}
+    if engine == "matching":
+        return hospital_optimal_matching_library(similarity_matrix, text_capacity)
 
-    # organize summary sentences preferences
-    summ_prefs = {key: [] for _, key in enumerate(summ_ids)}
-    for summ_ix, summ_id in enumerate(summ_ids):
-        alignment = np.argsort(similarity_matrix[summ_ix, :])[::-1]
-        summ_prefs[summ_id] = [text_ids[ix] for ix in alignment]
+    return hospital_optimal_matching(similarity_matrix, text_capacity)
 
-    # organize text paragraph preferences
-    text_prefs = {key: [] for _, key in enumerate(text_ids)}
-    for text_ix, text_id in enumerate(text_ids):
-        alignment = np.argsort(similarity_matrix[:, text_ix])[::-1]
-        text_prefs[text_id] = [summ_ids[ix] for ix in alignment]
 
-    # update matching capacity
-    capacity = {key: text_capacity for key in text_ids}
+#Matrix of bi-encoder scores b/w all pairwise paras and summaries #summaries X #paras
+#Using paraphrase-distilroberta-base-v1 bi encoder alignments
+#https://www.sbert.net/docs/usage/semantic_textual_similarity.html
+def compute_similarities_bi_encoder(paragraphs, summaries, scheduler=None):
 
-    # run matching algorithm
-    game = HospitalResident.create_from_dictionaries(summ_prefs, text_prefs, capacity)
-    matching = game.solve(optimal="hospital")
+    if scheduler is not None:
+        paragraphs_embeddings_paraphrase, summaries_embeddings_paraphrase = scheduler.encode([paragraphs, summaries])
+    else:
+        paragraphs_embeddings_paraphrase = model_bi_encoder_paraphrase.encode(paragraphs, convert_to_tensor=True)
+        summaries_embeddings_paraphrase = model_bi_encoder_paraphrase.encode(summaries, convert_to_tensor=True)
 
-    # extract alignments
-    alignments = [-1] * summ_cnt
-    for t_key, s_keys in matching.items():
-        for s_key in s_keys:
-            alignments[ids_summ[s_key.name]] = ids_text[t_key.name]
+    return compute_similarities_from_embeddings(paragraphs_embeddings_paraphrase, summaries_embeddings_paraphrase)
 
-    return alignments
 
+def compute_similarities_from_embeddings(paragraphs_embeddings, summaries_embeddings):
+    from sentence_transformers import util
 
-#Matrix of bi-encoder scores b/w all pairwise paras and summaries #summaries X #paras
-#Using paraphrase-distilroberta-base-v1 bi encoder alignments
-#https://www.sbert.net/docs/usage/semantic_textual_similarity.html
-def compute_similarities_bi_encoder(paragraphs, summaries):
+    similarity_matrix_bi_encoder_paraphrase = util.pytorch_cos_sim(summaries_embeddings, paragraphs_embeddings).cpu().numpy()
 
-    paragraphs_embeddings_paraphrase = model_bi_encoder_paraphrase.encode(paragraphs, convert_to_tensor=True)
-    summaries_embeddings_paraphrase = model_bi_encoder_paraphrase.encode(summaries, convert_to_tensor=True)
+    return similarity_matrix_bi_encoder_paraphrase
 
-    similarity_matrix_bi_encoder_paraphrase = util.pytorch_cos_sim(summaries_embeddings_paraphrase, paragraphs_embeddings_paraphrase).cpu().numpy()
 
-    return similarity_matrix_bi_encoder_paraphrase
+# Yields (example, summaries, paragraphs, similarity matrix), texts from `args.encoding_window` examples are encoded together
+# Paragraph embeddings are computed once per group key and shared by all examples of the group
+def iterate_encoded_examples(merged_examples, args, group_counts, profiler=None):
+    embedding_cache = None
+    if args.embedding_cache_dir:
+        embedding_cache = EmbeddingCache(args.embedding_cache_dir, bi_encoder_cache_name(args), model_bi_encoder_paraphrase.max_seq_length,
+                                         args.embedding_cache_dtype, max_size_bytes=int(args.embedding_cache_max_gb * 1024 ** 3))
+
+    scheduler = EncodingScheduler(model_bi_encoder_paraphrase, args.encoding_batch_size, args.encoding_bucket_width, embedding_cache)
+    group_counts = Counter(group_counts)
+    chapter_embeddings = {}
+    window = []
+
+    def flush(window):
+        to_encode = {}
+        for _, _, paragraphs, key in window:
+            if key not in chapter_embeddings and key not in to_encode:
+                to_encode[key] = paragraphs
+
+        with profile_stage(profiler, "encoding", [example for example, _, _, _ in window]):
+            embeddings = scheduler.encode(list(to_encode.values()) + [summaries for _, summaries, _, _ in window])
+        chapter_embeddings.update(zip(to_encode, embeddings[:len(to_encode)]))
+        summaries_embeddings = embeddings[len(to_encode):]
+
+        for (example, summaries, paragraphs, key), summary_embeddings in zip(window, summaries_embeddings):
+            with profile_stage(profiler, "similarity", [example]):
+                if args.top_k:
+                    similarity_matrix = topk_similarities(chapter_embeddings[key].cpu().numpy(), summary_embeddings.cpu().numpy(), args.top_k, args.top_k_block_size)
+                else:
+                    similarity_matrix = compute_similarities_from_embeddings(chapter_embeddings[key], summary_embeddings)
+
+            group_counts[key] -= 1
+            if group_counts[key] == 0:
+                del chapter_embeddings[key]
+
+            yield example, summaries, paragraphs, similarity_matrix
+
+    try:
+        for merged_example in merged_examples:
+            window.append(merged_example)
+            if len(window) >= args.encoding_window:
+                yield from flush(window)
+                window = []
+
+        if window:
+            yield from flush(window)
+    finally:
+        if embedding_cache is not None:
+            embedding_cache.save_index()
+            print ("Embedding cache hits: %d, misses: %d" % (embedding_cache.hits, embedding_cache.misses))
+
+
+# Fits the lexical vocabulary on the distinct chapters of the whole data file, so all shards and resumed runs share it
+def fit_lexical_vectorizer(args):
+    chapter_paths = set()
+
+    def split_paragraphs():
+        for example in iterate_gathered_examples(args.data_path):
+            if example["chapter_path"] in chapter_paths:
+                continue
+            chapter_paths.add(example["chapter_path"])
+
+            for paragraph in example["text"]:
+                if paragraph:
+                    yield paragraph
+
+    vectorizer = LexicalVectorizer(args.similarity_fn, args.bm25_k1, args.bm25_b).fit(split_paragraphs())
+    print ("Fitted %s vocabulary of %d terms on %d chapters" % (args.similarity_fn, len(vectorizer.vocabulary), len(chapter_paths)))
+
+    return vectorizer
+
+
+# Same as `iterate_encoded_examples` with lexical similarities, paragraph vectors are shared by the examples of a group
+def iterate_lexical_examples(merged_examples, vectorizer, group_counts, profiler=None):
+    group_counts = Counter(group_counts)
+    chapter_vectors = {}
+
+    for example, summaries, paragraphs, key in merged_examples:
+        with profile_stage(profiler, "similarity", [example]):
+            if key not in chapter_vectors:
+                chapter_vectors[key] = vectorizer.transform_paragraphs(paragraphs)
+
+            similarity_matrix = vectorizer.similarities(chapter_vectors[key], vectorizer.transform_summaries(summaries))
+
+        group_counts[key] -= 1
+        if group_counts[key] == 0:
+            del chapter_vectors[key]
+
+        yield example, summaries, paragraphs, similarity_matrix
+
+
+def similarity_score(similarity_matrix, s_ix, t_ix):
+    if isinstance(similarity_matrix, TopKSimilarity):
+        return similarity_matrix.score(s_ix, t_ix)
+    return similarity_matrix[s_ix][t_ix]
 
 
 def gather_data(alignments_bi_encoder_paraphrase, paragraphs, summaries, similarity_matrix_bi_encoder_paraphrase, title):
@@ -161,10 +381,16 @@ def gather_data(alignments_bi_encoder_paraphrase, paragraphs, summaries, similar
 
     for s_ix, t_ix_bienc_p in enumerate(all_alignments):
         # print (s_ix, t_ix)
+
+        # in the top-k mode a paragraph out of the kept top-k has no score, sentences left unmatched there are not written,
+        # the dense matrix keeps the original outputs, where they are written with the last paragraph and a "-1" title
+        if t_ix_bienc_p < 0 and isinstance(similarity_matrix_bi_encoder_paraphrase, TopKSimilarity):
+            continue
+
         example = {
             "summary_sentence": summaries[s_ix],
             "paragraph_alignment": paragraphs[t_ix_bienc_p],
-            "alignment_score":  str(similarity_matrix_bi_encoder_paraphrase[s_ix][t_ix_bienc_p]),
+            "alignment_score":  str(similarity_score(similarity_matrix_bi_encoder_paraphrase, s_ix, t_ix_bienc_p)),
             "title": title + "-" + str(t_ix_bienc_p)    # title has the id of the paragraph each summary sentence is aligned with
         }
         
@@ -173,26 +399,10 @@ def gather_data(alignments_bi_encoder_paraphrase, paragraphs, summaries, similar
     return examples
 
 
+# Renders the figure in the calling thread, `FigureRenderer` renders them in background processes during alignment
 def visualize_alignments(similarity_matrix, alignments, title, output_dir=None):
-    summ_cnt = len(alignments)
-
-    alignment_matrix = np.zeros_like(similarity_matrix)
-    for ix in range(summ_cnt):
-        alignment_matrix[ix][alignments[ix]] = 1
-
-    plt.figure(figsize=(20,10))
-
-    fig, (ax1, ax2) = plt.subplots(2, sharey=True, figsize=(20, 10))
-    fig.suptitle(title)
-    ax1.imshow(similarity_matrix, cmap='gray', interpolation='nearest')
-    ax1.set_title("Similarity matrix")
-    ax2.imshow(alignment_matrix, cmap='gray', interpolation='nearest')
-    ax2.set_title("Alignment matrix")
-
-    if output_dir:
-        plt.savefig(os.path.join(output_dir, title + ".png"), dpi=100)
-
-    plt.close()
+    output_path = os.path.join(output_dir, title + ".png") if output_dir else None
+    render_alignments(similarity_matrix, alignment_matrix(alignments, similarity_matrix.shape), title, output_path)
 
 # Combine sentences from the summary that align with the same paragraph
 def aggregate_paragraph_summary_alignments(examples):
@@ -226,80 +436,372 @@ def aggregate_paragraph_summary_alignments(examples):
     return aggregated_alignments
 
 
-def main(args):
-    # load data
-    with open(args.data_path) as fd:
-        data = [json.loads(line) for line in fd]
-
-    # Create alignment file
+# Stable, greedy, monotonic and/or optimal alignments of a single example, returns output name -> aggregated alignment records
+# With a `renderer`, the figure of each alignment is rendered in the background
+def align_example(example, summaries, paragraphs, similarity_matrix_bi_encoder_paraphrase, args, renderer=None):
+    aligned = {}
 
+    # For all our experimental results, we perform stable alignment        
     if args.stable_alignment:
-        f_stable_alignments = open(basename(args.data_path) + ".stable", "w")
+        stable_alignments_bi_encoder_paraphrase = align_data_stable_matching(similarity_matrix_bi_encoder_paraphrase, args.alignment_capacity, args.stable_matching_engine)
+        # print ("stable_alignments_bi_encoder_paraphrase: ", stable_alignments_bi_encoder_paraphrase)
+
+        # Add a title to uniquely distinguish paragraphs. Has source, book and chapter info
+        title = "%s.%s-stable" % (example["book_id"].lower().replace(" ", "_"), example["source"].lower())
+        stable_examples = gather_data(stable_alignments_bi_encoder_paraphrase, paragraphs, summaries, similarity_matrix_bi_encoder_paraphrase, title)
+
+        if renderer is not None:
+            renderer.submit(similarity_matrix_bi_encoder_paraphrase, stable_alignments_bi_encoder_paraphrase, title)
+        aligned["stable"] = aggregate_paragraph_summary_alignments(stable_examples)
+
 
     if args.greedy_alignment:
-        f_greedy_alignments = open(basename(args.data_path) + ".greedy", "w")
+        title = "%s.%s-greedy" % (example["book_id"].lower().replace(" ", "_"), example["source"].lower())
 
-    # align each example
+        greedy_alignments = align_data_greedy_matching(similarity_matrix_bi_encoder_paraphrase)
+        greedy_examples = gather_data(greedy_alignments, paragraphs, summaries, similarity_matrix_bi_encoder_paraphrase, title)
+
+        if renderer is not None:
+            renderer.submit(similarity_matrix_bi_encoder_paraphrase, greedy_alignments, title)
+
+        aligned["greedy"] = aggregate_paragraph_summary_alignments(greedy_examples)
+
+    # Alignments that follow the narrative order of the chapter
+    if getattr(args, "monotonic_alignment", False):
+        title = "%s.%s-monotonic" % (example["book_id"].lower().replace(" ", "_"), example["source"].lower())
+
+        monotonic_alignments = align_data_monotonic(similarity_matrix_bi_encoder_paraphrase, args.monotonic_skip_penalty, args.monotonic_backtrack_penalty, args.monotonic_band_width)
+        monotonic_examples = gather_data(monotonic_alignments, paragraphs, summaries, similarity_matrix_bi_encoder_paraphrase, title)
+
+        if renderer is not None:
+            renderer.submit(similarity_matrix_bi_encoder_paraphrase, monotonic_alignments, title)
+
+        aligned["monotonic"] = aggregate_paragraph_summary_alignments(monotonic_examples)
+
+    # Alignments with the max total similarity under the paragraph capacity
+    if getattr(args, "optimal_alignment", False):
+        title = "%s.%s-optimal" % (example["book_id"].lower().replace(" ", "_"), example["source"].lower())
+
+        optimal_alignments = align_data_optimal(similarity_matrix_bi_encoder_paraphrase, args.alignment_capacity, args.optimal_max_cells)
+        optimal_examples = gather_data(optimal_alignments, paragraphs, summaries, similarity_matrix_bi_encoder_paraphrase, title)
+
+        if renderer is not None:
+            renderer.submit(similarity_matrix_bi_encoder_paraphrase, optimal_alignments, title)
+
+        aligned["optimal"] = aggregate_paragraph_summary_alignments(optimal_examples)
+
+    return aligned
+
+
+# Output file name -> lines of an aligned example
+# In the compact format the merged paragraphs of a chapter are written once, with the first example of the chapter
+def output_lines(example, paragraphs, aligned, args, chapter_offsets):
+    if args.output_format != "compact":
+        return {name: [json.dumps(record) + "\n" for record in records] for name, records in aligned.items()}
 
-    for ix, example in enumerate(tqdm(data)):
+    chapter_path = example["chapter_path"]
+    lines = {"paragraphs": []}
+    if chapter_path not in chapter_offsets:
+        chapter_offsets[chapter_path] = chapter_file_offsets(args.chapters_dir, chapter_path, paragraphs)
+        lines["paragraphs"].append(json.dumps(compact_paragraphs_record(chapter_path, paragraphs, chapter_offsets[chapter_path])) + "\n")
+
+    for name, records in aligned.items():
+        lines[name + ".compact"] = [json.dumps(compact_alignment_record(record, chapter_path, chapter_offsets[chapter_path])) + "\n" for record in records]
+
+    return lines
+
+
+# Streams the examples of a gathered data file
+def iterate_gathered_examples(data_path):
+    with open(data_path) as fd:
+        for line in fd:
+            yield json.loads(line)
+
+
+# Yields (line number, checkpoint key, example) for non-empty examples that are not completed yet
+# The key identifies the example by its chapter path, source and occurrence of that pair in the data file
+# Only yields the examples of the books of this node (`args.shard`, by bid) and of this worker (`shard`, by group key), keys and line numbers are the ones of the whole file
+def iterate_pending_examples(data_path, completed, args, shard=None):
+    occurrences = Counter()
+
+    for line_ix, example in enumerate(iterate_gathered_examples(data_path)):
         if example['summary'] == []:
             continue
 
+        pair = (example["chapter_path"], example["source"])
+        occurrences[pair] += 1
+        key = "%s|%s|%d" % (pair[0], pair[1], occurrences[pair])
+
+        if not in_node_shard(example, args.shard):
+            continue
+
+        if shard is not None and shard_of(worker_shard_key(example, line_ix, args), args.workers) != shard:
+            continue
+
+        if key not in completed:
+            yield line_ix, key, example
+
+
+# Aligns the examples of the data file, or of a single shard of it, and writes the outputs with the `output_base` prefix
+# With `stream_parquet`, the records are also written to the Parquet files as they are aligned
+def align_examples(args, output_base, shard=None, stream_parquet=False):
+    if args.similarity_fn in LEXICAL_SCHEMES:
+        vectorizer = fit_lexical_vectorizer(args)
+    else:
+        load_bi_encoder(args)
+
+    # Create alignment file
+
+    output_paths = {name: output_base + "." + name for name in output_names(args)}
+
+    if shard is not None or args.shard is not None:
+        output_paths["index"] = output_base + ".index"
+
+    outputs = CheckpointedOutputs(output_paths, output_base + ".checkpoint", args.resume, args.checkpoint_every)
+
+    similarity_archive = None
+    if args.similarity_archive_dir:
+        similarity_archive = SimilarityArchiveWriter(args.similarity_archive_dir, args.similarity_archive_chunk_size, args.resume)
+        outputs.add_commit_hook(similarity_archive.flush)
+
+    # chapters whose merged paragraphs are already written, in the compact format
+    chapter_offsets = {}
+    if args.output_format == "compact":
+        chapter_offsets = load_chapter_offsets(output_paths["paragraphs"])
+
+    # load data, examples are streamed from the data file and their keys are queued until they are written
+    group_counts = count_group_keys((example for _, _, example in iterate_pending_examples(args.data_path, outputs.completed, args, shard)), args)
+    pending_keys = deque()
+
+    def pending_examples():
+        for line_ix, key, example in iterate_pending_examples(args.data_path, outputs.completed, args, shard):
+            pending_keys.append((line_ix, key))
+            yield example
+
+    parquet_writers = {}
+    if stream_parquet:
+        parquet_writers = {name: AlignmentParquetWriter(output_base + "." + name + ".parquet", args.parquet_row_group_size) for name in enabled_alignment_methods(args)}
+
+    # per-example stage times and counts, appended to the .profile file
+    profiler = ExampleProfiler(output_base + ".profile", args.resume) if args.profile else None
+
+    # reading, segmentation, similarities and alignment run as pipeline stages, outputs are written in this thread
+    pipeline = Pipeline(args.pipeline_queue_size)
+    pipeline.add_stage("read", lambda _: pending_examples())
+    pipeline.add_stage("segment", lambda examples: iterate_merged_examples(examples, args, group_counts, profiler))
+
+    # compute similarities
+    #Initially we tried both roberta and paraphrase bi encoder
+    if args.similarity_fn in LEXICAL_SCHEMES:
+        pipeline.add_stage("similarity", lambda merged_examples: iterate_lexical_examples(merged_examples, vectorizer, group_counts, profiler))
+    else:
+        pipeline.add_stage("encode", lambda merged_examples: iterate_encoded_examples(merged_examples, args, group_counts, profiler))
+
+    # figures of every `save_figs_every` example are queued to a pool of processes, the align stage never waits for them
+    renderer = None
+    if args.output_dir:
+        renderer = FigureRenderer(args.output_dir, args.save_figs_workers, args.save_figs_max_size, args.save_figs_queue_size, args.save_figs_skip_when_busy)
+
+    # align each example
+    def align_encoded_examples(encoded_examples):
+        for ix, (example, summaries, paragraphs, similarity_matrix) in enumerate(encoded_examples):
+            example_renderer = renderer if renderer is not None and ix % args.save_figs_every == 0 else None
+            with profile_stage(profiler, "matching", [example]):
+                aligned = align_example(example, summaries, paragraphs, similarity_matrix, args, example_renderer)
+
+            yield example, summaries, paragraphs, similarity_matrix, aligned
+
+    pipeline.add_stage("align", align_encoded_examples)
+
+    progress = tqdm(pipeline, total=sum(group_counts.values()))
+    for example, summaries, paragraphs, similarity_matrix_bi_encoder_paraphrase, aligned in progress:
+
         chap_path  = example["chapter_path"]
         print ("chap path: ", chap_path)
 
-        # merge text paragraphs
-        summaries = [sent for sent in example["summary"] if sent]
-        paragraphs_before_merge = [sent for sent in example["text"] if sent]
+        if pipeline.started:
+            progress.set_postfix(queued=pipeline.queued(), refresh=False)
+
+        line_ix, key = pending_keys.popleft()
+
+        with profile_stage(profiler, "writing", [example]):
+            lines = output_lines(example, paragraphs, aligned, args, chapter_offsets)
+            for name, name_lines in lines.items():
+                for line in name_lines:
+                    outputs.write(name, line)
+
+            for name, parquet_writer in parquet_writers.items():
+                for record in aligned[name]:
+                    parquet_writer.write(record)
+
+            if similarity_archive is not None:
+                similarity_archive.add(line_ix, key, example, summaries, paragraphs, similarity_matrix_bi_encoder_paraphrase)
+
+            if shard is not None or args.shard is not None:
+                line_counts = {name: len(name_lines) for name, name_lines in lines.items()}
+                outputs.write("index", json.dumps(dict(line_counts, line=line_ix, key=key)) + "\n")
 
-        #Convert long book chapters into paragraphs
-        paragraphs = merge_text_paragraphs(paragraphs_before_merge, args.merging_min_sents, args.merging_max_sents)
+            outputs.mark_completed(key)
 
-        # compute similarities
-        #Initially we tried both roberta and paraphrase bi encoder
-        similarity_matrix_bi_encoder_paraphrase = compute_similarities_bi_encoder(paragraphs, summaries)
+        if profiler is not None:
+            profiler.finish(example, key, summaries, paragraphs)
 
-        # For all our experimental results, we perform stable alignment        
-        if args.stable_alignment:
-            stable_alignments_bi_encoder_paraphrase = align_data_stable_matching(similarity_matrix_bi_encoder_paraphrase, args.alignment_capacity)
-            # print ("stable_alignments_bi_encoder_paraphrase: ", stable_alignments_bi_encoder_paraphrase)
+    outputs.close()
+    pipeline.report()
 
-            # Add a title to uniquely distinguish paragraphs. Has source, book and chapter info
-            title = "%s.%s-stable" % (example["book_id"].lower().replace(" ", "_"), example["source"].lower())
-            stable_examples = gather_data(stable_alignments_bi_encoder_paraphrase, paragraphs, summaries, similarity_matrix_bi_encoder_paraphrase, title)
+    for name, parquet_writer in parquet_writers.items():
+        parquet_writer.close()
+        print ("Wrote %d rows to %s.%s.parquet" % (parquet_writer.rows, output_base, name))
 
-            # visualize_alignments(similarity_matrix_bi_encoder_paraphrase, stable_alignments_bi_encoder_paraphrase, title, args.output_dir)
-            stable_examples_aggregated = aggregate_paragraph_summary_alignments(stable_examples)
+    if profiler is not None:
+        profiler.summary()
 
-            for stable_example in stable_examples_aggregated:
-                f_stable_alignments.write(json.dumps(stable_example) + "\n")
+    if renderer is not None:
+        renderer.close()
 
 
-        if args.greedy_alignment:
-            title = "%s.%s-greedy" % (example["book_id"].lower().replace(" ", "_"), example["source"].lower())
+def align_shard(args, shard):
+    # bound the number of threads used by each worker process, lexical similarities don't use torch
+    if args.similarity_fn not in LEXICAL_SCHEMES:
+        import torch
 
-            greedy_alignments = align_data_greedy_matching(similarity_matrix_bi_encoder_paraphrase)
-            greedy_examples = gather_data(greedy_alignments, paragraphs, summaries, similarity_matrix_bi_encoder_paraphrase, title)
+        torch.set_num_threads(args.threads_per_worker)
+    align_examples(args, shard_output_base(node_output_base(basename(args.data_path), args.shard), shard, args.workers), shard)
 
-            greedy_examples_aggregated = aggregate_paragraph_summary_alignments(greedy_examples)
 
-            for greedy_example in greedy_examples_aggregated:
-                f_greedy_alignments.write(json.dumps(greedy_example) + "\n")
+# Aligns the shards of the data file in `args.workers` processes and merges their outputs
+def align_sharded(args):
+    os.environ["OMP_NUM_THREADS"] = str(args.threads_per_worker)
+    os.environ["MKL_NUM_THREADS"] = str(args.threads_per_worker)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+    # every worker is a fresh process with its own model instance and its own embedding cache directory
+    worker_args = []
+    for shard in range(args.workers):
+        shard_args = argparse.Namespace(**vars(args))
+        if args.embedding_cache_dir:
+            shard_args.embedding_cache_dir = os.path.join(args.embedding_cache_dir, "shard-%d-of-%d" % (shard, args.workers))
+        if args.similarity_archive_dir:
+            shard_args.similarity_archive_dir = os.path.join(args.similarity_archive_dir, "shard-%d-of-%d" % (shard, args.workers))
+        worker_args.append(shard_args)
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=align_shard, args=(worker_args[shard], shard)) for shard in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [shard for shard, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError("Alignment workers failed for shards: %s, rerun with `--resume` to continue." % failed)
+
+    names = output_names(args)
+    output_base = node_output_base(basename(args.data_path), args.shard)
+    # the index of a node part is kept for the merge of the nodes
+    merged_cnt = merge_shard_outputs(output_base, names, args.workers, write_index=args.shard is not None)
+    print ("Merged %d examples from %d shards" % (merged_cnt, args.workers))
+
+    if not args.keep_shards:
+        remove_shard_outputs(output_base, names, args.workers)
+
+
+# Parquet copies of the finished alignment outputs, streamed row group by row group, when they could not be written during alignment
+def write_parquet_outputs(output_base, args):
+    for name in enabled_alignment_methods(args):
+        input_path = output_base + "." + name + (".compact" if args.output_format == "compact" else "")
+        rows = convert_to_parquet(input_path, output_base + "." + name + ".parquet", args.parquet_row_group_size)
+        print ("Wrote %d rows to %s.%s.parquet" % (rows, output_base, name))
+
+
+def main(args):
+    # the archives of the workers are subdirectories, old chunks of any layout are checked before they start
+    if args.similarity_archive_dir and os.path.isdir(args.similarity_archive_dir):
+        check_archive_dir(args.similarity_archive_dir, args.resume)
+
+    output_base = node_output_base(basename(args.data_path), args.shard)
+
+    # Parquet rows are written by the output stage of a single process run, the Parquet files of a resumed run would
+    # miss the examples completed before, and the workers' outputs are only ordered by the merge, so they are converted
+    stream_parquet = args.parquet and args.workers <= 1 and not (args.resume and os.path.exists(output_base + ".checkpoint"))
+
+    if args.workers <= 1:
+        align_examples(args, output_base, stream_parquet=stream_parquet)
+    else:
+        align_sharded(args)
+
+    if args.parquet and not stream_parquet:
+        write_parquet_outputs(output_base, args)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_path', type=str, help='path to gathered data file')
-    parser.add_argument('--similarity_fn', type=str, default='weighted', choices=['weighted', 'original'], help='function used for similarity evaluation')
+    parser.add_argument('--similarity_fn', type=str, default='bi_encoder', choices=['bi_encoder'] + LEXICAL_SCHEMES, help='function used for similarity evaluation, `tfidf` and `bm25` are lexical and need no model')
+    parser.add_argument('--bm25_k1', type=float, default=1.2, help='BM25 term frequency saturation')
+    parser.add_argument('--bm25_b', type=float, default=0.75, help='BM25 paragraph length normalization')
     parser.add_argument('--stable_alignment', action='store_true', help='function used for aligning')
     parser.add_argument('--greedy_alignment', action='store_true', help='function used for aligning')
+    parser.add_argument('--monotonic_alignment', action='store_true', help='align summary sentences in the narrative order of the chapter with dynamic programming')
+    parser.add_argument('--monotonic_skip_penalty', type=float, default=0.0, help='monotonic alignment cost of every paragraph skipped between consecutive summary sentences')
+    parser.add_argument('--monotonic_backtrack_penalty', type=float, default=float('inf'), help='monotonic alignment cost of moving back to an earlier paragraph, inf keeps the order strict')
+    parser.add_argument('--monotonic_band_width', type=int, default=None, help='max distance of the monotonic alignment from the diagonal, limits the dynamic program to a band')
+    parser.add_argument('--optimal_alignment', action='store_true', help='assign summary sentences to paragraphs with the max total similarity under `alignment_capacity`')
+    parser.add_argument('--optimal_max_cells', type=int, default=20000000, help='size limit of the optimal assignment problem (#summaries X #paragraphs X capacity), larger examples fall back to stable alignment')
     parser.add_argument('--merging_min_sents', type=int, default=4, help='')
     parser.add_argument('--merging_max_sents', type=int, default=12, help='')
     parser.add_argument('--alignment_capacity', type=int, default=10, help='')
-    parser.add_argument('--save_figs', action='store_true', help='function used for aligning')
+    parser.add_argument('--encoder_backend', type=str, default='pytorch', choices=ENCODER_BACKENDS, help='bi-encoder inference backend, `quantized` and `onnx` are meant for CPU machines')
+    parser.add_argument('--model_dir', type=str, default=None, help='local sentence-transformers model directory, defaults to downloading %s' % BI_ENCODER_MODEL_NAME)
+    parser.add_argument('--stable_matching_engine', type=str, default='numpy', choices=['numpy', 'matching'], help='solver used for stable alignment, both return the same alignments')
+    parser.add_argument('--group_key', type=str, default='chapter_path', help='examples with the same value of this field share merged paragraphs and their embeddings, empty string disables sharing')
+    parser.add_argument('--segmentation_batch_size', type=int, default=256, help='number of paragraphs per spaCy `nlp.pipe` batch')
+    parser.add_argument('--segmentation_n_process', type=int, default=1, help='number of processes used by spaCy `nlp.pipe`')
+    parser.add_argument('--segmentation_chunk_size', type=int, default=1, help='number of chapters segmented together in one `nlp.pipe` stream')
+    parser.add_argument('--encoding_window', type=int, default=16, help='number of examples whose paragraphs and summaries are encoded together')
+    parser.add_argument('--encoding_batch_size', type=int, default=64, help='number of texts per encoder forward pass')
+    parser.add_argument('--encoding_bucket_width', type=int, default=32, help='range of token lengths grouped into the same encoding bucket')
+    parser.add_argument('--embedding_cache_dir', type=str, default=None, help='directory of the persistent embedding cache, disabled if not set')
+    parser.add_argument('--embedding_cache_dtype', type=str, default='float32', choices=['float16', 'float32'], help='dtype of the cached embeddings')
+    parser.add_argument('--embedding_cache_max_gb', type=float, default=20.0, help='size limit of the embedding cache, least recently used shards are evicted beyond it')
+    parser.add_argument('--output_format', type=str, default='json', choices=['json', 'compact'], help='`compact` stores the merged paragraphs of each chapter once and references them by index and chapter file offsets, see compact_outputs.py')
+    parser.add_argument('--chapters_dir', type=str, default='../../', help='directory the chapter paths are relative to, used for the offsets of the compact format')
+    parser.add_argument('--parquet', action='store_true', help='also write the alignments as Parquet files with typed columns as they are aligned, converted at the end of the run with --workers or --resume, requires pyarrow')
+    parser.add_argument('--parquet_row_group_size', type=int, default=10000, help='number of rows per Parquet row group')
+    parser.add_argument('--resume', action='store_true', help='skip examples completed in the last checkpoint and append to the existing output files')
+    parser.add_argument('--checkpoint_every', type=int, default=100, help='number of completed examples between output flushes and checkpoints')
+    parser.add_argument('--top_k', type=int, default=0, help='keep only the k most similar paragraphs of each summary sentence and match on truncated preference lists, 0 keeps the dense matrix, with stable alignment the sentences the truncated lists leave unmatched get their most similar paragraph beyond its capacity')
+    parser.add_argument('--top_k_block_size', type=int, default=1024, help='number of paragraphs scored at once in the top-k mode')
+    parser.add_argument('--similarity_archive_dir', type=str, default=None, help='directory where the similarity matrices are archived for offline re-alignment with realign.py')
+    parser.add_argument('--similarity_archive_chunk_size', type=int, default=256, help='number of examples per similarity archive chunk')
+    parser.add_argument('--pipeline_queue_size', type=int, default=4, help='number of examples buffered between the read/segment/encode/align stages running in their own threads, 0 runs them sequentially')
+    parser.add_argument('--profile', action='store_true', help='record per-example stage times, counts and peak RSS to a .profile JSONL file and print a summary at the end')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes, examples are sharded by their group key, by chapter in the compact format, and the outputs are merged in order')
+    parser.add_argument('--shard', type=parse_shard, default=None, help='i/N, only align the books whose bid hashes to shard i of N, merge the node outputs with sharding.py')
+    parser.add_argument('--keep_shards', action='store_true', help='keep the output, index and checkpoint files of the workers after their outputs are merged')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='number of torch threads of each worker, defaults to #cpus / #workers')
+    parser.add_argument('--save_figs', action='store_true', help='save figures of the similarity and alignment matrices next to the data file')
+    parser.add_argument('--save_figs_every', type=int, default=1, help='save the figures of one example out of every N')
+    parser.add_argument('--save_figs_workers', type=int, default=2, help='number of processes rendering figures')
+    parser.add_argument('--save_figs_queue_size', type=int, default=None, help='number of figures waiting in memory for the rendering processes, defaults to 8 per process, independent of --pipeline_queue_size')
+    parser.add_argument('--save_figs_skip_when_busy', action='store_true', help='skip figures while the figure queue is full instead of spilling them to a temporary directory')
+    parser.add_argument('--save_figs_max_size', type=int, default=1000, help='matrices with more rows or columns are max-pooled down to this size before rendering')
     args = parser.parse_args()
 
-    if not (args.stable_alignment or args.greedy_alignment):
-        raise RuntimeError("At least one alignment option must be chosen: `stable_alignment`, `greedy_alignment`.")
+    if not enabled_alignment_methods(args):
+        raise RuntimeError("At least one alignment option must be chosen: `stable_alignment`, `greedy_alignment`, `monotonic_alignment`, `optimal_alignment`.")
+
+    if args.top_k and (args.monotonic_alignment or args.optimal_alignment):
+        raise RuntimeError("Monotonic and optimal alignments need the dense similarity matrix, they can't be used with `top_k`.")
+
+    if args.top_k and args.similarity_fn in LEXICAL_SCHEMES:
+        raise RuntimeError("The top-k mode works on bi-encoder embeddings, it can't be used with a lexical `similarity_fn`.")
+
+    if args.top_k and args.similarity_archive_dir:
+        raise RuntimeError("The similarity archive stores dense matrices, it can't be used with `top_k`.")
+
+    if args.threads_per_worker is None:
+        args.threads_per_worker = max(1, multiprocessing.cpu_count() // max(1, args.workers))
 
     if args.save_figs:
         args.output_dir = os.path.join(os.path.dirname(args.data_path), "saved_figs")
@@ -0,0 +1,270 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Local HTTP service keeping the bi-encoder and spaCy pipelines loaded between alignment requests.
+Endpoints take and return JSON:
+    POST /merge         {"paragraphs": [...], "merging_min_sents": 4, "merging_max_sents": 12} -> {"paragraphs": [...]}
+    POST /similarity    {"paragraphs": [...], "summaries": [...], "merge": true} -> {"paragraphs": [...], "similarity_matrix": [[...]]}
+    POST /stable        same as /similarity, with "alignment_capacity" -> {"paragraphs": [...], "alignments": [...], "scores": [...]}
+    POST /greedy        same as /similarity -> {"paragraphs": [...], "alignments": [...], "scores": [...]}
+    GET  /stats         queue depth, encoder batches and latency percentiles of each endpoint
+Alignments give the paragraph index of every summary sentence, -1 if it is left unmatched.
+Requests are served concurrently, their texts are queued and a single encoder thread coalesces them into
+micro-batches: it waits at most `--batch_wait_ms` for more requests, up to `--batch_max_texts` texts per batch.
+The model is loaded from a local directory with the Hugging Face hub disabled, so the service runs offline.
+
+python alignment_service.py --model_dir /path/to/paraphrase-distilroberta-base-v1 --port 8765
+"""
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from embedding_scheduler import EncodingScheduler
+from encoder_backends import ENCODER_BACKENDS
+from sparse_similarity import normalize_embeddings
+import align_data_bi_encoder_paraphrase as aligner
+
+ENDPOINTS = ["/merge", "/similarity", "/stable", "/greedy"]
+
+
+class EncodingBatcher:
+
+    def __init__(self, scheduler, max_texts=512, max_wait=0.01):
+        """
+        Encodes the texts of concurrent requests together, in a single encoder thread
+
+        :param scheduler: EncodingScheduler of the bi-encoder
+        :param max_texts: max number of texts of a micro-batch, a single larger request is encoded alone
+        :param max_wait: seconds the first request of a micro-batch waits for other ones
+        """
+        self.scheduler = scheduler
+        self.max_texts = max_texts
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.batched_requests = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def encode(self, texts):
+        # blocks until the texts are encoded, returns a #texts X dim array
+        request = {"texts": texts, "done": threading.Event()}
+        self.requests.put(request)
+        request["done"].wait()
+
+        if "error" in request:
+            raise request["error"]
+        return request["embeddings"]
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        texts_cnt = len(batch[0]["texts"])
+        deadline = time.time() + self.max_wait
+
+        while texts_cnt < self.max_texts:
+            try:
+                request = self.requests.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            batch.append(request)
+            texts_cnt += len(request["texts"])
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                embeddings = self.scheduler.encode([request["texts"] for request in batch])
+                for request, request_embeddings in zip(batch, embeddings):
+                    request["embeddings"] = request_embeddings.cpu().numpy()
+            except Exception as error:
+                for request in batch:
+                    request["error"] = error
+
+            self.batches += 1
+            self.batched_requests += len(batch)
+            for request in batch:
+                request["done"].set()
+
+
+class LatencyStats:
+
+    def __init__(self, window=1000):
+        """
+        :param window: number of most recent requests the percentiles are computed on
+        """
+        self.lock = threading.Lock()
+        self.latencies = {endpoint: deque(maxlen=window) for endpoint in ENDPOINTS}
+        self.counts = {endpoint: 0 for endpoint in ENDPOINTS}
+
+    def add(self, endpoint, seconds):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.counts[endpoint] += 1
+
+    def report(self):
+        report = {}
+        with self.lock:
+            for endpoint, latencies in self.latencies.items():
+                report[endpoint] = {"requests": self.counts[endpoint]}
+                if latencies:
+                    for percentile in [50, 90, 99]:
+                        report[endpoint]["p%d_ms" % percentile] = float(np.percentile(latencies, percentile)) * 1000
+
+        return report
+
+
+class AlignmentService:
+
+    def __init__(self, args):
+        self.args = args
+        self.batcher = EncodingBatcher(EncodingScheduler(aligner.load_bi_encoder(args), args.encoding_batch_size, args.encoding_bucket_width),
+                                       args.batch_max_texts, args.batch_wait_ms / 1000)
+        self.stats = LatencyStats()
+
+        # spaCy pipelines are not thread-safe
+        self.spacy_lock = threading.Lock()
+
+    def merge(self, request):
+        paragraphs = [par for par in request["paragraphs"] if par]
+        with self.spacy_lock:
+            return aligner.merge_text_paragraphs(paragraphs, request.get("merging_min_sents", self.args.merging_min_sents),
+                                                 request.get("merging_max_sents", self.args.merging_max_sents))
+
+    def similarities(self, request):
+        # (paragraphs, #summaries X #paragraphs similarity matrix), paragraphs are merged unless "merge" is false
+        paragraphs = self.merge(request) if request.get("merge", True) else [par for par in request["paragraphs"] if par]
+        summaries = [sent for sent in request["summaries"] if sent]
+        if not paragraphs or not summaries:
+            raise ValueError("paragraphs and summaries must not be empty")
+
+        embeddings = self.batcher.encode(paragraphs + summaries)
+        paragraphs_embeddings, summaries_embeddings = embeddings[:len(paragraphs)], embeddings[len(paragraphs):]
+
+        return paragraphs, normalize_embeddings(summaries_embeddings) @ normalize_embeddings(paragraphs_embeddings).T
+
+    def handle(self, endpoint, request):
+        if endpoint == "/merge":
+            return {"paragraphs": self.merge(request)}
+
+        paragraphs, similarity_matrix = self.similarities(request)
+        if endpoint == "/similarity":
+            return {"paragraphs": paragraphs, "similarity_matrix": similarity_matrix.tolist()}
+
+        if endpoint == "/stable":
+            alignments = aligner.align_data_stable_matching(similarity_matrix, request.get("alignment_capacity", self.args.alignment_capacity))
+        else:
+            alignments = aligner.align_data_greedy_matching(similarity_matrix)
+
+        return {
+            "paragraphs": paragraphs,
+            "alignments": [int(t_ix) for t_ix in alignments],
+            "scores": [float(similarity_matrix[s_ix, t_ix]) if t_ix >= 0 else None for s_ix, t_ix in enumerate(alignments)],
+        }
+
+    def report(self):
+        return {
+            "queue_depth": self.batcher.queue_depth(),
+            "encoder_batches": self.batcher.batches,
+            "requests_per_batch": self.batcher.batched_requests / max(self.batcher.batches, 1),
+            "endpoints": self.stats.report(),
+        }
+
+
+def request_handler(service):
+
+    class AlignmentRequestHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, content):
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self.send_json(200, service.report())
+            else:
+                self.send_json(404, {"error": "unknown endpoint %s" % self.path})
+
+        def do_POST(self):
+            if self.path not in ENDPOINTS:
+                self.send_json(404, {"error": "unknown endpoint %s" % self.path})
+                return
+
+            start = time.time()
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                response = service.handle(self.path, request)
+            except (ValueError, KeyError, TypeError) as error:
+                self.send_json(400, {"error": "%s: %s" % (type(error).__name__, error)})
+                return
+            except Exception as error:
+                self.send_json(500, {"error": "%s: %s" % (type(error).__name__, error)})
+                return
+
+            service.stats.add(self.path, time.time() - start)
+            self.send_json(200, response)
+
+        def log_message(self, format, *args):
+            if service.args.verbose:
+                super().log_message(format, *args)
+
+    return AlignmentRequestHandler
+
+
+def main(args):
+    # only the local model directory is used
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+    service = AlignmentService(args)
+    server = ThreadingHTTPServer((args.host, args.port), request_handler(service))
+    print ("Serving alignments on http://%s:%d" % (args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True, help='local sentence-transformers model directory')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address the service listens on')
+    parser.add_argument('--port', type=int, default=8765, help='port the service listens on')
+    parser.add_argument('--encoder_backend', type=str, default='pytorch', choices=ENCODER_BACKENDS, help='bi-encoder inference backend')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='number of torch threads')
+    parser.add_argument('--encoding_batch_size', type=int, default=64, help='number of texts per encoder forward pass')
+    parser.add_argument('--encoding_bucket_width', type=int, default=32, help='range of token lengths grouped into the same encoding bucket')
+    parser.add_argument('--batch_max_texts', type=int, default=512, help='max number of texts of the requests coalesced into a micro-batch')
+    parser.add_argument('--batch_wait_ms', type=float, default=10.0, help='time a request waits for concurrent ones before its micro-batch is encoded')
+    parser.add_argument('--merging_min_sents', type=int, default=4, help='default of the requests')
+    parser.add_argument('--merging_max_sents', type=int, default=12, help='default of the requests')
+    parser.add_argument('--alignment_capacity', type=int, default=10, help='default of the requests')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,102 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Benchmark of the alignment methods on the same similarity matrices.
+Matrices are read from a similarity archive (`--archive_dir`, written by the aligner with `--similarity_archive_dir`),
+or sampled with a noisy diagonal structure, as summaries mostly follow the narrative order of the chapter.
+For each method it reports the total time, the mean similarity of the aligned pairs, the fraction of consecutive
+summary sentences whose alignment moves back in the chapter and the fraction of unmatched sentences.
+
+python benchmarks/benchmark_alignment_methods.py --archive_dir /path/to/archive
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from monotonic_alignment import align_data_monotonic
+from optimal_alignment import align_data_optimal
+from similarity_archive import list_chunks, load_chunk
+from stable_matching import hospital_optimal_matching
+
+DEFAULT_SHAPES = [(20, 60), (50, 200), (100, 500), (200, 1000)]
+
+
+def sample_similarity_matrix(summ_cnt, text_cnt, rng):
+    # similarities decay with the distance to a position that follows the chapter order
+    positions = np.sort(rng.randint(text_cnt, size=summ_cnt))
+    distances = np.abs(np.arange(text_cnt)[None, :] - positions[:, None])
+    return np.exp(-distances / 3.0) * 0.6 + 0.4 * rng.rand(summ_cnt, text_cnt)
+
+
+def load_similarity_matrices(args):
+    if args.archive_dir:
+        matrices = []
+        for _, chunk_path in list_chunks(args.archive_dir):
+            matrices.extend(load_chunk(chunk_path)[1])
+            if len(matrices) >= args.max_examples:
+                break
+        return matrices[:args.max_examples]
+
+    rng = np.random.RandomState(args.seed)
+    return [sample_similarity_matrix(summ_cnt, text_cnt, rng) for summ_cnt, text_cnt in DEFAULT_SHAPES for _ in range(args.repeats)]
+
+
+def alignment_methods(args):
+    return {
+        "greedy": lambda matrix: np.argmax(matrix, axis=1).tolist(),
+        "stable": lambda matrix: hospital_optimal_matching(matrix, args.alignment_capacity),
+        "optimal": lambda matrix: align_data_optimal(matrix, args.alignment_capacity, args.optimal_max_cells),
+        "monotonic": lambda matrix: align_data_monotonic(matrix, args.skip_penalty, args.backtrack_penalty),
+        "monotonic-band": lambda matrix: align_data_monotonic(matrix, args.skip_penalty, args.backtrack_penalty, args.band_width),
+    }
+
+
+def main(args):
+    matrices = load_similarity_matrices(args)
+    print ("%d similarity matrices, %d summary sentences" % (len(matrices), sum(len(matrix) for matrix in matrices)))
+
+    print ("%16s %10s %10s %10s %10s" % ("method", "time (s)", "score", "backtracks", "unmatched"))
+    for name, method in alignment_methods(args).items():
+        scores, backtracks, moves, unmatched = [], 0, 0, 0
+
+        start = time.time()
+        alignments = [method(matrix) for matrix in matrices]
+        elapsed = time.time() - start
+
+        for matrix, alignment in zip(matrices, alignments):
+            alignment = np.array(alignment)
+            aligned = alignment >= 0
+            unmatched += int(np.sum(~aligned))
+            scores.extend(matrix[np.nonzero(aligned)[0], alignment[aligned]])
+
+            steps = alignment[aligned]
+            backtracks += int(np.sum(steps[1:] < steps[:-1]))
+            moves += max(len(steps) - 1, 0)
+
+        print ("%16s %10.3f %10.4f %10.4f %10.4f" % (name, elapsed, np.mean(scores), backtracks / max(moves, 1), unmatched / max(len(scores) + unmatched, 1)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--archive_dir', type=str, default=None, help='similarity archive directory, random matrices are used if not set')
+    parser.add_argument('--max_examples', type=int, default=500, help='')
+    parser.add_argument('--repeats', type=int, default=5, help='')
+    parser.add_argument('--alignment_capacity', type=int, default=10, help='')
+    parser.add_argument('--optimal_max_cells', type=int, default=20000000, help='')
+    parser.add_argument('--skip_penalty', type=float, default=0.0, help='')
+    parser.add_argument('--backtrack_penalty', type=float, default=float('inf'), help='')
+    parser.add_argument('--band_width', type=int, default=100, help='')
+    parser.add_argument('--seed', type=int, default=0, help='')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,111 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Benchmark of the bi-encoder backends on a sample of gathered examples.
+Reports the encoding throughput of each backend in sentences/sec, and how often the stable and greedy alignments
+computed from its embeddings agree with the ones of the fp32 pytorch baseline.
+
+python benchmarks/benchmark_encoder_backends.py --data_path /path/to/chapter_summary_aligned_test_split.jsonl.gathered --model_dir /path/to/paraphrase-distilroberta-base-v1
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from encoder_backends import ENCODER_BACKENDS, load_encoder
+from stable_matching import hospital_optimal_matching
+import align_data_bi_encoder_paraphrase as aligner
+
+
+def load_examples(data_path, num_examples, args):
+    examples = []
+    with open(data_path) as fd:
+        for line in fd:
+            example = json.loads(line)
+            summaries = [sent for sent in example["summary"] if sent]
+            paragraphs = [par for par in example["text"] if par]
+            if not summaries or not paragraphs:
+                continue
+
+            paragraphs = aligner.merge_text_paragraphs(paragraphs, args.merging_min_sents, args.merging_max_sents)
+            examples.append((summaries, paragraphs))
+
+            if len(examples) >= num_examples:
+                break
+
+    return examples
+
+
+def encode_examples(encoder, examples, batch_size):
+    texts = [text for summaries, paragraphs in examples for text in summaries + paragraphs]
+
+    start = time.time()
+    embeddings = encoder.encode(texts, batch_size=batch_size, convert_to_tensor=True)
+    elapsed = time.time() - start
+
+    similarity_matrices = []
+    offset = 0
+    for summaries, paragraphs in examples:
+        summaries_embeddings = embeddings[offset:offset + len(summaries)]
+        offset += len(summaries)
+        paragraphs_embeddings = embeddings[offset:offset + len(paragraphs)]
+        offset += len(paragraphs)
+
+        similarity_matrices.append(aligner.compute_similarities_from_embeddings(paragraphs_embeddings, summaries_embeddings))
+
+    return similarity_matrices, len(texts) / elapsed
+
+
+def alignments(similarity_matrices, capacity):
+    stable = [hospital_optimal_matching(matrix, capacity) for matrix in similarity_matrices]
+    greedy = [np.argmax(matrix, axis=1).tolist() for matrix in similarity_matrices]
+    return stable, greedy
+
+
+def agreement(alignments_a, alignments_b):
+    same = sum(a == b for example_a, example_b in zip(alignments_a, alignments_b) for a, b in zip(example_a, example_b))
+    total = sum(len(example) for example in alignments_a)
+    return same / max(total, 1)
+
+
+def main(args):
+    examples = load_examples(args.data_path, args.num_examples, args)
+    print ("examples: %d, texts: %d" % (len(examples), sum(len(s) + len(p) for s, p in examples)))
+
+    baseline = None
+    print ("%10s %14s %16s %16s" % ("backend", "sentences/sec", "stable agreement", "greedy agreement"))
+    for backend in args.backends:
+        encoder = load_encoder(backend, args.model_dir, 512, args.num_threads)
+        similarity_matrices, throughput = encode_examples(encoder, examples, args.batch_size)
+        stable, greedy = alignments(similarity_matrices, args.alignment_capacity)
+
+        if baseline is None:
+            baseline = (stable, greedy)
+
+        print ("%10s %14.1f %16.4f %16.4f" % (backend, throughput, agreement(baseline[0], stable), agreement(baseline[1], greedy)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, required=True, help='path to gathered data file')
+    parser.add_argument('--model_dir', type=str, required=True, help='local sentence-transformers model directory')
+    parser.add_argument('--backends', type=str, nargs='+', default=ENCODER_BACKENDS, choices=ENCODER_BACKENDS, help='backends to compare, the first one is the baseline')
+    parser.add_argument('--num_examples', type=int, default=50, help='')
+    parser.add_argument('--batch_size', type=int, default=64, help='')
+    parser.add_argument('--num_threads', type=int, default=None, help='')
+    parser.add_argument('--merging_min_sents', type=int, default=4, help='')
+    parser.add_argument('--merging_max_sents', type=int, default=12, help='')
+    parser.add_argument('--alignment_capacity', type=int, default=10, help='')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,82 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Benchmark of the lexical similarity functions against the bi-encoder on a sample of gathered examples.
+Reports the throughput of each function in sentences/sec (vectorizing and scoring, the vocabulary is fitted on the
+whole data file beforehand), and how often the stable and greedy alignments agree with the bi-encoder ones.
+Without `--model_dir` only the lexical functions are run and the first one is the baseline.
+
+python benchmarks/benchmark_lexical_similarity.py --data_path /path/to/chapter_summary_aligned_test_split.jsonl.gathered --model_dir /path/to/paraphrase-distilroberta-base-v1
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from encoder_backends import load_encoder
+from lexical_similarity import LEXICAL_SCHEMES
+from benchmark_encoder_backends import load_examples, encode_examples, alignments, agreement
+import align_data_bi_encoder_paraphrase as aligner
+
+
+def lexical_similarities(vectorizer, examples):
+    texts_cnt = sum(len(summaries) + len(paragraphs) for summaries, paragraphs in examples)
+
+    start = time.time()
+    similarity_matrices = [vectorizer.similarities(vectorizer.transform_paragraphs(paragraphs), vectorizer.transform_summaries(summaries))
+                           for summaries, paragraphs in examples]
+    elapsed = time.time() - start
+
+    return similarity_matrices, texts_cnt / elapsed
+
+
+def main(args):
+    examples = load_examples(args.data_path, args.num_examples, args)
+    print ("examples: %d, texts: %d" % (len(examples), sum(len(s) + len(p) for s, p in examples)))
+
+    results = []
+    if args.model_dir:
+        encoder = load_encoder(args.encoder_backend, args.model_dir, 512, args.num_threads)
+        results.append(("bi_encoder",) + encode_examples(encoder, examples, args.batch_size))
+
+    for scheme in LEXICAL_SCHEMES:
+        start = time.time()
+        vectorizer = aligner.fit_lexical_vectorizer(argparse.Namespace(data_path=args.data_path, similarity_fn=scheme, bm25_k1=args.bm25_k1, bm25_b=args.bm25_b))
+        print ("%s fit time: %.1fs" % (scheme, time.time() - start))
+
+        results.append((scheme,) + lexical_similarities(vectorizer, examples))
+
+    baseline = None
+    print ("%10s %14s %16s %16s" % ("function", "sentences/sec", "stable agreement", "greedy agreement"))
+    for name, similarity_matrices, throughput in results:
+        stable, greedy = alignments(similarity_matrices, args.alignment_capacity)
+
+        if baseline is None:
+            baseline = (stable, greedy)
+
+        print ("%10s %14.1f %16.4f %16.4f" % (name, throughput, agreement(baseline[0], stable), agreement(baseline[1], greedy)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, required=True, help='path to gathered data file')
+    parser.add_argument('--model_dir', type=str, default=None, help='local sentence-transformers model directory of the bi-encoder baseline')
+    parser.add_argument('--encoder_backend', type=str, default='pytorch', help='')
+    parser.add_argument('--num_examples', type=int, default=50, help='')
+    parser.add_argument('--batch_size', type=int, default=64, help='')
+    parser.add_argument('--num_threads', type=int, default=None, help='')
+    parser.add_argument('--merging_min_sents', type=int, default=4, help='')
+    parser.add_argument('--merging_max_sents', type=int, default=12, help='')
+    parser.add_argument('--alignment_capacity', type=int, default=10, help='')
+    parser.add_argument('--bm25_k1', type=float, default=1.2, help='')
+    parser.add_argument('--bm25_b', type=float, default=0.75, help='')
+    args = parser.parse_args()
+
+    main(args)
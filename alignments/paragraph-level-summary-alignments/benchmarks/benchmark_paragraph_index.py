@@ -0,0 +1,67 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Benchmark of the paragraph ANN index against exact search on book sizes.
+Embeddings are sampled around topic centroids as in `benchmark_topk_similarity.py`. For each number of paragraphs
+it reports the build time of the index, then the query time and recall@k of every `n_probe` value next to the
+time of exact search.
+
+python benchmarks/benchmark_paragraph_index.py --top_k 10 --n_probe 1 4 8 16
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from paragraph_index import ParagraphIndex, exact_search, recall_at_k
+from benchmark_topk_similarity import sample_embeddings
+
+DEFAULT_SIZES = [5000, 20000, 80000]
+
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+
+    print ("%10s %8s %10s %10s %8s %10s %10s" % ("paragraphs", "lists", "build (s)", "exact (s)", "n_probe", "ann (s)", "recall@k"))
+    for text_cnt in args.paragraphs:
+        paragraphs, summaries = sample_embeddings(args.queries, text_cnt, args.dim, rng)
+
+        start = time.time()
+        index = ParagraphIndex.build(paragraphs, args.n_lists, args.kmeans_iterations, args.seed)
+        build_time = time.time() - start
+
+        start = time.time()
+        exact_indices, _ = exact_search(paragraphs, summaries, args.top_k)
+        exact_time = time.time() - start
+
+        for n_probe in args.n_probe:
+            start = time.time()
+            indices, _ = index.search(summaries, args.top_k, n_probe)
+            search_time = time.time() - start
+
+            print ("%10d %8d %10.3f %10.4f %8d %10.4f %10.4f" % (text_cnt, len(index.centroids), build_time, exact_time, n_probe, search_time,
+                                                                recall_at_k(indices, exact_indices)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paragraphs', type=int, nargs='+', default=DEFAULT_SIZES, help='')
+    parser.add_argument('--queries', type=int, default=500, help='')
+    parser.add_argument('--top_k', type=int, default=10, help='')
+    parser.add_argument('--n_lists', type=int, default=None, help='')
+    parser.add_argument('--n_probe', type=int, nargs='+', default=[1, 4, 8, 16], help='')
+    parser.add_argument('--kmeans_iterations', type=int, default=10, help='')
+    parser.add_argument('--dim', type=int, default=768, help='')
+    parser.add_argument('--seed', type=int, default=0, help='')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,84 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Benchmark of the NumPy stable matching engine against the `matching` library.
+Similarity matrix shapes are taken from a gathered data file (#summary sentences X #chapter paragraphs, an upper
+bound on the number of merged paragraphs) or from a default list of shapes. Both engines are checked to return
+the same alignments.
+
+python benchmarks/benchmark_stable_matching.py --data_path /path/to/chapter_summary_aligned_test_split.jsonl.gathered
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from stable_matching import hospital_optimal_matching, hospital_optimal_matching_library
+
+# `matching` deep-copies the players, same limit as in the aligner
+sys.setrecursionlimit(5000)
+
+DEFAULT_SHAPES = [(10, 40), (25, 100), (50, 200), (100, 400), (200, 800)]
+
+
+def load_shapes(data_path, num_examples, seed):
+    with open(data_path) as fd:
+        shapes = []
+        for line in fd:
+            example = json.loads(line)
+            summ_cnt = len([sent for sent in example["summary"] if sent])
+            text_cnt = len([par for par in example["text"] if par])
+            if summ_cnt and text_cnt:
+                shapes.append((summ_cnt, text_cnt))
+
+    rng = np.random.RandomState(seed)
+    rng.shuffle(shapes)
+
+    return sorted(shapes[:num_examples])
+
+
+def main(args):
+    shapes = load_shapes(args.data_path, args.num_examples, args.seed) if args.data_path else DEFAULT_SHAPES
+    rng = np.random.RandomState(args.seed)
+
+    total_numpy, total_library = 0.0, 0.0
+
+    print ("%10s %10s %12s %12s %8s %6s" % ("summaries", "paragraphs", "numpy (s)", "matching (s)", "speedup", "same"))
+    for summ_cnt, text_cnt in shapes:
+        similarity_matrix = rng.uniform(-0.2, 1.0, size=(summ_cnt, text_cnt)).astype(np.float32)
+
+        start = time.time()
+        alignments_numpy = hospital_optimal_matching(similarity_matrix, args.alignment_capacity)
+        time_numpy = time.time() - start
+
+        start = time.time()
+        alignments_library = hospital_optimal_matching_library(similarity_matrix, args.alignment_capacity)
+        time_library = time.time() - start
+
+        total_numpy += time_numpy
+        total_library += time_library
+
+        print ("%10d %10d %12.4f %12.4f %8.1f %6s" % (summ_cnt, text_cnt, time_numpy, time_library, time_library / max(time_numpy, 1e-9), alignments_numpy == alignments_library))
+
+    print ("total numpy: %.3fs, total matching: %.3fs, speedup: %.1fx" % (total_numpy, total_library, total_library / max(total_numpy, 1e-9)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, default=None, help='path to gathered data file, shapes are taken from it')
+    parser.add_argument('--num_examples', type=int, default=50, help='number of examples sampled from the data file')
+    parser.add_argument('--alignment_capacity', type=int, default=10, help='')
+    parser.add_argument('--seed', type=int, default=0, help='')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,139 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Startup time benchmark of the command line scripts of the repository.
+Every script with an argparse parser is run with `--help` from its own directory, the benchmark reports the median
+wall time, the peak memory of the process and the top-level import that took the longest (`python -X importtime`).
+Scripts without a parser, eg. in scripts/data_collection and scripts/data_cleaning, start their work (scraping,
+cleaning) at module level, so only their top-level imports are run and timed, they are marked `imports` in the report.
+Modules without a parser imported by other scripts are libraries and are not timed on their own, scripts with syntax errors are listed
+as excluded after the report.
+
+python benchmarks/benchmark_startup.py --repeats 5
+"""
+
+import argparse
+import ast
+import os
+import re
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+
+
+def imported_modules(module):
+    # names of the modules imported by a parsed script
+    names = set()
+    for node in ast.walk(module):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names.add(node.module)
+    return names
+
+
+def find_cli_scripts(root):
+    """
+    Returns (path, mode) of the scripts, `help` for scripts with an argparse parser, `imports` for the other ones,
+    and the paths of the scripts that can't be parsed
+
+    :param root: directory searched for scripts, modules without a parser imported by other ones are libraries
+    """
+    sources, unparsable, libraries = {}, [], set()
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith(".") and name != "__pycache__")
+        for file_name in sorted(file_names):
+            if not file_name.endswith(".py"):
+                continue
+
+            path = os.path.join(dir_path, file_name)
+            with open(path, errors="ignore") as fd:
+                sources[path] = fd.read()
+
+            try:
+                libraries |= imported_modules(ast.parse(sources[path]))
+            except SyntaxError:
+                unparsable.append(path)
+
+    scripts = []
+    for path, source in sources.items():
+        if path in unparsable:
+            continue
+
+        if "argparse" in source:
+            scripts.append((path, "help"))
+        elif os.path.splitext(os.path.basename(path))[0] not in libraries:
+            scripts.append((path, "imports"))
+
+    return scripts, unparsable
+
+
+def import_statements(script):
+    # top-level imports of a script, run without the rest of the module
+    with open(script, errors="ignore") as fd:
+        source = fd.read()
+
+    statements = [ast.get_source_segment(source, node) for node in ast.parse(source).body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    return "\n".join(statements)
+
+
+def run_startup(script, mode, importtime=False):
+    # `--help` of a script with a parser, or its top-level imports, from the directory of the script
+    command = [sys.executable] + (["-X", "importtime"] if importtime else [])
+    command += [script, "--help"] if mode == "help" else ["-c", import_statements(script)]
+
+    start = time.time()
+    process = subprocess.Popen(command, cwd=os.path.dirname(script), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read().decode(errors="ignore")
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+
+    # ru_maxrss is in KB on linux
+    return elapsed, usage.ru_maxrss / 1024, os.waitstatus_to_exitcode(status), stderr
+
+
+def slowest_import(importtime_log):
+    # top-level entries of `-X importtime` have no indentation before the module name
+    slowest = ("-", 0)
+    for match in re.finditer(r"import time:\s+\d+ \|\s+(\d+) \| (\S.*)", importtime_log):
+        cumulative, module = int(match.group(1)), match.group(2)
+        if cumulative > slowest[1]:
+            slowest = (module, cumulative)
+
+    return "%s (%.2fs)" % (slowest[0], slowest[1] / 1e6)
+
+
+def main(args):
+    scripts, unparsable = find_cli_scripts(args.root)
+
+    print ("%-90s %8s %10s %10s %6s  %s" % ("script", "mode", "time (s)", "peak MB", "exit", "slowest import"))
+    for script, mode in scripts:
+        results = [run_startup(script, mode) for _ in range(args.repeats)]
+        _, _, _, importtime_log = run_startup(script, mode, importtime=True)
+
+        elapsed = np.median([result[0] for result in results])
+        peak = max(result[1] for result in results)
+        exit_code = results[-1][2]
+
+        print ("%-90s %8s %10.2f %10.1f %6d  %s" % (os.path.relpath(script, args.root), mode, elapsed, peak, exit_code, slowest_import(importtime_log)))
+
+    for script in unparsable:
+        print ("Excluded, not valid Python: %s" % os.path.relpath(script, args.root))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default=REPO_ROOT, help='directory searched for scripts')
+    parser.add_argument('--repeats', type=int, default=3, help='')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,91 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Benchmark of the sparse top-k similarity mode against the dense similarity matrix on long chapter sizes.
+Embeddings are sampled around topic centroids, so that sentences have a few clearly similar paragraphs as in real data.
+For each size it reports time and peak memory (tracemalloc) of similarity + stable matching for both paths, the
+rate of sentences left unmatched by the truncated preference lists of the top-k matching (before they fall back to
+their most similar paragraph), and how often the greedy and stable alignments of the top-k path agree with the dense
+ones. Each size is also run with all summary sentences sampled around `--hot_paragraphs` paragraphs, as in summaries
+that focus on a few paragraphs of a chapter, which is where sentences go unmatched.
+
+python benchmarks/benchmark_topk_similarity.py --top_k 32
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sparse_similarity import normalize_embeddings, topk_similarities
+from stable_matching import hospital_optimal_matching, hospital_optimal_matching_topk
+from align_data_bi_encoder_paraphrase import align_data_stable_matching
+
+DEFAULT_SHAPES = [(100, 1000), (300, 3000), (600, 8000)]
+
+
+def sample_embeddings(summ_cnt, text_cnt, dim, rng, hot_paragraphs=None):
+    # with `hot_paragraphs`, summary sentences are sampled closely around that many paragraphs only
+    topics = rng.normal(size=(max(8, text_cnt // 20), dim))
+    paragraphs = topics[rng.randint(len(topics), size=text_cnt)] + 0.8 * rng.normal(size=(text_cnt, dim))
+    noise = 0.3 if hot_paragraphs else 1.2
+    summaries = paragraphs[rng.randint(hot_paragraphs or text_cnt, size=summ_cnt)] + noise * rng.normal(size=(summ_cnt, dim))
+    return paragraphs.astype(np.float32), summaries.astype(np.float32)
+
+
+def measure(function):
+    tracemalloc.start()
+    start = time.time()
+    result = function()
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 1024 ** 2
+
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+
+    print ("%10s %10s %6s %10s %10s %10s %10s %10s %8s %8s" % ("summaries", "paragraphs", "hot", "dense (s)", "dense MB", "top-k (s)", "top-k MB", "unmatched", "greedy", "stable"))
+    for (summ_cnt, text_cnt), hot_paragraphs in [(shape, hot) for shape in DEFAULT_SHAPES for hot in [None, args.hot_paragraphs]]:
+        paragraphs, summaries = sample_embeddings(summ_cnt, text_cnt, args.dim, rng, hot_paragraphs)
+
+        def dense():
+            similarity_matrix = normalize_embeddings(summaries) @ normalize_embeddings(paragraphs).T
+            return np.argmax(similarity_matrix, axis=1).tolist(), hospital_optimal_matching(similarity_matrix, args.alignment_capacity)
+
+        def topk():
+            topk_similarity = topk_similarities(paragraphs, summaries, args.top_k, args.block_size)
+            return topk_similarity, topk_similarity.indices[:, 0].tolist(), align_data_stable_matching(topk_similarity, args.alignment_capacity)
+
+        (dense_greedy, dense_stable), dense_time, dense_peak = measure(dense)
+        (topk_similarity, topk_greedy, topk_stable), topk_time, topk_peak = measure(topk)
+        unmatched = np.mean(np.array(hospital_optimal_matching_topk(topk_similarity, args.alignment_capacity)) < 0)
+
+        greedy_agreement = np.mean(np.array(dense_greedy) == np.array(topk_greedy))
+        stable_agreement = np.mean(np.array(dense_stable) == np.array(topk_stable))
+
+        print ("%10d %10d %6s %10.3f %10.1f %10.3f %10.1f %10.4f %8.4f %8.4f" % (summ_cnt, text_cnt, hot_paragraphs or "-", dense_time, dense_peak, topk_time, topk_peak,
+                                                                           unmatched, greedy_agreement, stable_agreement))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top_k', type=int, default=32, help='')
+    parser.add_argument('--block_size', type=int, default=1024, help='')
+    parser.add_argument('--alignment_capacity', type=int, default=10, help='')
+    parser.add_argument('--hot_paragraphs', type=int, default=1, help='number of paragraphs the summary sentences are sampled around in the concentrated runs')
+    parser.add_argument('--dim', type=int, default=768, help='')
+    parser.add_argument('--seed', type=int, default=0, help='')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,97 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Checkpointed output files for long alignment runs.
+Output lines are written through regular file handles, every `checkpoint_every` completed examples the files
+are flushed to disk and the checkpoint file is atomically replaced with the list of completed example keys and
+the committed size of each output file. When a run is resumed, the output files are truncated to their committed
+size, so lines of partially written examples are dropped, and the completed examples are skipped.
+"""
+
+import json
+import os
+
+
+def atomic_write_json(path, content):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as fd:
+        json.dump(content, fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(temp_path, path)
+
+
+class CheckpointedOutputs:
+
+    def __init__(self, output_paths, checkpoint_path, resume=False, checkpoint_every=100):
+        """
+        :param output_paths: dictionary of output name -> path, eg. {"stable": "x.gathered.stable"}
+        :param checkpoint_path: path of the checkpoint file
+        :param resume: continue from the last checkpoint instead of starting from scratch
+        :param checkpoint_every: number of completed examples between checkpoints
+        """
+        self.output_paths = output_paths
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+
+        self.completed = set()
+        offsets = {}
+
+        if resume and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as fd:
+                checkpoint = json.load(fd)
+            self.completed = set(checkpoint["completed"])
+            offsets = checkpoint["offsets"]
+        elif os.path.exists(checkpoint_path):
+            # the outputs are truncated below, a later resume must not use the offsets of an older run
+            os.remove(checkpoint_path)
+
+        self.files = {}
+        for name, path in output_paths.items():
+            if resume and os.path.exists(path):
+                # drop everything written after the last checkpoint
+                with open(path, "r+") as fd:
+                    fd.truncate(offsets.get(name, 0))
+                self.files[name] = open(path, "a")
+            else:
+                self.files[name] = open(path, "w")
+
+        self.uncommitted = 0
+        self.commit_hooks = []
+
+    def add_commit_hook(self, hook):
+        # called before each checkpoint, eg. to flush other outputs of the completed examples
+        self.commit_hooks.append(hook)
+
+    def write(self, name, line):
+        self.files[name].write(line)
+
+    def mark_completed(self, key):
+        self.completed.add(key)
+        self.uncommitted += 1
+
+        if self.uncommitted >= self.checkpoint_every:
+            self.commit()
+
+    def commit(self):
+        for hook in self.commit_hooks:
+            hook()
+
+        offsets = {}
+        for name, fd in self.files.items():
+            fd.flush()
+            os.fsync(fd.fileno())
+            offsets[name] = fd.tell()
+
+        atomic_write_json(self.checkpoint_path, {"completed": sorted(self.completed), "offsets": offsets})
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        for fd in self.files.values():
+            fd.close()
@@ -0,0 +1,189 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Compact output format of the paragraph alignments (`--output_format compact`).
+The merged paragraphs of each chapter are written once to a `.paragraphs` file, with the character offsets of every
+merged paragraph in the chapter file, and the `.<method>.compact` records reference them by index:
+    .paragraphs          {"chapter_path": ..., "paragraphs": [...], "offsets": [[start, end], ...] or null}
+    .<method>.compact    {"chapter_path": ..., "title": ..., "paragraph": ix, "offsets": [start, end] or null,
+                          "summary": [...], "alignment_scores": [...]}
+`load_compact_alignments` materialises the records of the default JSON format, `text` and `title` included. The
+`.paragraphs` file is indexed by byte offset and only the chapter of the current record is kept in memory.
+
+python compact_outputs.py --input chapter_summary_aligned_test_split.jsonl.gathered.stable.compact
+"""
+
+import argparse
+import json
+import os
+import re
+
+
+def chapter_paragraph_spans(chapter_text):
+    # (start, end) of the paragraphs the way gather_data.py splits them: on blank lines, stripped, empty ones dropped
+    spans = []
+    position = 0
+    for chunk in chapter_text.split("\n\n"):
+        start, end = position, position + len(chunk)
+        position = end + 2
+
+        chunk = chunk.replace("\n", " ")
+        if not chunk.strip():
+            continue
+
+        spans.append((chunk.strip(), start + len(chunk) - len(chunk.lstrip()), end - len(chunk) + len(chunk.rstrip())))
+
+    return spans
+
+
+def paragraph_offsets(chapter_text, merged_paragraphs):
+    """
+    Character offsets of the merged paragraphs in the chapter file, None if they don't match its paragraphs
+
+    :param chapter_text: content of the chapter file
+    :param merged_paragraphs: paragraphs of the chapter merged by the aligner
+    """
+    spans = chapter_paragraph_spans(chapter_text)
+
+    offsets = []
+    span_ix = 0
+    for paragraph in merged_paragraphs:
+        if not paragraph:
+            position = spans[span_ix][1] if span_ix < len(spans) else len(chapter_text)
+            offsets.append([position, position])
+            continue
+
+        # merged paragraphs are consecutive chapter paragraphs joined with spaces
+        start_ix, joined = span_ix, ""
+        while span_ix < len(spans) and len(joined) < len(paragraph):
+            joined = spans[span_ix][0] if span_ix == start_ix else joined + " " + spans[span_ix][0]
+            span_ix += 1
+
+        if joined != paragraph:
+            return None
+        offsets.append([spans[start_ix][1], spans[span_ix - 1][2]])
+
+    return offsets
+
+
+def chapter_file_offsets(chapters_dir, chapter_path, merged_paragraphs):
+    # offsets of the merged paragraphs in the chapter file, None if the file is missing
+    try:
+        with open(os.path.join(chapters_dir, chapter_path)) as fd:
+            return paragraph_offsets(fd.read(), merged_paragraphs)
+    except FileNotFoundError:
+        return None
+
+
+def compact_paragraphs_record(chapter_path, paragraphs, offsets):
+    return {"chapter_path": chapter_path, "paragraphs": paragraphs, "offsets": offsets}
+
+
+def compact_alignment_record(record, chapter_path, offsets):
+    """
+    Compact form of an aggregated alignment record
+
+    :param record: record of `aggregate_paragraph_summary_alignments`, its title ends with the paragraph index
+    :param chapter_path: chapter of the example, key of its merged paragraphs
+    :param offsets: offsets of the merged paragraphs of the chapter, or None
+    """
+    # the index is -1 for the sentences stable matching leaves unmatched
+    title, paragraph_ix = re.match(r"^(.*?)-(-?\d+)$", record["title"]).groups()
+    paragraph_ix = int(paragraph_ix)
+
+    return {
+        "chapter_path": chapter_path,
+        "title": title,
+        "paragraph": paragraph_ix,
+        "offsets": offsets[paragraph_ix] if offsets is not None else None,
+        "summary": record["summary"],
+        "alignment_scores": record["alignment_scores"],
+    }
+
+
+def paragraphs_path_of(compact_path):
+    # X.<method>.compact -> X.paragraphs
+    return compact_path.rsplit(".", 2)[0] + ".paragraphs"
+
+
+def index_chapter_paragraphs(paragraphs_path):
+    # chapter path -> byte offset of its line in the .paragraphs file
+    chapter_offsets = {}
+    with open(paragraphs_path, "rb") as fd:
+        offset = 0
+        for line in fd:
+            chapter_offsets.setdefault(json.loads(line)["chapter_path"], offset)
+            offset += len(line)
+
+    return chapter_offsets
+
+
+def read_chapter_paragraphs(fd, offset):
+    fd.seek(offset)
+    return json.loads(fd.readline())["paragraphs"]
+
+
+def load_chapter_offsets(paragraphs_path):
+    # chapter path -> offsets of the chapters already written, used to resume a run
+    chapter_offsets = {}
+    if os.path.exists(paragraphs_path):
+        with open(paragraphs_path) as fd:
+            for line in fd:
+                record = json.loads(line)
+                chapter_offsets.setdefault(record["chapter_path"], record["offsets"])
+
+    return chapter_offsets
+
+
+def load_compact_alignments(compact_path, paragraphs_path=None):
+    """
+    Yields the alignment records of a compact file in the default JSON format
+
+    :param compact_path: path of a .<method>.compact file
+    :param paragraphs_path: path of the .paragraphs file, defaults to the one next to the compact file
+    """
+    paragraphs_path = paragraphs_path or paragraphs_path_of(compact_path)
+    chapter_offsets = index_chapter_paragraphs(paragraphs_path)
+
+    # records of a chapter are consecutive, its paragraphs are read when its first record comes
+    chapter_path, paragraphs = None, None
+    with open(compact_path) as fd, open(paragraphs_path, "rb") as paragraphs_fd:
+        for line in fd:
+            record = json.loads(line)
+            if record["chapter_path"] != chapter_path:
+                chapter_path = record["chapter_path"]
+                paragraphs = read_chapter_paragraphs(paragraphs_fd, chapter_offsets[chapter_path])
+
+            yield {
+                'text': paragraphs[record["paragraph"]],
+                'summary': record["summary"],
+                'alignment_scores': record["alignment_scores"],
+                'title': "%s-%d" % (record["title"], record["paragraph"]),
+            }
+
+
+def main(args):
+    output_path = args.output or args.input[:-len(".compact")]
+
+    records_cnt = 0
+    with open(output_path, "w") as fd:
+        for record in load_compact_alignments(args.input, args.paragraphs):
+            fd.write(json.dumps(record) + "\n")
+            records_cnt += 1
+
+    print ("Wrote %d records to %s" % (records_cnt, output_path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True, help='path of a .<method>.compact file')
+    parser.add_argument('--paragraphs', type=str, default=None, help='path of the .paragraphs file, defaults to the one next to the input')
+    parser.add_argument('--output', type=str, default=None, help='path of the JSON output, defaults to the input without .compact')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,221 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Persistent, content-addressed cache for paragraph and summary sentence embeddings.
+Embeddings are stored in fixed size memory-mapped .npy shards, the index maps the hash of a text to its
+shard and row. Each (model name, max sequence length, dtype) combination gets its own directory.
+When the cache grows beyond its size limit, the least recently used shards are evicted.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def model_dir_fingerprint(model_dir):
+    """
+    Hash of a local model directory, part of the model name of the cache, so that two directories with the same
+    name, or weights replaced in place, don't share embeddings
+
+    :param model_dir: local model directory
+    """
+    fingerprint = hashlib.sha1(os.path.realpath(model_dir).encode("utf-8"))
+    for dir_path, dir_names, file_names in os.walk(model_dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            # exported by the onnx backend from the weights on first use
+            if file_name == "model.onnx":
+                continue
+
+            path = os.path.join(dir_path, file_name)
+            stat = os.stat(path)
+            fingerprint.update(("%s:%d:%d" % (os.path.relpath(path, model_dir), stat.st_size, stat.st_mtime_ns)).encode("utf-8"))
+
+            # config files are small, their content is hashed
+            if file_name.endswith(".json"):
+                with open(path, "rb") as fd:
+                    fingerprint.update(fd.read())
+
+    return fingerprint.hexdigest()[:16]
+
+
+class EmbeddingCache:
+
+    def __init__(self, cache_dir, model_name, max_seq_length, dtype="float32", shard_rows=65536, max_size_bytes=None):
+        """
+        :param cache_dir: root directory of the cache
+        :param model_name: name of the encoder model, part of the cache key
+        :param max_seq_length: max sequence length of the encoder, part of the cache key
+        :param dtype: float16 or float32, dtype of the stored embeddings
+        :param shard_rows: number of embeddings stored in a single shard
+        :param max_size_bytes: size limit of the cache, least recently used shards are evicted beyond it
+        """
+        self.dtype = np.dtype(dtype)
+        self.shard_rows = shard_rows
+        self.max_size_bytes = max_size_bytes
+
+        namespace = hashlib.sha1(("%s:%s:%s" % (model_name, max_seq_length, self.dtype.name)).encode("utf-8")).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir, namespace)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.index_path = os.path.join(self.cache_dir, "index.npz")
+
+        # text hash -> (shard id, row)
+        self.index = {}
+        # shard id -> number of rows used
+        self.shard_sizes = {}
+        # shard id -> last access tick, used for eviction
+        self.shard_access = {}
+        self.dim = None
+        self.tick = 0
+        self.memmaps = {}
+
+        self.hits = 0
+        self.misses = 0
+
+        self.load_index()
+
+    def shard_path(self, shard_id):
+        return os.path.join(self.cache_dir, "shard_%05d.npy" % shard_id)
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+
+        with np.load(self.index_path) as index:
+            self.dim = int(index["dim"])
+            self.tick = int(index["tick"])
+
+            for key, shard_id, row in zip(index["hashes"], index["shard_ids"], index["rows"]):
+                self.index[bytes(key)] = (int(shard_id), int(row))
+
+            for shard_id, size, access in zip(index["shards"], index["shard_sizes"], index["shard_access"]):
+                self.shard_sizes[int(shard_id)] = int(size)
+                self.shard_access[int(shard_id)] = int(access)
+
+    def save_index(self):
+        # rows must be on disk before the index that points at them
+        for memmap in self.memmaps.values():
+            memmap.flush()
+
+        shards = sorted(self.shard_sizes)
+        hashes = list(self.index)
+
+        # write to a temporary file first, so that an interrupted run doesn't corrupt the index
+        temp_path = self.index_path + ".tmp.npz"
+        np.savez(temp_path,
+                 dim=np.int64(self.dim or 0),
+                 tick=np.int64(self.tick),
+                 hashes=np.array(hashes, dtype="S20"),
+                 shard_ids=np.array([self.index[key][0] for key in hashes], dtype=np.int64),
+                 rows=np.array([self.index[key][1] for key in hashes], dtype=np.int64),
+                 shards=np.array(shards, dtype=np.int64),
+                 shard_sizes=np.array([self.shard_sizes[shard_id] for shard_id in shards], dtype=np.int64),
+                 shard_access=np.array([self.shard_access[shard_id] for shard_id in shards], dtype=np.int64))
+        os.replace(temp_path, self.index_path)
+
+    def shard(self, shard_id):
+        if shard_id not in self.memmaps:
+            path = self.shard_path(shard_id)
+            if os.path.exists(path):
+                self.memmaps[shard_id] = np.load(path, mmap_mode="r+")
+            else:
+                self.memmaps[shard_id] = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(self.shard_rows, self.dim))
+
+        return self.memmaps[shard_id]
+
+    def size_bytes(self):
+        if self.dim is None:
+            return 0
+        return len(self.shard_sizes) * self.shard_rows * self.dim * self.dtype.itemsize
+
+    def evict(self, keep_shard_id):
+        # drop least recently used shards until the new shard fits under the size limit
+        shard_bytes = self.shard_rows * self.dim * self.dtype.itemsize
+
+        while self.max_size_bytes and self.size_bytes() + shard_bytes > self.max_size_bytes:
+            candidates = [shard_id for shard_id in self.shard_sizes if shard_id != keep_shard_id]
+            if not candidates:
+                break
+
+            shard_id = min(candidates, key=lambda shard_id: self.shard_access[shard_id])
+            self.drop_shard(shard_id)
+
+            # the saved index must not point at the shard once its file is gone, even if the run is killed
+            self.save_index()
+            os.remove(self.shard_path(shard_id))
+
+    def drop_shard(self, shard_id):
+        self.index = {key: location for key, location in self.index.items() if location[0] != shard_id}
+        self.shard_sizes.pop(shard_id, None)
+        self.shard_access.pop(shard_id, None)
+        self.memmaps.pop(shard_id, None)
+
+    def get(self, texts):
+        """
+        Look up cached embeddings, returns a list with an embedding or None for each text
+
+        :param texts: list of texts
+        """
+        self.tick += 1
+        embeddings = []
+
+        for text in texts:
+            location = self.index.get(text_hash(text))
+
+            # shard files deleted outside of this cache are misses, not zero embeddings
+            if location is not None and location[0] not in self.memmaps and not os.path.exists(self.shard_path(location[0])):
+                self.drop_shard(location[0])
+                location = None
+
+            if location is None:
+                self.misses += 1
+                embeddings.append(None)
+            else:
+                self.hits += 1
+                shard_id, row = location
+                self.shard_access[shard_id] = self.tick
+                embeddings.append(np.asarray(self.shard(shard_id)[row], dtype=np.float32))
+
+        return embeddings
+
+    def put(self, texts, embeddings):
+        """
+        Store embeddings of the given texts
+
+        :param texts: list of texts
+        :param embeddings: float array with one row per text
+        """
+        embeddings = np.asarray(embeddings)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+
+        self.tick += 1
+        for text, embedding in zip(texts, embeddings):
+            key = text_hash(text)
+            if key in self.index:
+                continue
+
+            shard_id = max(self.shard_sizes) if self.shard_sizes else 0
+            if self.shard_sizes.get(shard_id, 0) >= self.shard_rows:
+                shard_id += 1
+
+            if shard_id not in self.shard_sizes:
+                self.evict(shard_id)
+                self.shard_sizes[shard_id] = 0
+
+            row = self.shard_sizes[shard_id]
+            self.shard(shard_id)[row] = embedding
+            self.shard_sizes[shard_id] = row + 1
+            self.shard_access[shard_id] = self.tick
+            self.index[key] = (shard_id, row)
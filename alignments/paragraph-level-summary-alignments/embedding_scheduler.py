@@ -0,0 +1,113 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Encoding scheduler for the bi-encoder aligner.
+Paragraphs and summary sentences from a window of examples are collected together, de-duplicated and sorted by
+their token length into buckets. Each bucket is encoded in large batches, which keeps padding low even when
+individual chapters are short, and every example gets back the rows of the embeddings that belong to it.
+When an embedding cache is given, only the texts missing from the cache are encoded.
+"""
+
+
+class EncodingScheduler:
+
+    def __init__(self, model, batch_size=64, bucket_width=32, cache=None):
+        """
+        :param model: SentenceTransformer model used for encoding
+        :param batch_size: number of texts encoded in a single forward pass
+        :param bucket_width: range of token lengths grouped into the same bucket
+        :param cache: optional EmbeddingCache
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.bucket_width = bucket_width
+        self.cache = cache
+
+    def token_lengths(self, texts):
+        tokenizer = getattr(self.model, "tokenizer", None)
+
+        if tokenizer is None:
+            return [len(text.split()) for text in texts]
+
+        max_length = getattr(self.model, "max_seq_length", None)
+        input_ids = tokenizer(texts, truncation=max_length is not None, max_length=max_length)["input_ids"]
+
+        return [len(ids) for ids in input_ids]
+
+    def buckets(self, texts):
+        """
+        Split text indices into buckets of similar token length, longest texts first
+
+        :param texts: list of unique texts
+        """
+        if not texts:
+            return []
+
+        lengths = self.token_lengths(texts)
+        order = sorted(range(len(texts)), key=lambda ix: -lengths[ix])
+
+        buckets = []
+        for ix in order:
+            bucket_id = lengths[ix] // self.bucket_width
+            if buckets and buckets[-1][0] == bucket_id:
+                buckets[-1][1].append(ix)
+            else:
+                buckets.append((bucket_id, [ix]))
+
+        return [indices for _, indices in buckets]
+
+    def encode_unique(self, texts):
+        """
+        Encode a list of unique texts bucket by bucket, returns a tensor with one row per text
+
+        :param texts: list of unique texts
+        """
+        import torch
+
+        embeddings = [None] * len(texts)
+        device = None
+
+        if self.cache is not None:
+            embeddings = [None if embedding is None else torch.from_numpy(embedding) for embedding in self.cache.get(texts)]
+
+        missing = [ix for ix, embedding in enumerate(embeddings) if embedding is None]
+        missing_texts = [texts[ix] for ix in missing]
+
+        for bucket in self.buckets(missing_texts):
+            indices = [missing[ix] for ix in bucket]
+            bucket_embeddings = self.model.encode([texts[ix] for ix in indices], batch_size=self.batch_size, convert_to_tensor=True)
+            device = bucket_embeddings.device
+
+            for ix, embedding in zip(indices, bucket_embeddings):
+                embeddings[ix] = embedding
+
+            if self.cache is not None:
+                self.cache.put([texts[ix] for ix in indices], bucket_embeddings.cpu().numpy())
+
+        if device is not None:
+            embeddings = [embedding.to(device) for embedding in embeddings]
+
+        return torch.stack(embeddings)
+
+    def encode(self, text_lists):
+        """
+        Encode several lists of texts together, returns one embedding tensor per input list
+
+        :param text_lists: lists of texts, eg. the paragraphs and summary sentences of a window of examples
+        """
+        text_ids = {}
+        for texts in text_lists:
+            for text in texts:
+                text_ids.setdefault(text, len(text_ids))
+
+        if not text_ids:
+            return [None for _ in text_lists]
+
+        embeddings = self.encode_unique(list(text_ids))
+
+        return [embeddings[[text_ids[text] for text in texts]] for texts in text_lists]
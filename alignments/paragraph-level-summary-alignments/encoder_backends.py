@@ -0,0 +1,162 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Encoder backends for the paraphrase bi-encoder, all loaded from a sentence-transformers model directory (or model name).
+    pytorch   - stock SentenceTransformer in fp32
+    quantized - SentenceTransformer with its linear layers dynamically quantized to int8, for CPU inference
+    onnx      - the transformer exported to ONNX and run with ONNX Runtime, pooling is done in NumPy
+Every backend exposes `encode(texts, batch_size, convert_to_tensor)`, `tokenizer`, `max_seq_length` and `device`
+in the same way as SentenceTransformer, so they can be used interchangeably by the aligner.
+"""
+
+import json
+import os
+
+import numpy as np
+
+ENCODER_BACKENDS = ["pytorch", "quantized", "onnx"]
+
+
+def load_encoder(backend, model_path, max_seq_length=512, num_threads=None):
+    """
+    :param backend: one of ENCODER_BACKENDS
+    :param model_path: local sentence-transformers model directory or model name
+    :param max_seq_length: max number of tokens per text
+    :param num_threads: number of intra-op threads for the CPU backends
+    """
+    if backend == "onnx":
+        return OnnxEncoder(model_path, max_seq_length, num_threads)
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    if backend == "quantized":
+        model = SentenceTransformer(model_path, device="cpu")
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == "pytorch":
+        model = SentenceTransformer(model_path)
+    else:
+        raise RuntimeError("Unknown encoder backend: %s" % backend)
+
+    model.max_seq_length = max_seq_length
+    return model
+
+
+def sentence_transformer_modules(model_path):
+    """
+    Paths of the transformer and pooling modules of a saved sentence-transformers model
+
+    :param model_path: local sentence-transformers model directory
+    """
+    with open(os.path.join(model_path, "modules.json")) as fd:
+        modules = json.load(fd)
+
+    transformer_path, pooling_path = model_path, None
+    for module in modules:
+        if module["type"].endswith("Transformer"):
+            transformer_path = os.path.join(model_path, module["path"])
+        elif module["type"].endswith("Pooling"):
+            pooling_path = os.path.join(model_path, module["path"])
+
+    return transformer_path, pooling_path
+
+
+def export_onnx(model_path, onnx_path):
+    """
+    Export the transformer of a sentence-transformers model to ONNX
+
+    :param model_path: local sentence-transformers model directory
+    :param onnx_path: path of the exported model
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    transformer_path, _ = sentence_transformer_modules(model_path)
+    tokenizer = AutoTokenizer.from_pretrained(transformer_path)
+    model = AutoModel.from_pretrained(transformer_path)
+    model.eval()
+
+    inputs = tokenizer(["A sentence used for tracing the model."], return_tensors="pt")
+    dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}, "last_hidden_state": {0: "batch", 1: "sequence"}}
+
+    with torch.no_grad():
+        torch.onnx.export(model, (inputs["input_ids"], inputs["attention_mask"]), onnx_path,
+                          input_names=["input_ids", "attention_mask"], output_names=["last_hidden_state"],
+                          dynamic_axes=dynamic_axes, opset_version=12)
+
+
+class OnnxEncoder:
+
+    def __init__(self, model_path, max_seq_length=512, num_threads=None):
+        """
+        :param model_path: local sentence-transformers model directory, the ONNX model is exported to it on first use
+        :param max_seq_length: max number of tokens per text
+        :param num_threads: number of intra-op threads of the ONNX Runtime session
+        """
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        if not os.path.isdir(model_path):
+            raise RuntimeError("The onnx backend requires a local model directory, got: %s" % model_path)
+
+        transformer_path, pooling_path = sentence_transformer_modules(model_path)
+
+        self.pooling_mode = "mean"
+        if pooling_path:
+            with open(os.path.join(pooling_path, "config.json")) as fd:
+                pooling_config = json.load(fd)
+            if pooling_config.get("pooling_mode_cls_token"):
+                self.pooling_mode = "cls"
+            elif not pooling_config.get("pooling_mode_mean_tokens"):
+                raise RuntimeError("Unsupported pooling configuration: %s" % pooling_config)
+
+        onnx_path = os.path.join(model_path, "model.onnx")
+        if not os.path.exists(onnx_path):
+            export_onnx(model_path, onnx_path)
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(transformer_path)
+        self.max_seq_length = max_seq_length
+        self.device = "cpu"
+
+    def encode(self, texts, batch_size=32, convert_to_tensor=False, **kwargs):
+        # longest texts first, same as SentenceTransformer.encode
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        embeddings = [None] * len(texts)
+
+        for start in range(0, len(texts), batch_size):
+            batch_ids = order[start:start + batch_size]
+            inputs = self.tokenizer([texts[ix] for ix in batch_ids], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors="np")
+            attention_mask = inputs["attention_mask"].astype(np.int64)
+
+            token_embeddings = self.session.run(None, {"input_ids": inputs["input_ids"].astype(np.int64), "attention_mask": attention_mask})[0]
+
+            if self.pooling_mode == "cls":
+                batch_embeddings = token_embeddings[:, 0]
+            else:
+                mask = attention_mask[:, :, None].astype(token_embeddings.dtype)
+                batch_embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+            for ix, embedding in zip(batch_ids, batch_embeddings):
+                embeddings[ix] = embedding
+
+        embeddings = np.stack(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+
+        if convert_to_tensor:
+            import torch
+            return torch.from_numpy(embeddings)
+
+        return embeddings
@@ -0,0 +1,187 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Rendering of the similarity and alignment matrices of aligned examples (`--save_figs`).
+Figures are drawn with the headless Agg backend on `matplotlib.figure.Figure` objects, without pyplot global state,
+so nothing is kept alive between calls. `FigureRenderer` puts the figures in its own bounded queue, whatever the size
+of the pipeline queues, and a feeder thread sends them to a pool of processes which render and encode the PNG files.
+Submitting never waits for the renderer: when `queue_size` figures are waiting, the downsampled matrices of the next
+ones are spilled to a temporary directory and rendered later, or with `skip_when_busy` the figures are skipped and
+counted. Matrices larger than `max_size` on an axis are max-pooled down before rendering, so alignments stay visible.
+"""
+
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from collections import deque
+
+import numpy as np
+
+
+def alignment_matrix(alignments, shape):
+    matrix = np.zeros(shape, dtype=np.float32)
+    for s_ix, t_ix in enumerate(alignments):
+        if t_ix >= 0:
+            matrix[s_ix, t_ix] = 1
+    return matrix
+
+
+def downsample(matrix, max_size):
+    # max pooling with the smallest factors that bring both axes under max_size
+    rows, cols = matrix.shape
+    row_factor, col_factor = -(-rows // max_size), -(-cols // max_size)
+    if row_factor == 1 and col_factor == 1:
+        return matrix
+
+    padded = np.full((-(-rows // row_factor) * row_factor, -(-cols // col_factor) * col_factor), matrix.min(), dtype=matrix.dtype)
+    padded[:rows, :cols] = matrix
+    return padded.reshape(padded.shape[0] // row_factor, row_factor, padded.shape[1] // col_factor, col_factor).max(axis=(1, 3))
+
+
+def render_alignments(similarity_matrix, alignment_matrix, title, output_path=None):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(20, 10))
+    FigureCanvasAgg(fig)
+    ax1, ax2 = fig.subplots(2, sharey=True)
+    fig.suptitle(title)
+    ax1.imshow(similarity_matrix, cmap='gray', interpolation='nearest')
+    ax1.set_title("Similarity matrix")
+    ax2.imshow(alignment_matrix, cmap='gray', interpolation='nearest')
+    ax2.set_title("Alignment matrix")
+
+    if output_path:
+        fig.savefig(output_path, dpi=100)
+
+
+def use_agg_backend():
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+class FigureRenderer:
+
+    def __init__(self, output_dir, processes=2, max_size=1000, queue_size=None, skip_when_busy=False):
+        """
+        :param output_dir: directory of the PNG files
+        :param processes: number of rendering processes
+        :param max_size: max number of rows and columns of the rendered matrices
+        :param queue_size: max number of figures waiting in memory, defaults to 8 per process
+        :param skip_when_busy: skip the figures submitted while the queue is full, instead of spilling them to disk
+        """
+        self.output_dir = output_dir
+        self.processes = processes
+        self.max_size = max_size
+        self.skip_when_busy = skip_when_busy
+        self.pool = multiprocessing.get_context("spawn").Pool(processes, initializer=use_agg_backend)
+        self.queue = queue.Queue(queue_size or 8 * processes)
+        self.spill_dir = None
+        self.spilled = deque()
+        self.spilled_cnt = 0
+        self.pending = []
+        self.error = None
+        self.rendered = 0
+        self.skipped = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, similarity_matrix, alignments, title):
+        # called by the align stage, returns right away
+        # only dense similarity matrices are rendered
+        if not isinstance(similarity_matrix, np.ndarray):
+            return
+
+        try:
+            self.queue.put_nowait((similarity_matrix, list(alignments), title))
+        except queue.Full:
+            if self.skip_when_busy:
+                self.skipped += 1
+                return
+
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix="figures-", dir=self.output_dir)
+            spill_path = os.path.join(self.spill_dir, "%d.npz" % self.spilled_cnt)
+            self.spilled_cnt += 1
+            similarity, alignment = self.downsampled(similarity_matrix, alignments)
+            np.savez(spill_path, similarity=similarity, alignment=alignment)
+            self.spilled.append((spill_path, title))
+
+    def downsampled(self, similarity_matrix, alignments):
+        return downsample(similarity_matrix, self.max_size), downsample(alignment_matrix(alignments, similarity_matrix.shape), self.max_size)
+
+    def collect(self, max_pending):
+        # waits until at most `max_pending` figures are rendering, rendering errors are raised here
+        while len(self.pending) > max_pending:
+            self.pending[0].wait()
+
+            still_pending = []
+            for result in self.pending:
+                if result.ready():
+                    result.get()
+                    self.rendered += 1
+                else:
+                    still_pending.append(result)
+            self.pending = still_pending
+
+    def render(self, similarity, alignment, title):
+        # keeps two figures per process in the pool, the next ones wait in the queue
+        self.collect(2 * self.processes - 1)
+        self.pending.append(self.pool.apply_async(render_alignments, (similarity, alignment, title, os.path.join(self.output_dir, title + ".png"))))
+
+    def render_spilled(self):
+        spill_path, title = self.spilled.popleft()
+        with np.load(spill_path) as matrices:
+            self.render(matrices["similarity"], matrices["alignment"], title)
+        os.remove(spill_path)
+
+    def run(self):
+        # feeder thread, figures of the queue first, the spilled ones when the queue is empty
+        try:
+            while True:
+                try:
+                    figure = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    if self.spilled:
+                        self.render_spilled()
+                    continue
+
+                if figure is None:
+                    break
+
+                similarity_matrix, alignments, title = figure
+                self.render(*self.downsampled(similarity_matrix, alignments), title)
+
+            while self.spilled:
+                self.render_spilled()
+            self.collect(0)
+        except Exception as error:
+            self.error = error
+
+    def close(self):
+        # the feeder thread stops on its first error, the queue may stay full
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.thread.join()
+        self.pool.close()
+        self.pool.join()
+
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        if self.error is not None:
+            raise self.error
+
+        print ("Rendered %d figures" % self.rendered + (", skipped %d while the renderer was busy" % self.skipped if self.skip_when_busy else ""))
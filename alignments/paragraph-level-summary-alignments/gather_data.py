@@ -14,11 +14,15 @@ import argparse
 import json
 import os
 import re
-import spacy
+import sys
 from os.path import basename
 
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../scripts"))
+import spacy_registry
+from sharding import in_node_shard, node_output_base, parse_shard
+
 def fix_leftover_headers(summary_content):
     """
     Function removes leftover prefixes from the summary text, such as: Chapter 1, Chapter V, Analysis, etc.
@@ -168,6 +172,31 @@ def fix_short_sentences(summary_content):
     return fixed_content
 
 
+def split_summary_sentences(spacy_nlp, summary_content, example=None):
+    """
+    Splits the summary text into sentences and fixes the splitting errors
+
+    :param spacy_nlp: spaCy pipeline used for sentence splitting
+    :param summary_content: summary text
+    :param example: example the summary belongs to, printed when the short sentences can't be fixed
+    """
+    summary_content = [sent.text.strip() for sent in spacy_nlp(summary_content).sents]
+    summary_content = [sent for sent in summary_content if sent]
+
+    summary_content = fix_leftover_headers(summary_content)
+    summary_content = fix_prefix_punctuation(summary_content)
+    summary_content = fix_prefix_quotations(summary_content)
+    summary_content = fix_unclosed_quotations(summary_content)
+    summary_content = fix_noncapitalized_prefix(summary_content)
+
+    try:
+        summary_content = fix_short_sentences(summary_content)
+    except:
+        print ("Example: ", example)
+
+    return summary_content
+
+
 def main(args):
 
     CHAPTER_SUMMARY_MATCHED_FILE = args.matched_file
@@ -176,16 +205,22 @@ def main(args):
     with open(CHAPTER_SUMMARY_MATCHED_FILE) as fd:
         raw_data = [json.loads(line) for line in fd]
 
-    spacy_nlp = spacy.load('en_core_web_lg', disable=["tagger", "ner", "textcat","lemmatizer"])
+    spacy_nlp = spacy_registry.get_pipeline('en_core_web_lg', disable=["tagger", "ner", "textcat","lemmatizer"])
 
     CHAPTERIZED_BOOKS_DIR = "../../"
     FINISHED_SUMMARIES_DIR = "../../scripts/"
 
     empty_summaries = []
 
-    # gather data
+    # gather data, with `shard` set only the books of this node, the input line of each example is kept for the merge
     processed_data = []
-    for example in tqdm(raw_data):
+    index_entries = []
+    for line_ix, example in enumerate(tqdm(raw_data)):
+        if not in_node_shard(example, args.shard):
+            continue
+
+        index_entries.append({"line": line_ix, "gathered": 0})
+
         with open(os.path.join(CHAPTERIZED_BOOKS_DIR, example["chapter_path"])) as fd:
             if args.join_strings:
                 chapter_content = " ".join([line.strip() for line in fd.readlines()])
@@ -212,19 +247,7 @@ def main(args):
                     empty_summaries.append(summary_path)
                     continue
 
-                summary_content = [sent.text.strip() for sent in spacy_nlp(summary_content).sents]
-                summary_content = [sent for sent in summary_content if sent]
-
-                summary_content = fix_leftover_headers(summary_content)
-                summary_content = fix_prefix_punctuation(summary_content)
-                summary_content = fix_prefix_quotations(summary_content)
-                summary_content = fix_unclosed_quotations(summary_content)
-                summary_content = fix_noncapitalized_prefix(summary_content)
-                    
-                try:
-                    summary_content = fix_short_sentences(summary_content)
-                except:
-                    print ("Example: ", example)
+                summary_content = split_summary_sentences(spacy_nlp, summary_content, example)
             else:
                 raise RuntimeError("Unknown processing option")
 
@@ -232,20 +255,29 @@ def main(args):
         example["summary"] = summary_content
 
         processed_data.append(example)
+        index_entries[-1]["gathered"] = 1
 
     # Some summaries could be empty after the cleanup process
     print ("Empty summaries found: ", empty_summaries, len(empty_summaries))
 
    # save gathered data
-    with open(basename(CHAPTER_SUMMARY_MATCHED_FILE) + ".gathered", "w") as fd:
+    output_base = node_output_base(basename(CHAPTER_SUMMARY_MATCHED_FILE), args.shard)
+    with open(output_base + ".gathered", "w") as fd:
         for example in processed_data:
             fd.write(json.dumps(example) + "\n")
 
+    # skipped examples are listed too, so the merge can check that every input line was processed
+    if args.shard is not None:
+        with open(output_base + ".index", "w") as fd:
+            for entry in index_entries:
+                fd.write(json.dumps(entry) + "\n")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--join_strings', action='store_true')
     parser.add_argument('--split_paragraphs', action='store_true')
     parser.add_argument('--matched_file', type=str, required=True)
+    parser.add_argument('--shard', type=parse_shard, default=None, help='i/N, only gather the books whose bid hashes to shard i of N, merge the parts with sharding.py')
     args = parser.parse_args()
 
     if args.join_strings and args.split_paragraphs or (not args.join_strings and not args.split_paragraphs):
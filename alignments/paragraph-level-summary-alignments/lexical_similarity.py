@@ -0,0 +1,110 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Model-free lexical similarities between summary sentences and paragraphs, a CPU alternative to the bi-encoder.
+The vocabulary and document frequencies are fitted once on the paragraphs of a data split, texts are then
+vectorized into sparse matrices and scored with a sparse product into the usual #summaries X #paragraphs matrix.
+    - tfidf: cosine similarity of sublinear TF-IDF vectors, in [0, 1]
+    - bm25: Okapi BM25 score of each paragraph for the terms of each sentence, the average paragraph length
+      is the one of the chapter being aligned
+Terms that don't appear in the fitted paragraphs are ignored.
+"""
+
+import re
+from collections import Counter
+
+import numpy as np
+
+LEXICAL_SCHEMES = ["tfidf", "bm25"]
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class LexicalVectorizer:
+
+    def __init__(self, scheme="tfidf", k1=1.2, b=0.75):
+        """
+        :param scheme: `tfidf` or `bm25`
+        :param k1: BM25 term frequency saturation
+        :param b: BM25 length normalization
+        """
+        if scheme not in LEXICAL_SCHEMES:
+            raise ValueError("Unknown lexical similarity scheme: %s" % scheme)
+
+        self.scheme = scheme
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        self.idf = np.zeros(0, dtype=np.float32)
+
+    def fit(self, documents):
+        # document frequencies of the terms of an iterable of paragraphs
+        doc_freqs = Counter()
+        doc_cnt = 0
+        for document in documents:
+            doc_freqs.update(set(tokenize(document)))
+            doc_cnt += 1
+
+        self.vocabulary = {term: ix for ix, term in enumerate(sorted(doc_freqs))}
+        doc_freqs = np.array([doc_freqs[term] for term in sorted(doc_freqs)], dtype=np.float64)
+
+        if self.scheme == "tfidf":
+            self.idf = np.log((1 + doc_cnt) / (1 + doc_freqs)) + 1
+        else:
+            self.idf = np.log(1 + (doc_cnt - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        self.idf = self.idf.astype(np.float32)
+
+        return self
+
+    def term_counts(self, texts):
+        from scipy import sparse
+
+        rows, cols, counts = [], [], []
+        for row, text in enumerate(texts):
+            term_ids = Counter(self.vocabulary[term] for term in tokenize(text) if term in self.vocabulary)
+            rows.extend([row] * len(term_ids))
+            cols.extend(term_ids.keys())
+            counts.extend(term_ids.values())
+
+        return sparse.csr_matrix((np.array(counts, dtype=np.float32), (rows, cols)), shape=(len(texts), len(self.vocabulary)))
+
+    def tfidf_vectors(self, texts):
+        vectors = self.term_counts(texts)
+        vectors.data = (1 + np.log(vectors.data)) * self.idf[vectors.indices]
+
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+        return vectors.multiply(1 / np.clip(norms, 1e-8, None)[:, None]).tocsr()
+
+    def transform_paragraphs(self, paragraphs):
+        if self.scheme == "tfidf":
+            return self.tfidf_vectors(paragraphs)
+
+        vectors = self.term_counts(paragraphs)
+        lengths = np.asarray(vectors.sum(axis=1)).ravel()
+        length_norms = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1e-8))
+
+        # term frequency saturation with the length norm of the row of each entry
+        row_norms = np.repeat(length_norms, np.diff(vectors.indptr))
+        vectors.data = self.idf[vectors.indices] * vectors.data * (self.k1 + 1) / (vectors.data + row_norms)
+        return vectors
+
+    def transform_summaries(self, summaries):
+        if self.scheme == "tfidf":
+            return self.tfidf_vectors(summaries)
+
+        # BM25 queries only count the distinct terms of the sentence
+        vectors = self.term_counts(summaries)
+        vectors.data = np.ones_like(vectors.data)
+        return vectors
+
+    def similarities(self, paragraphs_vectors, summaries_vectors):
+        return np.asarray((summaries_vectors @ paragraphs_vectors.T).todense(), dtype=np.float32)
@@ -0,0 +1,102 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Monotonic (narrative order preserving) alignment of summary sentences to paragraphs.
+Summary sentences mostly follow the order of the chapter, the dynamic program finds the assignment of sentences to
+paragraphs that maximizes the total similarity, where
+    - consecutive sentences may stay on the same paragraph or move forward, every skipped paragraph costs `skip_penalty`
+    - moving back to an earlier paragraph costs `backtrack_penalty`, with an infinite penalty the order is strict
+Each row of the dynamic program is computed with prefix/suffix maxima in O(#paragraphs), O(#summaries * #paragraphs)
+in total. With `band_width`, sentence i can only align with paragraphs within `band_width` of the diagonal
+position i * #paragraphs / #summaries, which reduces the cost to O(#summaries * band_width).
+"""
+
+import numpy as np
+
+
+def band_limits(summ_cnt, text_cnt, band_width=None):
+    if not band_width:
+        return np.zeros(summ_cnt, dtype=np.int64), np.full(summ_cnt, text_cnt, dtype=np.int64)
+
+    centers = (np.arange(summ_cnt) * text_cnt) // max(summ_cnt, 1)
+    lows = np.clip(centers - band_width, 0, text_cnt - 1)
+    highs = np.clip(centers + band_width + 1, 1, text_cnt)
+    return lows, highs
+
+
+def running_argmax(values):
+    # index of the maximum of values[:i + 1] for each i, the latest index wins ties
+    indices = np.arange(len(values))
+    is_max = values >= np.maximum.accumulate(values)
+    return np.maximum.accumulate(np.where(is_max, indices, 0))
+
+
+def align_data_monotonic(similarity_matrix, skip_penalty=0.0, backtrack_penalty=float("inf"), band_width=None):
+    """
+    Returns the index of the aligned paragraph for each summary sentence
+
+    :param similarity_matrix: #summaries X #paragraphs similarity matrix
+    :param skip_penalty: cost of every paragraph skipped between consecutive sentences
+    :param backtrack_penalty: cost of aligning a sentence with an earlier paragraph than the previous sentence
+    :param band_width: max distance from the diagonal, None for the full matrix
+    """
+    similarity_matrix = np.asarray(similarity_matrix, dtype=np.float64)
+    summ_cnt, text_cnt = similarity_matrix.shape
+    if summ_cnt == 0:
+        return []
+
+    lows, highs = band_limits(summ_cnt, text_cnt, band_width)
+
+    # best scores of the previous row within its band, and back pointers of every row
+    scores = similarity_matrix[0, lows[0]:highs[0]]
+    back_pointers = [None]
+
+    for s_ix in range(1, summ_cnt):
+        prev_low, prev_high = lows[s_ix - 1], highs[s_ix - 1]
+        low, high = lows[s_ix], highs[s_ix]
+        positions = np.arange(low, high)
+
+        candidates = np.full((3, high - low), -np.inf)
+        pointers = np.zeros((3, high - low), dtype=np.int64)
+
+        # stay on the same paragraph
+        stay = (positions >= prev_low) & (positions < prev_high)
+        candidates[0, stay] = scores[positions[stay] - prev_low]
+        pointers[0, stay] = positions[stay]
+
+        # move forward from an earlier paragraph q, skipping p - q - 1 paragraphs
+        prev_positions = np.arange(prev_low, prev_high)
+        forward_scores = scores + skip_penalty * prev_positions
+        forward_argmax = running_argmax(forward_scores)
+        last = np.minimum(positions - 1, prev_high - 1) - prev_low
+        forward = last >= 0
+        best = forward_argmax[last[forward]]
+        candidates[1, forward] = forward_scores[best] - skip_penalty * (positions[forward] - 1)
+        pointers[1, forward] = prev_positions[best]
+
+        # move back from a later paragraph
+        if np.isfinite(backtrack_penalty):
+            backward_argmax = running_argmax(scores[::-1])[::-1]
+            backward_argmax = len(scores) - 1 - backward_argmax
+            first = np.maximum(positions + 1, prev_low) - prev_low
+            backward = first < len(scores)
+            best = backward_argmax[first[backward]]
+            candidates[2, backward] = scores[best] - backtrack_penalty
+            pointers[2, backward] = prev_positions[best]
+
+        choice = np.argmax(candidates, axis=0)
+        scores = candidates[choice, np.arange(high - low)] + similarity_matrix[s_ix, low:high]
+        back_pointers.append(pointers[choice, np.arange(high - low)])
+
+    # trace back the best path
+    alignments = [0] * summ_cnt
+    alignments[-1] = int(lows[-1] + np.argmax(scores))
+    for s_ix in range(summ_cnt - 1, 0, -1):
+        alignments[s_ix - 1] = int(back_pointers[s_ix][alignments[s_ix] - lows[s_ix]])
+
+    return alignments
@@ -0,0 +1,53 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Capacity constrained assignment of summary sentences to paragraphs that maximizes the total similarity.
+Each paragraph is replicated `text_capacity` times and the #summaries X (#paragraphs * capacity) assignment problem
+is solved exactly with `scipy.optimize.linear_sum_assignment`. Sentences can't use more than #summaries copies of a
+paragraph, so the capacity is capped by the number of sentences.
+Matrices with more cells than `max_cells` after replication fall back to the stable matching.
+"""
+
+import numpy as np
+
+from stable_matching import hospital_optimal_matching
+
+DEFAULT_MAX_CELLS = 20000000
+
+
+def optimal_assignment_cells(summ_cnt, text_cnt, text_capacity):
+    # size of the assignment problem after replicating the paragraphs
+    return summ_cnt * text_cnt * min(text_capacity, summ_cnt)
+
+
+def align_data_optimal(similarity_matrix, text_capacity, max_cells=DEFAULT_MAX_CELLS):
+    """
+    Returns the index of the aligned paragraph for each summary sentence, -1 for unmatched sentences
+
+    :param similarity_matrix: #summaries X #paragraphs similarity matrix
+    :param text_capacity: max number of summary sentences aligned with a single paragraph
+    :param max_cells: size limit of the replicated problem, larger matrices fall back to stable matching
+    """
+    similarity_matrix = np.asarray(similarity_matrix)
+    summ_cnt, text_cnt = similarity_matrix.shape
+    if summ_cnt == 0 or text_cnt == 0:
+        return [-1] * summ_cnt
+
+    if max_cells and optimal_assignment_cells(summ_cnt, text_cnt, text_capacity) > max_cells:
+        return hospital_optimal_matching(similarity_matrix, text_capacity)
+
+    from scipy.optimize import linear_sum_assignment
+
+    # column j * capacity + c is the c-th copy of paragraph j
+    capacity = min(text_capacity, summ_cnt)
+    replicated = np.repeat(similarity_matrix, capacity, axis=1)
+    summ_ixs, slot_ixs = linear_sum_assignment(replicated, maximize=True)
+
+    alignments = np.full(summ_cnt, -1, dtype=np.int64)
+    alignments[summ_ixs] = slot_ixs // capacity
+    return alignments.tolist()
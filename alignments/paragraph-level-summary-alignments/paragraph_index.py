@@ -0,0 +1,266 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Approximate nearest neighbour index over the merged paragraph embeddings of a book, for retrieval of supporting
+paragraphs of summary sentences across all chapters.
+The index is an inverted file: paragraphs are clustered with spherical k-means into `n_lists` lists, and a query is
+only scored against the paragraphs of its `n_probe` closest lists, so with n_lists ~ sqrt(#paragraphs) a query scores
+a fraction n_probe / n_lists of the book. Embeddings are stored grouped by list, so each probed list is a contiguous
+slice. Indexes are saved to a single .npz file, the paragraphs they index are written next to it as JSON.
+
+Indexes of all books of a gathered data file are built from the chapter files of each book, saved as
+book_<bid>.npz/.json, and their recall measured against exact search with the summary sentences of all the chapters
+and sources of the book, with:
+
+python paragraph_index.py --data_path /path/to/chapter_summary_aligned_test_split.jsonl.gathered --index_dir indexes
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from encoder_backends import ENCODER_BACKENDS
+from sparse_similarity import normalize_embeddings, topk_similarities
+
+
+def kmeans_centroids(embeddings, n_lists, n_iter=10, seed=0):
+    """
+    Spherical k-means, returns n_lists X dim normalized centroids
+
+    :param embeddings: normalized #paragraphs X dim embeddings
+    :param n_lists: number of clusters
+    :param n_iter: number of k-means iterations
+    :param seed: seed of the initial centroids
+    """
+    rng = np.random.RandomState(seed)
+    centroids = embeddings[rng.choice(len(embeddings), n_lists, replace=False)]
+
+    for _ in range(n_iter):
+        assignments = np.argmax(embeddings @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, embeddings)
+
+        # empty clusters keep their previous centroid
+        empty = np.bincount(assignments, minlength=n_lists) == 0
+        sums[empty] = centroids[empty]
+        centroids = normalize_embeddings(sums)
+
+    return centroids
+
+
+def exact_search(embeddings, queries, k):
+    # (indices, scores) of the k most similar paragraphs of each query, by brute force
+    topk_similarity = topk_similarities(embeddings, queries, k)
+    return topk_similarity.indices, topk_similarity.scores
+
+
+def recall_at_k(indices, exact_indices):
+    # fraction of the exact top-k neighbours found by the approximate search
+    found = sum(len(set(row[row >= 0].tolist()) & set(exact_row.tolist())) for row, exact_row in zip(indices, exact_indices))
+    return found / max(exact_indices.size, 1)
+
+
+class ParagraphIndex:
+
+    def __init__(self, centroids, list_offsets, ids, embeddings):
+        """
+        :param centroids: n_lists X dim normalized centroids of the lists
+        :param list_offsets: n_lists + 1 offsets of the lists in `ids` and `embeddings`
+        :param ids: paragraph index of each row of `embeddings`
+        :param embeddings: normalized paragraph embeddings, grouped by list
+        """
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.ids = ids
+        self.embeddings = embeddings
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_iter=10, seed=0):
+        """
+        :param embeddings: #paragraphs X dim paragraph embeddings
+        :param n_lists: number of lists, defaults to sqrt(#paragraphs)
+        :param n_iter: number of k-means iterations
+        :param seed: seed of the k-means initialization
+        """
+        embeddings = normalize_embeddings(embeddings)
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(embeddings)))
+        n_lists = max(1, min(n_lists, len(embeddings)))
+
+        centroids = kmeans_centroids(embeddings, n_lists, n_iter, seed)
+        assignments = np.argmax(embeddings @ centroids.T, axis=1)
+
+        ids = np.argsort(assignments, kind="stable")
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+
+        return cls(centroids, list_offsets, ids, embeddings[ids])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, k, n_probe=8):
+        """
+        Returns #queries X k (indices, scores) of the most similar paragraphs, most similar first, padded with -1
+
+        :param queries: #queries X dim embeddings, eg. of summary sentences
+        :param k: number of paragraphs returned for each query
+        :param n_probe: number of lists scored for each query
+        """
+        queries = normalize_embeddings(queries)
+        n_probe = min(n_probe, len(self.centroids))
+
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+        # lists are scored for all the queries probing them at once, merging the running top-k of those queries
+        for list_ix in np.unique(probes):
+            start, end = self.list_offsets[list_ix], self.list_offsets[list_ix + 1]
+            if start == end:
+                continue
+
+            q_ixs = np.nonzero((probes == list_ix).any(axis=1))[0]
+            block_scores = queries[q_ixs] @ self.embeddings[start:end].T
+            block_indices = np.broadcast_to(self.ids[start:end], block_scores.shape)
+
+            candidate_scores = np.concatenate([scores[q_ixs], block_scores], axis=1)
+            candidate_indices = np.concatenate([indices[q_ixs], block_indices], axis=1)
+
+            keep = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+            scores[q_ixs] = np.take_along_axis(candidate_scores, keep, axis=1)
+            indices[q_ixs] = np.take_along_axis(candidate_indices, keep, axis=1)
+
+        # most similar paragraphs first
+        order = np.argsort(-scores, axis=1, kind="stable")
+        indices, scores = np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+        return indices, scores
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets, ids=self.ids, embeddings=self.embeddings)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["list_offsets"], data["ids"], data["embeddings"])
+
+
+def index_path(index_dir, bid):
+    return os.path.join(index_dir, "book_%s.npz" % bid)
+
+
+def build_book_index(bid, chapters_dir, scheduler, args):
+    """
+    Builds and saves the index of all the chapters of a book, returns (index, paragraph embeddings)
+
+    :param bid: id of the book
+    :param chapters_dir: directory of the chapter files of the book, relative to `args.books_dir`
+    :param scheduler: EncodingScheduler of the bi-encoder
+    """
+    import align_data_bi_encoder_paraphrase as aligner
+    from align_books_hierarchical import iterate_chapter_paragraphs, list_chapter_files
+
+    chapter_paths = list_chapter_files(os.path.join(args.books_dir, chapters_dir))
+    chapters = [list(iterate_chapter_paragraphs(chapter_path)) for chapter_path in chapter_paths]
+
+    merged_chapters = aligner.merge_text_paragraphs_batched(chapters, args.merging_min_sents, args.merging_max_sents,
+                                                            args.segmentation_batch_size, args.segmentation_n_process)
+    paragraphs = [{"chapter_path": os.path.join(chapters_dir, os.path.basename(chapter_path)), "paragraph": paragraph}
+                  for chapter_path, merged in zip(chapter_paths, merged_chapters) for paragraph in merged]
+    if not paragraphs:
+        return None, None
+
+    embeddings = normalize_embeddings(scheduler.encode_unique([record["paragraph"] for record in paragraphs]).cpu().numpy())
+    index = ParagraphIndex.build(embeddings, args.n_lists, args.kmeans_iterations)
+
+    path = index_path(args.index_dir, bid)
+    index.save(path)
+    with open(path[:-len(".npz")] + ".json", "w") as fd:
+        json.dump(paragraphs, fd)
+
+    return index, embeddings
+
+
+def load_book_summaries(data_path):
+    # bid -> (chapters directory, unique summary sentences of all its chapters and sources), whatever the order of the examples
+    import align_data_bi_encoder_paraphrase as aligner
+
+    books = {}
+    for example in aligner.iterate_gathered_examples(data_path):
+        chapters_dir, summaries = books.setdefault(example["bid"], (os.path.dirname(example["chapter_path"]), {}))
+        summaries.update(dict.fromkeys(sent for sent in example["summary"] if sent))
+
+    return {bid: (chapters_dir, list(summaries)) for bid, (chapters_dir, summaries) in books.items()}
+
+
+def main(args):
+    import align_data_bi_encoder_paraphrase as aligner
+    from embedding_scheduler import EncodingScheduler
+
+    os.makedirs(args.index_dir, exist_ok=True)
+    scheduler = EncodingScheduler(aligner.load_bi_encoder(args), args.encoding_batch_size, args.encoding_bucket_width)
+
+    queries_cnt, found, exact_time, search_time = 0, 0.0, 0.0, 0.0
+    print ("%40s %10s %8s %10s %10s %10s" % ("book", "paragraphs", "lists", "exact (s)", "ann (s)", "recall@k"))
+
+    for bid, (chapters_dir, summaries) in load_book_summaries(args.data_path).items():
+        if not os.path.isdir(os.path.join(args.books_dir, chapters_dir)):
+            print ("Skipping missing book: ", chapters_dir)
+            continue
+
+        index, embeddings = build_book_index(bid, chapters_dir, scheduler, args)
+        if index is None or not summaries:
+            continue
+
+        queries = scheduler.encode_unique(summaries).cpu().numpy()
+
+        start = time.time()
+        exact_indices, _ = exact_search(embeddings, queries, args.top_k)
+        book_exact_time = time.time() - start
+
+        start = time.time()
+        indices, _ = index.search(queries, args.top_k, args.n_probe)
+        book_search_time = time.time() - start
+
+        recall = recall_at_k(indices, exact_indices)
+        print ("%40s %10d %8d %10.4f %10.4f %10.4f" % (chapters_dir[-40:], len(index), len(index.centroids), book_exact_time, book_search_time, recall))
+
+        queries_cnt += len(queries)
+        found += recall * len(queries)
+        exact_time += book_exact_time
+        search_time += book_search_time
+
+    if queries_cnt:
+        print ("%d queries, exact search %.2fs, ann search %.2fs, recall@%d %.4f" % (queries_cnt, exact_time, search_time, args.top_k, found / queries_cnt))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, required=True, help='path to gathered data file')
+    parser.add_argument('--books_dir', type=str, default='../../', help='directory the chapter paths are relative to')
+    parser.add_argument('--index_dir', type=str, required=True, help='directory the book indexes are written to')
+    parser.add_argument('--n_lists', type=int, default=None, help='number of lists of each index, defaults to sqrt(#paragraphs of the book)')
+    parser.add_argument('--kmeans_iterations', type=int, default=10, help='number of k-means iterations used to build the lists')
+    parser.add_argument('--n_probe', type=int, default=8, help='number of lists scored for each query')
+    parser.add_argument('--top_k', type=int, default=10, help='number of paragraphs retrieved for each summary sentence')
+    parser.add_argument('--merging_min_sents', type=int, default=4, help='')
+    parser.add_argument('--merging_max_sents', type=int, default=12, help='')
+    parser.add_argument('--segmentation_batch_size', type=int, default=256, help='number of paragraphs per spaCy `nlp.pipe` batch')
+    parser.add_argument('--segmentation_n_process', type=int, default=1, help='number of processes used by spaCy `nlp.pipe`')
+    parser.add_argument('--encoder_backend', type=str, default='pytorch', choices=ENCODER_BACKENDS, help='bi-encoder inference backend')
+    parser.add_argument('--model_dir', type=str, default=None, help='local sentence-transformers model directory')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='number of torch threads')
+    parser.add_argument('--encoding_batch_size', type=int, default=64, help='number of texts per encoder forward pass')
+    parser.add_argument('--encoding_bucket_width', type=int, default=32, help='range of token lengths grouped into the same encoding bucket')
+    args = parser.parse_args()
+
+    main(args)
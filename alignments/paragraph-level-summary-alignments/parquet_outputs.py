@@ -0,0 +1,150 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Columnar Parquet copies of the paragraph alignment outputs (requires `pyarrow`).
+Each aggregated alignment record becomes a row with typed columns:
+    text                string
+    summary             list<string>
+    alignment_scores    list<float32>
+    title               dictionary<string>, title of the record without the paragraph index, eg. `book.source-stable`
+    paragraph           int32, paragraph index of the record, the JSON title is `<title>-<paragraph>`
+    book_id, source     dictionary<string>, parsed from the title, so lowercased with spaces replaced by `_`
+Records are written in row groups of `row_group_size` rows, so memory stays bounded. With `--parquet`, the aligner
+writes the records of a single process run as they are aligned, the outputs of `--workers` and `--resume` runs are
+converted from the JSON (or compact) outputs at the end of the run, existing files are converted with:
+
+python parquet_outputs.py --input chapter_summary_aligned_test_split.jsonl.gathered.stable
+"""
+
+import argparse
+import json
+import os
+import re
+
+from compact_outputs import load_compact_alignments
+
+
+def alignment_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("text", pa.string()),
+        ("summary", pa.list_(pa.string())),
+        ("alignment_scores", pa.list_(pa.float32())),
+        ("title", pa.dictionary(pa.int32(), pa.string())),
+        ("paragraph", pa.int32()),
+        ("book_id", pa.dictionary(pa.int32(), pa.string())),
+        ("source", pa.dictionary(pa.int32(), pa.string())),
+    ])
+
+
+def title_fields(title):
+    # `book_id.source-method-paragraph` -> (book_id.source-method, paragraph, book_id, source)
+    prefix, paragraph = re.match(r"^(.*?)-(-?\d+)$", title).groups()
+    book_id, _, source = prefix.rsplit("-", 1)[0].rpartition(".")
+    return prefix, int(paragraph), book_id, source
+
+
+class AlignmentParquetWriter:
+
+    def __init__(self, path, row_group_size=10000):
+        """
+        :param path: path of the Parquet file, written to `path`.tmp until closed
+        :param row_group_size: number of rows buffered before a row group is written
+        """
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.row_group_size = row_group_size
+        self.schema = alignment_schema()
+        self.writer = pq.ParquetWriter(path + ".tmp", self.schema)
+        self.columns = {name: [] for name in self.schema.names}
+        self.rows = 0
+
+    def write(self, record):
+        title, paragraph, book_id, source = title_fields(record["title"])
+
+        self.columns["text"].append(record["text"])
+        self.columns["summary"].append(record["summary"])
+        self.columns["alignment_scores"].append([float(score) for score in record["alignment_scores"]])
+        self.columns["title"].append(title)
+        self.columns["paragraph"].append(paragraph)
+        self.columns["book_id"].append(book_id)
+        self.columns["source"].append(source)
+
+        if len(self.columns["text"]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+
+        if not self.columns["text"]:
+            return
+
+        arrays = []
+        for field in self.schema:
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(self.columns[field.name], pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(self.columns[field.name], field.type))
+
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows += len(self.columns["text"])
+        self.columns = {name: [] for name in self.schema.names}
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+def iterate_alignment_records(path):
+    # records of a JSON output file, or materialised from a compact one
+    if path.endswith(".compact"):
+        yield from load_compact_alignments(path)
+        return
+
+    with open(path) as fd:
+        for line in fd:
+            yield json.loads(line)
+
+
+def convert_to_parquet(input_path, output_path=None, row_group_size=10000):
+    """
+    Writes the records of an alignment output file to Parquet, returns the number of rows
+
+    :param input_path: path of a .<method> or .<method>.compact file
+    :param output_path: path of the Parquet file, defaults to the input path without .compact and with .parquet
+    :param row_group_size: number of rows per row group
+    """
+    if output_path is None:
+        output_path = re.sub(r"\.compact$", "", input_path) + ".parquet"
+
+    writer = AlignmentParquetWriter(output_path, row_group_size)
+    for record in iterate_alignment_records(input_path):
+        writer.write(record)
+    writer.close()
+
+    return writer.rows
+
+
+def main(args):
+    for input_path in args.input:
+        output_path = args.output if args.output and len(args.input) == 1 else None
+        rows = convert_to_parquet(input_path, output_path, args.row_group_size)
+        print ("Converted %d records of %s" % (rows, input_path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, nargs='+', required=True, help='paths of .<method> or .<method>.compact alignment files')
+    parser.add_argument('--output', type=str, default=None, help='path of the Parquet file when converting a single input, defaults to <input>.parquet')
+    parser.add_argument('--row_group_size', type=int, default=10000, help='number of rows per Parquet row group')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,161 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Staged pipeline of generators connected by bounded queues.
+Each stage is a function from an iterator of inputs to an iterator of outputs, it runs in its own thread and puts
+its outputs into a bounded queue read by the next stage, so a slow stage blocks the ones before it (backpressure).
+Stages keep the order of their inputs and the last stage is consumed by the caller.
+For every stage the pipeline counts the items produced and the time spent waiting for inputs (starved) or for
+room in the output queue (blocked), the busiest stage is the bottleneck.
+With `queue_size=0` the stages are chained in the calling thread, as plain generators.
+"""
+
+import queue
+import threading
+import time
+
+ITEM, DONE, ERROR = 0, 1, 2
+
+
+class PipelineStage:
+
+    def __init__(self, name, function, inputs, queue_size):
+        """
+        :param name: name of the stage in the reports
+        :param function: function from an iterator of inputs to an iterator of outputs
+        :param inputs: upstream stage, None for the first stage
+        :param queue_size: max number of outputs waiting for the next stage
+        """
+        self.name = name
+        self.function = function
+        self.inputs = inputs
+        self.queue = queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="pipeline-" + name, daemon=True)
+
+        self.items = 0
+        self.input_wait = 0.0
+        self.output_wait = 0.0
+        self.start_time = None
+        self.end_time = None
+
+    def timed_inputs(self):
+        if self.inputs is None:
+            return
+
+        iterator = iter(self.inputs)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.input_wait += time.time() - start
+
+            yield item
+
+    def put(self, kind, item):
+        start = time.time()
+        while not self.stopped.is_set():
+            try:
+                self.queue.put((kind, item), timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.output_wait += time.time() - start
+
+    def run(self):
+        self.start_time = time.time()
+        try:
+            for item in self.function(self.timed_inputs()):
+                self.put(ITEM, item)
+                self.items += 1
+                if self.stopped.is_set():
+                    break
+            self.put(DONE, None)
+        except BaseException as error:
+            self.put(ERROR, error)
+        finally:
+            self.end_time = time.time()
+
+    def __iter__(self):
+        while True:
+            kind, item = self.queue.get()
+            if kind == DONE:
+                return
+            if kind == ERROR:
+                raise item
+            yield item
+
+    def stats(self):
+        elapsed = max((self.end_time or time.time()) - (self.start_time or time.time()), 1e-9)
+        busy = max(elapsed - self.input_wait - self.output_wait, 0.0)
+        return {
+            "stage": self.name,
+            "items": self.items,
+            "items_per_sec": self.items / elapsed,
+            "busy": busy / elapsed,
+            "starved": self.input_wait / elapsed,
+            "blocked": self.output_wait / elapsed,
+            "queued": self.queue.qsize(),
+        }
+
+
+class Pipeline:
+
+    def __init__(self, queue_size=4):
+        """
+        :param queue_size: size of the queue after each stage, 0 runs the stages sequentially in the calling thread
+        """
+        self.queue_size = queue_size
+        self.stages = []
+        self.functions = []
+        self.started = False
+
+    def add_stage(self, name, function):
+        self.functions.append(function)
+        if self.queue_size > 0:
+            inputs = self.stages[-1] if self.stages else None
+            self.stages.append(PipelineStage(name, function, inputs, self.queue_size))
+
+        return self
+
+    def __iter__(self):
+        if self.queue_size <= 0:
+            items = iter(())
+            for function in self.functions:
+                items = function(items)
+            yield from items
+            return
+
+        self.started = True
+        for stage in self.stages:
+            stage.thread.start()
+
+        try:
+            yield from self.stages[-1]
+        finally:
+            self.close()
+
+    def close(self):
+        # unblocks the stages waiting for room in their queues, e.g. when the consumer failed
+        for stage in self.stages:
+            stage.stopped.set()
+
+    def queued(self):
+        return "/".join(str(stage.queue.qsize()) for stage in self.stages)
+
+    def report(self):
+        if not self.started:
+            return
+
+        print ("%12s %8s %10s %8s %8s %8s" % ("stage", "items", "items/s", "busy", "starved", "blocked"))
+        for stats in (stage.stats() for stage in self.stages):
+            print ("%12s %8d %10.2f %7.1f%% %7.1f%% %7.1f%%" % (stats["stage"], stats["items"], stats["items_per_sec"],
+                                                               100 * stats["busy"], 100 * stats["starved"], 100 * stats["blocked"]))
@@ -0,0 +1,108 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Per-example timing and memory instrumentation of the aligner (`--profile`).
+Stages record their wall time for the examples they process, stages that work on batches of examples (segmentation
+chunks, encoding windows) split the batch time evenly between its examples. When an example is written, its record
+with the stage times, paragraph/sentence/token counts and the peak RSS of the process is appended to a JSONL file.
+The summary printed at the end gives the percentiles of each stage and the throughput in tokens/sec.
+Examples are tracked by object identity, so the stages can run in different pipeline threads.
+"""
+
+import json
+import resource
+import threading
+import time
+
+import numpy as np
+
+PROFILED_STAGES = ["merging", "encoding", "similarity", "matching", "writing"]
+
+
+def token_count(texts):
+    return sum(len(text.split()) for text in texts)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ExampleProfiler:
+
+    def __init__(self, profile_path, resume=False):
+        """
+        :param profile_path: path of the JSONL file the example records are written to
+        :param resume: append to the records of the interrupted run instead of starting a new file
+        """
+        self.fd = open(profile_path, "a" if resume else "w")
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.records = []
+        self.start_time = time.time()
+
+    def add_time(self, stage, examples, seconds):
+        share = seconds / max(len(examples), 1)
+        with self.lock:
+            for example in examples:
+                timings = self.timings.setdefault(id(example), {})
+                timings[stage] = timings.get(stage, 0.0) + share
+
+    def finish(self, example, key, summaries, paragraphs):
+        with self.lock:
+            timings = self.timings.pop(id(example), {})
+
+        record = {
+            "key": key,
+            "paragraphs": len(paragraphs),
+            "sentences": len(summaries),
+            "tokens": token_count(paragraphs) + token_count(summaries),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        record.update({stage: timings.get(stage, 0.0) for stage in PROFILED_STAGES})
+
+        self.fd.write(json.dumps(record) + "\n")
+        self.records.append({name: record[name] for name in PROFILED_STAGES + ["tokens"]})
+
+    def summary(self):
+        self.fd.close()
+        if not self.records:
+            return
+
+        elapsed = time.time() - self.start_time
+        tokens = sum(record["tokens"] for record in self.records)
+
+        print ("%10s %10s %10s %10s %10s %12s" % ("stage", "p50 (s)", "p90 (s)", "p99 (s)", "total (s)", "tokens/s"))
+        for stage in PROFILED_STAGES:
+            times = np.array([record[stage] for record in self.records])
+            stage_throughput = "%.1f" % (tokens / times.sum()) if times.sum() > 0 else "-"
+            print ("%10s %10.4f %10.4f %10.4f %10.1f %12s" % (stage, np.percentile(times, 50), np.percentile(times, 90), np.percentile(times, 99),
+                                                           times.sum(), stage_throughput))
+
+        print ("%d examples, %d tokens in %.1fs: %.1f tokens/s, peak RSS %.0f MB" % (len(self.records), tokens, elapsed, tokens / max(elapsed, 1e-9), peak_rss_mb()))
+
+
+def profile_stage(profiler, stage, examples):
+    # context manager timing a stage for a batch of examples, does nothing without a profiler
+    return StageTimer(profiler, stage, examples)
+
+
+class StageTimer:
+
+    def __init__(self, profiler, stage, examples):
+        self.profiler = profiler
+        self.stage = stage
+        self.examples = examples
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler is not None:
+            self.profiler.add_time(self.stage, self.examples, time.time() - self.start)
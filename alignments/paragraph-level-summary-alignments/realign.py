@@ -0,0 +1,108 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Script used to re-run the stable/greedy/monotonic/optimal alignment over the similarity matrices archived by the aligner
+(`--similarity_archive_dir`), without loading the bi-encoder. Chunks of the archive are aligned in parallel and
+the usual .stable/.greedy/.monotonic/.optimal files are written in the order of the gathered data file.
+
+python realign.py --archive_dir /path/to/archive --output_base chapter_summary_aligned_test_split.jsonl.gathered --stable_alignment --alignment_capacity 5
+"""
+
+import argparse
+import heapq
+import json
+import os
+from functools import partial
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+from similarity_archive import list_chunks, load_chunk
+import align_data_bi_encoder_paraphrase as aligner
+
+
+def realign_chunk(chunk_path, args):
+    records, matrices = load_chunk(chunk_path)
+
+    aligned_records = []
+    for record, similarity_matrix in zip(records, matrices):
+        aligned = aligner.align_example(record, record["summaries"], record["paragraphs"], similarity_matrix, args)
+        aligned_records.append((record["line"], record["key"], aligned))
+
+    return aligned_records
+
+
+def main(args):
+    chunks = list_chunks(args.archive_dir)
+    if not chunks:
+        raise RuntimeError("No similarity archive chunks found in: %s" % args.archive_dir)
+
+    names = aligner.enabled_alignment_methods(args)
+    output_files = {name: open(args.output_base + "." + name + ".tmp", "w") for name in names}
+
+    # chunks are sorted by their first line, so every record buffered with a line before
+    # the first line of the next chunk can be written out
+    pending = []
+    written_keys = set()
+    sequence = 0
+
+    def write_until(line_limit):
+        while pending and (line_limit is None or pending[0][0] < line_limit):
+            _, _, key, aligned = heapq.heappop(pending)
+
+            # examples may be archived twice when a run was resumed, keep the first copy
+            if key in written_keys:
+                continue
+            written_keys.add(key)
+
+            for name in names:
+                for record in aligned[name]:
+                    output_files[name].write(json.dumps(record) + "\n")
+
+    with Pool(args.workers) as pool:
+        chunk_results = pool.imap(partial(realign_chunk, args=args), [chunk_path for _, chunk_path in chunks])
+
+        for chunk_ix, aligned_records in enumerate(tqdm(chunk_results, total=len(chunks))):
+            for line_ix, key, aligned in aligned_records:
+                heapq.heappush(pending, (line_ix, sequence, key, aligned))
+                sequence += 1
+
+            next_first_line = chunks[chunk_ix + 1][0] if chunk_ix + 1 < len(chunks) else None
+            write_until(next_first_line)
+
+    for name, fd in output_files.items():
+        fd.close()
+        os.replace(args.output_base + "." + name + ".tmp", args.output_base + "." + name)
+
+    print ("Realigned %d examples from %d chunks" % (len(written_keys), len(chunks)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--archive_dir', type=str, required=True, help='similarity archive directory written by the aligner')
+    parser.add_argument('--output_base', type=str, default=None, help='path prefix of the output files, defaults to the archive directory name')
+    parser.add_argument('--stable_alignment', action='store_true', help='function used for aligning')
+    parser.add_argument('--greedy_alignment', action='store_true', help='function used for aligning')
+    parser.add_argument('--monotonic_alignment', action='store_true', help='align summary sentences in the narrative order of the chapter with dynamic programming')
+    parser.add_argument('--monotonic_skip_penalty', type=float, default=0.0, help='monotonic alignment cost of every paragraph skipped between consecutive summary sentences')
+    parser.add_argument('--monotonic_backtrack_penalty', type=float, default=float('inf'), help='monotonic alignment cost of moving back to an earlier paragraph, inf keeps the order strict')
+    parser.add_argument('--monotonic_band_width', type=int, default=None, help='max distance of the monotonic alignment from the diagonal, limits the dynamic program to a band')
+    parser.add_argument('--optimal_alignment', action='store_true', help='assign summary sentences to paragraphs with the max total similarity under `alignment_capacity`')
+    parser.add_argument('--optimal_max_cells', type=int, default=20000000, help='size limit of the optimal assignment problem (#summaries X #paragraphs X capacity), larger examples fall back to stable alignment')
+    parser.add_argument('--alignment_capacity', type=int, default=10, help='')
+    parser.add_argument('--stable_matching_engine', type=str, default='numpy', choices=['numpy', 'matching'], help='solver used for stable alignment, both return the same alignments')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes aligning chunks in parallel')
+    args = parser.parse_args()
+
+    if not aligner.enabled_alignment_methods(args):
+        raise RuntimeError("At least one alignment option must be chosen: `stable_alignment`, `greedy_alignment`, `monotonic_alignment`, `optimal_alignment`.")
+
+    if args.output_base is None:
+        args.output_base = os.path.basename(os.path.normpath(args.archive_dir))
+
+    main(args)
@@ -0,0 +1,190 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Deterministic sharding of gathered examples and ordered merging of the per-shard alignment outputs.
+Every shard writes its own output files along with an index file, one JSON line per completed example with
+its line number in the gathered data file and the number of lines it wrote to each output.
+The merge replays the index files in line order, which reproduces the output of a single process run.
+
+Across machines, `gather_data.py` and the aligner take `--shard i/N`: node i only processes the books whose `bid`
+hashes to i, so all the chapters of a book, and the summaries of a chapter, stay on the same node. Node outputs are
+written as `<output>.part-i-of-N.<name>` with their index, and merged with a completeness check against the
+input file (the manifest), which fails if any of its examples is missing from the parts:
+
+python sharding.py --manifest ../chapter-level-summary-alignments/chapter_summary_aligned_test_split.jsonl --num_shards 4 --names gathered
+python sharding.py --manifest chapter_summary_aligned_test_split.jsonl.gathered --num_shards 4 --names stable greedy
+"""
+
+import argparse
+import json
+import os
+import zlib
+from os.path import basename
+
+
+def shard_of(value, num_shards):
+    """
+    Shard assigned to a value, stable across runs and machines
+
+    :param value: sharding key, eg. the chapter path of an example
+    :param num_shards: total number of shards
+    """
+    return zlib.crc32(str(value).encode("utf-8")) % num_shards
+
+
+def shard_output_base(output_base, shard, num_shards):
+    return "%s.shard-%d-of-%d" % (output_base, shard, num_shards)
+
+
+def parse_shard(spec):
+    # `i/N` -> (i, N), used as an argparse type
+    try:
+        shard, num_shards = [int(value) for value in spec.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be given as i/N, got %r" % spec)
+
+    if not 0 <= shard < num_shards:
+        raise argparse.ArgumentTypeError("shard index must be in [0, %d), got %d" % (num_shards, shard))
+
+    return shard, num_shards
+
+
+def in_node_shard(example, shard):
+    # examples are assigned to nodes by book, so a book is never split across nodes
+    return shard is None or shard_of(example["bid"], shard[1]) == shard[0]
+
+
+def node_output_base(output_base, shard):
+    if shard is None:
+        return output_base
+    return "%s.part-%d-of-%d" % (output_base, shard[0], shard[1])
+
+
+def read_index_entries(index_paths):
+    # (line, part, entry) of the index files, in line order
+    entries = []
+    for part, index_path in enumerate(index_paths):
+        with open(index_path) as fd:
+            for line in fd:
+                entry = json.loads(line)
+                entries.append((entry["line"], part, entry))
+    entries.sort(key=lambda entry: entry[:2])
+
+    return entries
+
+
+def merge_indexed_outputs(part_bases, output_base, names, entries=None, write_index=False):
+    """
+    Merge the output files of several parts into `output_base`.<name> files in the order of their index entries
+
+    :param part_bases: path prefixes of the parts, each with an .index file
+    :param output_base: path prefix of the merged output files
+    :param names: output names, eg. ["stable", "greedy"]
+    :param entries: index entries of the parts, read from their index files if not given
+    :param write_index: also write the merged index, eg. when merging the worker shards of a node
+    """
+    if entries is None:
+        entries = read_index_entries([part_base + ".index" for part_base in part_bases])
+
+    for name in names + (["index"] if write_index else []):
+        part_files = [open(part_base + "." + name) for part_base in part_bases] if name != "index" else []
+        merged_path = output_base + "." + name
+
+        with open(merged_path + ".tmp", "w") as fd:
+            for _, part, entry in entries:
+                if name == "index":
+                    fd.write(json.dumps(entry) + "\n")
+                    continue
+
+                for _ in range(entry[name]):
+                    fd.write(part_files[part].readline())
+
+        # every line of the parts must belong to an example of their index
+        for part_base, part_file in zip(part_bases, part_files):
+            if part_file.readline():
+                raise RuntimeError("%s.%s has lines that are not in its index, it was not merged" % (part_base, name))
+            part_file.close()
+
+        os.replace(merged_path + ".tmp", merged_path)
+
+    return len(entries)
+
+
+def merge_shard_outputs(output_base, names, num_shards, write_index=False):
+    """
+    Merge the per-shard output files into `output_base`.<name> files in the order of the gathered data file
+
+    :param output_base: path prefix of the merged output files
+    :param names: output names, eg. ["stable", "greedy"]
+    :param num_shards: total number of shards
+    :param write_index: also write the merged index, when `output_base` is itself a node part
+    """
+    part_bases = [shard_output_base(output_base, shard, num_shards) for shard in range(num_shards)]
+    return merge_indexed_outputs(part_bases, output_base, names, write_index=write_index)
+
+
+def remove_shard_outputs(output_base, names, num_shards):
+    # output, index and checkpoint files of the shards, once they are merged
+    for shard in range(num_shards):
+        part_base = shard_output_base(output_base, shard, num_shards)
+        for name in names + ["index", "checkpoint"]:
+            if os.path.exists(part_base + "." + name):
+                os.remove(part_base + "." + name)
+
+
+def check_node_outputs(manifest_path, output_base, num_shards):
+    """
+    Returns the index entries of the node parts, raises if an example of the manifest is missing from its part
+
+    :param manifest_path: input file of the nodes, eg. the matched file of `gather_data.py` or a gathered file
+    :param output_base: path prefix of the node parts
+    :param num_shards: number of nodes
+    """
+    part_bases = [node_output_base(output_base, (shard, num_shards)) for shard in range(num_shards)]
+
+    missing_parts = [part_base for part_base in part_bases if not os.path.exists(part_base + ".index")]
+    if missing_parts:
+        raise RuntimeError("Missing node outputs: %s" % missing_parts)
+
+    entries = read_index_entries([part_base + ".index" for part_base in part_bases])
+    lines = {(line_ix, part) for line_ix, part, _ in entries}
+
+    # examples with an empty summary are skipped by the aligner
+    missing = []
+    with open(manifest_path) as fd:
+        for line_ix, line in enumerate(fd):
+            example = json.loads(line)
+            if example.get("summary") == []:
+                continue
+
+            if (line_ix, shard_of(example["bid"], num_shards)) not in lines:
+                missing.append(line_ix)
+
+    if missing:
+        raise RuntimeError("%d examples of %s are missing from the node outputs, first lines: %s" % (len(missing), manifest_path, missing[:10]))
+
+    return part_bases, entries
+
+
+def main(args):
+    output_base = args.output_base or basename(args.manifest)
+
+    part_bases, entries = check_node_outputs(args.manifest, output_base, args.num_shards)
+    merged_cnt = merge_indexed_outputs(part_bases, output_base, args.names, entries)
+    print ("Merged %d examples from %d nodes into %s.{%s}" % (merged_cnt, args.num_shards, output_base, ",".join(args.names)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--manifest', type=str, required=True, help='input file of the nodes, every example of it must be in the node outputs')
+    parser.add_argument('--num_shards', type=int, required=True, help='number of nodes, N of `--shard i/N`')
+    parser.add_argument('--names', type=str, nargs='+', required=True, help='outputs to merge, `gathered` for gather_data.py, alignment methods for the aligner')
+    parser.add_argument('--output_base', type=str, default=None, help='path prefix of the node outputs and of the merged files, defaults to the basename of the manifest')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,119 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Archive of the similarity matrices computed by the aligner, used to re-run the matching offline without the encoder.
+The archive is a directory of compressed chunks, each with:
+    chunk_xxxxx.json.gz - one record per example: line in the gathered file, checkpoint key, book_id, source,
+                          chapter_path, summary sentences and merged paragraphs (row and column order of the matrix)
+    chunk_xxxxx.npz     - the #summaries X #paragraphs matrices of the examples, along with their lines and keys
+A chunk is complete once its .npz file exists. Examples are added in the order of the gathered file, so
+records within a chunk and chunks within a directory are sorted by line.
+"""
+
+import glob
+import gzip
+import json
+import os
+import re
+
+import numpy as np
+
+
+def check_archive_dir(archive_dir, resume=False):
+    # a fresh run must not mix its chunks with the ones of an older run, which `realign.py` would read first
+    if not resume and list_chunks(archive_dir):
+        raise RuntimeError("Similarity archive %s already has chunks, remove them or run with `--resume`." % archive_dir)
+
+
+class SimilarityArchiveWriter:
+
+    def __init__(self, archive_dir, chunk_size=256, resume=False):
+        """
+        :param archive_dir: directory of the archive
+        :param chunk_size: max number of examples in a single chunk
+        :param resume: add chunks to the ones of an interrupted run, otherwise the directory must have no chunks
+        """
+        self.archive_dir = archive_dir
+        self.chunk_size = chunk_size
+        os.makedirs(archive_dir, exist_ok=True)
+        check_archive_dir(archive_dir, resume)
+
+        chunk_ids = [int(re.match(r"chunk_(\d+)\.npz$", os.path.basename(path)).group(1))
+                     for path in glob.glob(os.path.join(archive_dir, "chunk_*.npz")) if not path.endswith(".tmp.npz")]
+        self.next_chunk = max(chunk_ids) + 1 if chunk_ids else 0
+        self.records = []
+        self.matrices = []
+
+    def add(self, line_ix, key, example, summaries, paragraphs, similarity_matrix):
+        self.records.append({
+            "line": line_ix,
+            "key": key,
+            "book_id": example["book_id"],
+            "source": example["source"],
+            "chapter_path": example["chapter_path"],
+            "summaries": summaries,
+            "paragraphs": paragraphs
+        })
+        self.matrices.append(np.asarray(similarity_matrix, dtype=np.float32))
+
+        if len(self.records) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+
+        chunk_path = os.path.join(self.archive_dir, "chunk_%05d" % self.next_chunk)
+
+        with gzip.open(chunk_path + ".json.gz", "wt") as fd:
+            json.dump(self.records, fd)
+
+        # the .npz file is written last and atomically, it marks the chunk as complete
+        arrays = {"matrix_%d" % ix: matrix for ix, matrix in enumerate(self.matrices)}
+        np.savez_compressed(chunk_path + ".tmp.npz",
+                            lines=np.array([record["line"] for record in self.records], dtype=np.int64),
+                            keys=np.array([record["key"] for record in self.records]),
+                            **arrays)
+        os.replace(chunk_path + ".tmp.npz", chunk_path + ".npz")
+
+        self.next_chunk += 1
+        self.records = []
+        self.matrices = []
+
+
+def list_chunks(archive_dir):
+    """
+    Complete chunks of an archive, including the archives of all shards in its subdirectories,
+    returns (first line, chunk path without extension) sorted by the first line
+    """
+    chunks = []
+    for npz_path in glob.glob(os.path.join(archive_dir, "**", "chunk_*.npz"), recursive=True):
+        if npz_path.endswith(".tmp.npz"):
+            continue
+
+        with np.load(npz_path) as chunk:
+            lines = chunk["lines"]
+        if len(lines):
+            chunks.append((int(lines[0]), npz_path[:-len(".npz")]))
+
+    return sorted(chunks)
+
+
+def load_chunk(chunk_path):
+    """
+    Returns the records and similarity matrices of a chunk
+
+    :param chunk_path: chunk path without extension
+    """
+    with gzip.open(chunk_path + ".json.gz", "rt") as fd:
+        records = json.load(fd)
+
+    with np.load(chunk_path + ".npz") as chunk:
+        matrices = [chunk["matrix_%d" % ix] for ix in range(len(records))]
+
+    return records, matrices
@@ -0,0 +1,83 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Sparse top-k similarities for very long chapters and plays.
+Only the k most similar paragraphs of each summary sentence are kept. They are computed over blocks of paragraphs,
+merging the running top-k with each block, so the dense #summaries X #paragraphs matrix is never materialised.
+Stable matching on the truncated preference lists can leave sentences unmatched when all of their k paragraphs are
+full, the aligner then falls back to the greedy alignment of those sentences, their most similar paragraph, even
+beyond its capacity.
+"""
+
+import numpy as np
+
+
+class TopKSimilarity:
+
+    def __init__(self, indices, scores, text_cnt):
+        """
+        :param indices: #summaries X k paragraph indices, most similar first
+        :param scores: #summaries X k cosine similarities of those paragraphs
+        :param text_cnt: total number of paragraphs
+        """
+        self.indices = indices
+        self.scores = scores
+        self.shape = (indices.shape[0], text_cnt)
+
+    def score(self, summ_ix, text_ix):
+        # similarity of a pair, nan if the paragraph isn't in the top-k of the sentence
+        positions = np.nonzero(self.indices[summ_ix] == text_ix)[0]
+        if len(positions) == 0:
+            return np.float32("nan")
+        return self.scores[summ_ix, positions[0]]
+
+    def nbytes(self):
+        return self.indices.nbytes + self.scores.nbytes
+
+
+def normalize_embeddings(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.clip(norms, 1e-8, None)
+
+
+def topk_similarities(paragraphs_embeddings, summaries_embeddings, k, block_size=1024):
+    """
+    Top-k cosine similarities between summary sentences and paragraphs
+
+    :param paragraphs_embeddings: #paragraphs X dim embeddings
+    :param summaries_embeddings: #summaries X dim embeddings
+    :param k: number of paragraphs kept for each summary sentence
+    :param block_size: number of paragraphs scored at once
+    """
+    paragraphs_embeddings = normalize_embeddings(paragraphs_embeddings)
+    summaries_embeddings = normalize_embeddings(summaries_embeddings)
+
+    summ_cnt, text_cnt = len(summaries_embeddings), len(paragraphs_embeddings)
+    k = min(k, text_cnt)
+
+    top_indices = np.zeros((summ_cnt, 0), dtype=np.int64)
+    top_scores = np.zeros((summ_cnt, 0), dtype=np.float32)
+
+    for start in range(0, text_cnt, block_size):
+        block_scores = summaries_embeddings @ paragraphs_embeddings[start:start + block_size].T
+        block_indices = np.broadcast_to(np.arange(start, start + block_scores.shape[1]), block_scores.shape)
+
+        candidate_scores = np.concatenate([top_scores, block_scores], axis=1)
+        candidate_indices = np.concatenate([top_indices, block_indices], axis=1)
+
+        if candidate_scores.shape[1] > k:
+            keep = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+            candidate_scores = np.take_along_axis(candidate_scores, keep, axis=1)
+            candidate_indices = np.take_along_axis(candidate_indices, keep, axis=1)
+
+        top_scores, top_indices = candidate_scores, candidate_indices
+
+    # most similar paragraphs first
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return TopKSimilarity(np.take_along_axis(top_indices, order, axis=1), np.take_along_axis(top_scores, order, axis=1), text_cnt)
@@ -0,0 +1,192 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Capacitated hospital-resident stable matching between summary sentences and text paragraphs.
+Text paragraphs are the hospitals and summary sentences are the residents, the matching is hospital-optimal.
+`hospital_optimal_matching` runs deferred acceptance on integer preference arrays with NumPy, in every round
+all under-subscribed paragraphs propose to their next most preferred sentences at once.
+`hospital_optimal_matching_library` solves the same game with the `matching` library and is kept as a reference.
+`hospital_optimal_matching_topk` runs the same algorithm on truncated preference lists, where each sentence only
+ranks its top-k paragraphs and each paragraph only ranks the sentences that ranked it.
+"""
+
+import numpy as np
+
+
+def preference_arrays(similarity_matrix):
+    """
+    Integer preference lists of both sides, most preferred first
+
+    :param similarity_matrix: #summaries X #paragraphs similarity matrix
+    """
+    summ_prefs = np.argsort(similarity_matrix, axis=1)[:, ::-1]
+    text_prefs = np.argsort(similarity_matrix, axis=0)[::-1, :].T
+
+    return summ_prefs, text_prefs
+
+
+def hospital_optimal_matching(similarity_matrix, text_capacity):
+    """
+    Returns the index of the aligned paragraph for each summary sentence, -1 for unmatched sentences
+
+    :param similarity_matrix: #summaries X #paragraphs similarity matrix
+    :param text_capacity: max number of summary sentences aligned with a single paragraph
+    """
+    summ_cnt, text_cnt = similarity_matrix.shape
+    summ_prefs, text_prefs = preference_arrays(similarity_matrix)
+
+    # rank of each paragraph in the preference list of each summary sentence
+    summ_ranks = np.empty((summ_cnt, text_cnt), dtype=np.int64)
+    summ_ranks[np.arange(summ_cnt)[:, None], summ_prefs] = np.arange(text_cnt)[None, :]
+
+    matches = np.full(summ_cnt, -1, dtype=np.int64)
+    match_ranks = np.full(summ_cnt, text_cnt, dtype=np.int64)
+    text_matched = np.zeros(text_cnt, dtype=np.int64)
+    text_next = np.zeros(text_cnt, dtype=np.int64)
+
+    while True:
+        # every paragraph with free capacity proposes to as many of its next preferred sentences
+        proposal_cnt = np.minimum(text_capacity - text_matched, summ_cnt - text_next)
+        proposal_cnt[proposal_cnt < 0] = 0
+        if not proposal_cnt.any():
+            break
+
+        proposing = np.nonzero(proposal_cnt)[0]
+        proposal_text = np.repeat(proposing, proposal_cnt[proposing])
+        group_starts = np.cumsum(proposal_cnt[proposing]) - proposal_cnt[proposing]
+        proposal_offset = np.arange(len(proposal_text)) - np.repeat(group_starts, proposal_cnt[proposing])
+        proposal_summ = text_prefs[proposal_text, text_next[proposal_text] + proposal_offset]
+        text_next += proposal_cnt
+
+        # each sentence keeps its most preferred proposal, if it beats its current match
+        proposal_rank = summ_ranks[proposal_summ, proposal_text]
+        order = np.lexsort((proposal_rank, proposal_summ))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = proposal_summ[order][1:] != proposal_summ[order][:-1]
+        best = order[first]
+
+        accepted = best[proposal_rank[best] < match_ranks[proposal_summ[best]]]
+        accepted_summ = proposal_summ[accepted]
+        accepted_text = proposal_text[accepted]
+
+        released = matches[accepted_summ]
+        np.subtract.at(text_matched, released[released >= 0], 1)
+        np.add.at(text_matched, accepted_text, 1)
+
+        matches[accepted_summ] = accepted_text
+        match_ranks[accepted_summ] = proposal_rank[accepted]
+
+    return matches.tolist()
+
+
+def hospital_optimal_matching_topk(topk_similarity, text_capacity):
+    """
+    Returns the index of the aligned paragraph for each summary sentence, -1 for unmatched sentences
+
+    :param topk_similarity: TopKSimilarity with the k most similar paragraphs of each summary sentence
+    :param text_capacity: max number of summary sentences aligned with a single paragraph
+    """
+    summ_cnt, text_cnt = topk_similarity.shape
+    k = topk_similarity.indices.shape[1]
+
+    # (sentence, paragraph, similarity, rank of the paragraph for the sentence) of all acceptable pairs
+    pair_summ = np.repeat(np.arange(summ_cnt), k)
+    pair_text = topk_similarity.indices.ravel()
+    pair_score = topk_similarity.scores.ravel()
+    pair_rank = np.tile(np.arange(k), summ_cnt)
+
+    # preference lists of the paragraphs, most similar sentence first
+    order = np.lexsort((-pair_score, pair_text))
+    list_summ = pair_summ[order]
+    list_rank = pair_rank[order]
+    list_len = np.bincount(pair_text, minlength=text_cnt)
+    list_start = np.cumsum(list_len) - list_len
+
+    matches = np.full(summ_cnt, -1, dtype=np.int64)
+    match_ranks = np.full(summ_cnt, k, dtype=np.int64)
+    text_matched = np.zeros(text_cnt, dtype=np.int64)
+    text_next = np.zeros(text_cnt, dtype=np.int64)
+
+    while True:
+        proposal_cnt = np.minimum(text_capacity - text_matched, list_len - text_next)
+        proposal_cnt[proposal_cnt < 0] = 0
+        if not proposal_cnt.any():
+            break
+
+        proposing = np.nonzero(proposal_cnt)[0]
+        proposal_text = np.repeat(proposing, proposal_cnt[proposing])
+        group_starts = np.cumsum(proposal_cnt[proposing]) - proposal_cnt[proposing]
+        proposal_offset = np.arange(len(proposal_text)) - np.repeat(group_starts, proposal_cnt[proposing])
+        positions = list_start[proposal_text] + text_next[proposal_text] + proposal_offset
+        proposal_summ = list_summ[positions]
+        proposal_rank = list_rank[positions]
+        text_next += proposal_cnt
+
+        order = np.lexsort((proposal_rank, proposal_summ))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = proposal_summ[order][1:] != proposal_summ[order][:-1]
+        best = order[first]
+
+        accepted = best[proposal_rank[best] < match_ranks[proposal_summ[best]]]
+        accepted_summ = proposal_summ[accepted]
+        accepted_text = proposal_text[accepted]
+
+        released = matches[accepted_summ]
+        np.subtract.at(text_matched, released[released >= 0], 1)
+        np.add.at(text_matched, accepted_text, 1)
+
+        matches[accepted_summ] = accepted_text
+        match_ranks[accepted_summ] = proposal_rank[accepted]
+
+    return matches.tolist()
+
+
+def hospital_optimal_matching_library(similarity_matrix, text_capacity):
+    """
+    Same as `hospital_optimal_matching`, solved with `matching.games.HospitalResident`
+
+    :param similarity_matrix: #summaries X #paragraphs similarity matrix
+    :param text_capacity: max number of summary sentences aligned with a single paragraph
+    """
+    from matching.games import HospitalResident
+
+    # text paragraphs -> hospital
+    # summary paragraphs -> resident
+    summ_cnt, text_cnt = similarity_matrix.shape
+
+    summ_ids = ["%dS" % ix for ix in range(summ_cnt)]
+    text_ids = ["%dT" % ix for ix in range(text_cnt)]
+    ids_summ = {key: ix for ix, key in enumerate(summ_ids)}
+    ids_text = {key: ix for ix, key in enumerate(text_ids)}
+
+    # organize summary sentences preferences
+    summ_prefs = {key: [] for _, key in enumerate(summ_ids)}
+    for summ_ix, summ_id in enumerate(summ_ids):
+        alignment = np.argsort(similarity_matrix[summ_ix, :])[::-1]
+        summ_prefs[summ_id] = [text_ids[ix] for ix in alignment]
+
+    # organize text paragraph preferences
+    text_prefs = {key: [] for _, key in enumerate(text_ids)}
+    for text_ix, text_id in enumerate(text_ids):
+        alignment = np.argsort(similarity_matrix[:, text_ix])[::-1]
+        text_prefs[text_id] = [summ_ids[ix] for ix in alignment]
+
+    # update matching capacity
+    capacity = {key: text_capacity for key in text_ids}
+
+    # run matching algorithm
+    game = HospitalResident.create_from_dictionaries(summ_prefs, text_prefs, capacity)
+    matching = game.solve(optimal="hospital")
+
+    # extract alignments
+    alignments = [-1] * summ_cnt
+    for t_key, s_keys in matching.items():
+        for s_key in s_keys:
+            alignments[ids_summ[s_key.name]] = ids_text[t_key.name]
+
+    return alignments
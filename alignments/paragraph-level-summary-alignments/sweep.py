@@ -0,0 +1,204 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Script used to align a data file with a grid of `merging_min_sents` X `merging_max_sents` X `alignment_capacity`
+values in a single process. The sentences of each chapter are counted with spaCy once and merged for every
+(min, max) pair, merged paragraphs that come out identical for several pairs are encoded once and their embeddings
+are shared, and the similarity matrix of each pair is aligned with every capacity.
+Each configuration is written to its own `<data file>.sweep.min<min>-max<max>-cap<capacity>.<method>` files, and
+the time spent by each configuration in every stage is printed at the end.
+
+python sweep.py --data_path /path/to/chapter_summary_aligned_test_split.jsonl.gathered --stable_alignment --merging_min_sents 3 4 5 --merging_max_sents 8 12 --alignment_capacity 5 10
+"""
+
+import argparse
+import json
+import time
+from collections import Counter, defaultdict
+from os.path import basename
+
+import numpy as np
+from tqdm import tqdm
+
+from embedding_scheduler import EncodingScheduler
+from encoder_backends import ENCODER_BACKENDS
+from lexical_similarity import LEXICAL_SCHEMES
+from sparse_similarity import normalize_embeddings
+import align_data_bi_encoder_paraphrase as aligner
+
+
+def merging_configs(args):
+    return [(min_sents, max_sents) for min_sents in args.merging_min_sents for max_sents in args.merging_max_sents if min_sents <= max_sents]
+
+
+def config_name(min_sents, max_sents, capacity):
+    return "min%d-max%d-cap%d" % (min_sents, max_sents, capacity)
+
+
+class SweepSimilarities:
+
+    def __init__(self, args):
+        """
+        Similarity matrices of merged paragraphs with memoized paragraph encodings, shared by all configurations
+
+        :param args: sweep arguments, `similarity_fn` selects the bi-encoder or a lexical function
+        """
+        self.lexical = args.similarity_fn in LEXICAL_SCHEMES
+        if self.lexical:
+            self.vectorizer = aligner.fit_lexical_vectorizer(args)
+        else:
+            self.scheduler = EncodingScheduler(aligner.load_bi_encoder(args), args.encoding_batch_size, args.encoding_bucket_width)
+
+        # group key -> {paragraph text: embedding}
+        self.paragraph_embeddings = {}
+
+    def encode(self, texts):
+        return self.scheduler.encode_unique(texts).cpu().numpy()
+
+    def encode_paragraphs(self, key, paragraphs):
+        # returns the number of paragraphs encoded, the other ones were encoded for an earlier configuration
+        if self.lexical:
+            return 0
+
+        memo = self.paragraph_embeddings.setdefault(key, {})
+        missing = list(dict.fromkeys(paragraph for paragraph in paragraphs if paragraph not in memo))
+        if missing:
+            memo.update(zip(missing, self.encode(missing)))
+
+        return len(missing)
+
+    def similarities(self, key, paragraphs, summaries, summaries_embeddings):
+        if self.lexical:
+            return self.vectorizer.similarities(self.vectorizer.transform_paragraphs(paragraphs), self.vectorizer.transform_summaries(summaries))
+
+        memo = self.paragraph_embeddings[key]
+        paragraphs_embeddings = np.stack([memo[paragraph] for paragraph in paragraphs])
+        return normalize_embeddings(summaries_embeddings) @ normalize_embeddings(paragraphs_embeddings).T
+
+    def release(self, key):
+        self.paragraph_embeddings.pop(key, None)
+
+
+def main(args):
+    similarities = SweepSimilarities(args)
+    configs = merging_configs(args)
+    methods = aligner.enabled_alignment_methods(args)
+    output_base = basename(args.data_path) + ".sweep."
+
+    output_files = {}
+    for min_sents, max_sents in configs:
+        for capacity in args.alignment_capacity:
+            for name in methods:
+                output_files[(min_sents, max_sents, capacity, name)] = open(output_base + config_name(min_sents, max_sents, capacity) + "." + name, "w")
+
+    # seconds spent in each stage, by (min, max) for the stages shared by all capacities and by (min, max, capacity)
+    timings = defaultdict(Counter)
+    paragraph_counts = defaultdict(Counter)
+
+    group_counts = aligner.count_group_keys(aligner.iterate_gathered_examples(args.data_path), args)
+    chapter_sentence_counts = {}
+
+    for ix, example in enumerate(tqdm(aligner.iterate_gathered_examples(args.data_path))):
+        if example["summary"] == []:
+            continue
+
+        key = aligner.example_group_key(example, ix, args)
+        text_paragraphs = [par for par in example["text"] if par]
+        summaries = [sent for sent in example["summary"] if sent]
+
+        # spaCy runs once per chapter, for all configurations
+        if key not in chapter_sentence_counts:
+            start = time.time()
+            chapter_sentence_counts[key] = aligner.count_paragraph_sentences(text_paragraphs, args.segmentation_batch_size, args.segmentation_n_process)
+            timings["all"]["segmentation"] += time.time() - start
+
+        start = time.time()
+        summaries_embeddings = None if similarities.lexical else similarities.encode(summaries)
+        timings["all"]["summary encoding"] += time.time() - start
+
+        for min_sents, max_sents in configs:
+            start = time.time()
+            paragraphs = aligner.merge_paragraphs_by_counts(text_paragraphs, chapter_sentence_counts[key], min_sents, max_sents)
+            timings[(min_sents, max_sents)]["merging"] += time.time() - start
+
+            start = time.time()
+            encoded = similarities.encode_paragraphs(key, paragraphs)
+            timings[(min_sents, max_sents)]["encoding"] += time.time() - start
+            if not similarities.lexical:
+                paragraph_counts[(min_sents, max_sents)]["encoded"] += encoded
+                paragraph_counts[(min_sents, max_sents)]["reused"] += len(paragraphs) - encoded
+
+            start = time.time()
+            similarity_matrix = similarities.similarities(key, paragraphs, summaries, summaries_embeddings)
+            timings[(min_sents, max_sents)]["similarity"] += time.time() - start
+
+            for capacity in args.alignment_capacity:
+                start = time.time()
+                aligned = aligner.align_example(example, summaries, paragraphs, similarity_matrix, argparse.Namespace(**dict(vars(args), alignment_capacity=capacity)))
+                timings[(min_sents, max_sents, capacity)]["matching"] += time.time() - start
+
+                start = time.time()
+                for name, records in aligned.items():
+                    for record in records:
+                        output_files[(min_sents, max_sents, capacity, name)].write(json.dumps(record) + "\n")
+                timings[(min_sents, max_sents, capacity)]["writing"] += time.time() - start
+
+        group_counts[key] -= 1
+        if group_counts[key] == 0:
+            del chapter_sentence_counts[key]
+            similarities.release(key)
+
+    for output_file in output_files.values():
+        output_file.close()
+
+    print ("segmentation: %.1fs, summary encoding: %.1fs (shared by all configurations)" % (timings["all"]["segmentation"], timings["all"]["summary encoding"]))
+    print ("%22s %10s %10s %10s %10s %10s %10s %10s" % ("config", "merging", "encoding", "similarity", "matching", "writing", "encoded", "reused"))
+    for min_sents, max_sents in configs:
+        shared = timings[(min_sents, max_sents)]
+        for capacity in args.alignment_capacity:
+            config = timings[(min_sents, max_sents, capacity)]
+            print ("%22s %10.2f %10.2f %10.2f %10.2f %10.2f %10d %10d" % (config_name(min_sents, max_sents, capacity), shared["merging"], shared["encoding"], shared["similarity"],
+                                                                      config["matching"], config["writing"], paragraph_counts[(min_sents, max_sents)]["encoded"],
+                                                                      paragraph_counts[(min_sents, max_sents)]["reused"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, required=True, help='path to gathered data file')
+    parser.add_argument('--merging_min_sents', type=int, nargs='+', default=[4], help='values of `merging_min_sents` in the grid')
+    parser.add_argument('--merging_max_sents', type=int, nargs='+', default=[12], help='values of `merging_max_sents` in the grid')
+    parser.add_argument('--alignment_capacity', type=int, nargs='+', default=[10], help='values of `alignment_capacity` in the grid')
+    parser.add_argument('--stable_alignment', action='store_true', help='function used for aligning')
+    parser.add_argument('--greedy_alignment', action='store_true', help='function used for aligning')
+    parser.add_argument('--monotonic_alignment', action='store_true', help='align summary sentences in the narrative order of the chapter with dynamic programming')
+    parser.add_argument('--optimal_alignment', action='store_true', help='assign summary sentences to paragraphs with the max total similarity under `alignment_capacity`')
+    parser.add_argument('--stable_matching_engine', type=str, default='numpy', choices=['numpy', 'matching'], help='solver used for stable alignment, both return the same alignments')
+    parser.add_argument('--monotonic_skip_penalty', type=float, default=0.0, help='monotonic alignment cost of every paragraph skipped between consecutive summary sentences')
+    parser.add_argument('--monotonic_backtrack_penalty', type=float, default=float('inf'), help='monotonic alignment cost of moving back to an earlier paragraph, inf keeps the order strict')
+    parser.add_argument('--monotonic_band_width', type=int, default=None, help='max distance of the monotonic alignment from the diagonal, limits the dynamic program to a band')
+    parser.add_argument('--optimal_max_cells', type=int, default=20000000, help='size limit of the optimal assignment problem, larger examples fall back to stable alignment')
+    parser.add_argument('--similarity_fn', type=str, default='bi_encoder', choices=['bi_encoder'] + LEXICAL_SCHEMES, help='function used for similarity evaluation')
+    parser.add_argument('--bm25_k1', type=float, default=1.2, help='BM25 term frequency saturation')
+    parser.add_argument('--bm25_b', type=float, default=0.75, help='BM25 paragraph length normalization')
+    parser.add_argument('--encoder_backend', type=str, default='pytorch', choices=ENCODER_BACKENDS, help='bi-encoder inference backend')
+    parser.add_argument('--model_dir', type=str, default=None, help='local sentence-transformers model directory')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='number of torch threads')
+    parser.add_argument('--encoding_batch_size', type=int, default=64, help='number of texts per encoder forward pass')
+    parser.add_argument('--encoding_bucket_width', type=int, default=32, help='range of token lengths grouped into the same encoding bucket')
+    parser.add_argument('--segmentation_batch_size', type=int, default=256, help='number of paragraphs per spaCy `nlp.pipe` batch')
+    parser.add_argument('--segmentation_n_process', type=int, default=1, help='number of processes used by spaCy `nlp.pipe`')
+    parser.add_argument('--group_key', type=str, default='chapter_path', help='examples with the same value of this field share sentence counts and paragraph embeddings')
+    args = parser.parse_args()
+
+    if not aligner.enabled_alignment_methods(args):
+        raise RuntimeError("At least one alignment option must be chosen: `stable_alignment`, `greedy_alignment`, `monotonic_alignment`, `optimal_alignment`.")
+
+    if not merging_configs(args):
+        raise RuntimeError("No (merging_min_sents, merging_max_sents) pair of the grid has min <= max.")
+
+    main(args)
@@ -13,14 +13,17 @@ The script separates cleans the summary text along with separating the analysis,
 
 import json
 import os
+import sys
 from unidecode import unidecode
 import re
 from tqdm import tqdm
 from os.path import basename
 from multiprocessing import Pool
-import spacy
 import string
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import spacy_registry
+
 
 sources = ['gradesaver', 'shmoop',  'cliffnotes', 'sparknotes', 'pinkmonkey', 'bookwolf',  'novelguide', 'thebestnotes']
 
@@ -31,7 +34,8 @@ def clean_summary(source):
     source_summary_dir_base = "../cleaning_phase/"
     dest_dir_base = "../finished_summaries/"
 
-    spacy_nlp = spacy.load("en_core_web_lg")
+    # Loaded once in the parent process and inherited by the forked workers
+    spacy_nlp = spacy_registry.get_pipeline("en_core_web_lg")
 
     source_summary_dir = os.path.join(source_summary_dir_base, source)
     dest_dir = os.path.join(dest_dir_base, source)
@@ -361,5 +365,8 @@ def clean_summary(source):
 
 n_cpus = 8
 
+# Load the pipeline before forking, so that the workers share a single copy
+spacy_registry.preload(("en_core_web_lg", None))
+
 with Pool(n_cpus) as p:
     p.map(clean_summary, sources)
\ No newline at end of file
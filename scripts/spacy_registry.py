@@ -0,0 +1,85 @@
+"""
+/*
+ * Copyright (c) 2021, salesforce.com, inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: BSD-3-Clause
+ * For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+ */
+
+Process-wide registry of spaCy pipelines shared by the cleaning, gathering and alignment scripts.
+Pipelines are keyed on the model name and the set of disabled components, loaded lazily on first use
+and kept for the lifetime of the process. Pipelines loaded before a `multiprocessing.Pool` is created are
+inherited by the forked workers instead of being loaded again in every worker.
+"""
+
+import atexit
+import gc
+import os
+import time
+
+# (model name, disabled components) -> loaded spaCy pipeline
+_PIPELINES = {}
+
+# (model name, disabled components) -> [load count, total load time in seconds, lookup count]
+_LOAD_STATS = {}
+
+# pid of the process that registered the exit report, forked workers inherit the registry but don't report
+_OWNER_PID = os.getpid()
+
+
+def pipeline_key(model_name, disable=None):
+    """
+    Key used to identify a pipeline in the registry
+
+    :param model_name: name of the spaCy model, eg. en_core_web_lg
+    :param disable: components of the pipeline that should be disabled
+    """
+    return (model_name, tuple(sorted(set(disable or ()))))
+
+
+def get_pipeline(model_name="en_core_web_lg", disable=None):
+    """
+    Return the spaCy pipeline for the given model name and disabled components, loading it on first use
+
+    :param model_name: name of the spaCy model, eg. en_core_web_lg
+    :param disable: components of the pipeline that should be disabled
+    """
+    key = pipeline_key(model_name, disable)
+    stats = _LOAD_STATS.setdefault(key, [0, 0.0, 0])
+    stats[2] += 1
+
+    if key not in _PIPELINES:
+        import spacy
+
+        start = time.time()
+        _PIPELINES[key] = spacy.load(model_name, disable=list(key[1]))
+        stats[0] += 1
+        stats[1] += time.time() - start
+
+    return _PIPELINES[key]
+
+
+def preload(*keys):
+    """
+    Load the given pipelines in the current process before forking workers.
+    Objects loaded so far are moved out of the garbage collector's tracking so that the
+    forked workers don't touch (and copy) the pages holding the pipelines.
+
+    :param keys: (model name, disabled components) tuples
+    """
+    for model_name, disable in keys:
+        get_pipeline(model_name, disable)
+
+    gc.freeze()
+
+
+def report_load_stats():
+    if os.getpid() != _OWNER_PID or not _LOAD_STATS:
+        return
+
+    print ("spaCy pipelines loaded: ")
+    for (model_name, disable), (load_count, load_time, lookup_count) in _LOAD_STATS.items():
+        print ("  %s (disabled: %s) loads: %d, lookups: %d, load time: %.2fs" % (model_name, ", ".join(disable) or "-", load_count, lookup_count, load_time))
+
+
+atexit.register(report_load_stats)